@@ -10,7 +10,13 @@ except ImportError:
 import remerkleable.settings as remerkleable_settings
 
 
+# Number of merkle_hash calls, to instrument the hash caching of the step trees
+merkle_hash_calls = 0
+
+
 def merkle_hash(left: bytes, right: bytes) -> bytes:
+    global merkle_hash_calls
+    merkle_hash_calls += 1
     return keccak_256(left + right)
 
 
@@ -1,26 +1,23 @@
 import click
-from typing import List, BinaryIO
+from typing import BinaryIO, Optional
+import macula
+import mmap
+import os
 from .exec_mode import ExecMode
-from .step import Step, Bytes32, MinimalExecutionPayload
+from .step import MinimalExecutionPayload
 from .capture import CaptureTrace
-from .interpreter import next_step
-from .witness import TraceWitnessData, StepAccessList
-from .external import HttpSource
+from .witness_gen import write_step_witness, replay_step_witness
+from .witness_stream import WitnessWriter, WitnessReader, open_witness
+from .checkpoint import Checkpoint, checkpoint_path, write_checkpoint, read_checkpoint, restore_trace
+from .fast_forward import FastForwardTrace, fast_forward as run_fast_forward
+from .bench import bench as run_bench, bench_dispatch as run_bench_dispatch
+from .external import ExternalSource, HttpSource
+from .rpc import DEFAULT_TIMEOUT
+from .params import MPT_READ_NODES_PER_STEP
 from .block import load_block
-from remerkleable.tree import PairNode
 import json
 
 
-def encode_hex(v: bytes) -> str:
-    return '0x' + v.hex()
-
-
-def decode_hex(v: str) -> bytes:
-    if v.startswith('0x'):
-        v = v[2:]
-    return bytes.fromhex(v)
-
-
 @click.group()
 def cli():
     """Macula - optimistic rollup tech for ethereum
@@ -33,32 +30,70 @@ SANITY_LIMIT = 10000
 
 
 @cli.command()
-@click.argument('output', type=click.File('wb'))
+@click.argument('output', type=click.Path(dir_okay=False))
 @click.argument('api', type=click.STRING)
 @click.argument('block', type=click.STRING)
-def gen(output: BinaryIO, api: str, block: str):
+@click.option('--checkpoint-every', type=click.INT, default=1000, help="steps between checkpoints, 0 to disable")
+@click.option('--resume', is_flag=True, help="continue from the latest checkpoint of the output")
+@click.option('--sparse', type=click.IntRange(min=1), default=1,
+              help="keep the full witness of every K-th step only, other steps are replayed on demand")
+@click.option('--rpc-timeout', type=click.FLOAT, default=DEFAULT_TIMEOUT, help="seconds until an API call fails")
+@click.option('--mpt-nodes-per-step', type=click.IntRange(min=1, max=255), default=MPT_READ_NODES_PER_STEP,
+              help="trie levels an MPT read step may descend through")
+def gen(output: str, api: str, block: str, checkpoint_every: int, resume: bool, sparse: int,
+        rpc_timeout: float, mpt_nodes_per_step: int):
     """Generate a fraud proof for the given transaction
 
+    OUTPUT file to write the witness to, checkpoints are written next to it
+
     API endpoint to fetch state trie and contract code from
 
     BLOCK json-encoded minimal execution payload
      (parent_hash, coinbase, random, block_number, gas_limit, timestamp, transactions)
     """
+    checkpoint: Optional[Checkpoint] = None
+    if resume:
+        with open(checkpoint_path(output), 'rb') as f:
+            checkpoint = read_checkpoint(f)
+        click.echo("resuming from checkpoint at step %d" % checkpoint.step_number)
+
+    with open(output, 'r+b' if resume else 'wb') as f, HttpSource(api, timeout=rpc_timeout) as src:
+        existing: Optional[WitnessReader] = None
+        if checkpoint is not None:
+            # drop everything that was written after the checkpoint
+            f.truncate(checkpoint.output_offset)
+            existing = WitnessReader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            f.seek(0, os.SEEK_END)
+        gen_trace(WitnessWriter(f, existing), output, src, block, checkpoint, existing, checkpoint_every, sparse,
+                  mpt_nodes_per_step)
+        f.flush()
+    click.echo("done!")
+
 
+# Runs the trace, and writes the witness of each step as soon as it is complete
+def gen_trace(writer: WitnessWriter, output: str, src: ExternalSource, block: str, checkpoint: Optional[Checkpoint],
+              existing: Optional[WitnessReader], checkpoint_every: int, sparse: int, nodes_per_step: int):
     click.echo("preparing trace...")
-    src = HttpSource(api)
-    trac = CaptureTrace(src)
+    n = 0
+    if checkpoint is None:
+        trac = CaptureTrace(src, nodes_per_step=nodes_per_step)
 
-    click.echo("decoding block: "+block)
-    block_obj = json.loads(block)
-    min_payload = MinimalExecutionPayload.from_obj(block_obj)
+        click.echo("decoding block: "+block)
+        block_obj = json.loads(block)
+        min_payload = MinimalExecutionPayload.from_obj(block_obj)
 
-    click.echo("loading first step...")
-    init_step = load_block(min_payload)
-    trac.add_step(init_step)
+        click.echo("loading first step...")
+        init_step = load_block(min_payload)
+        trac.add_step(init_step)
+    else:
+        click.echo("loading checkpoint step...")
+        trac = restore_trace(checkpoint, existing, src, nodes_per_step)
+        n = checkpoint.step_number
+
+    hash_calls_start = macula.merkle_hash_calls
+    uncached_hash_calls = 0
 
     click.echo("running step by step proof generator...")
-    n = 0
     while True:
         click.echo("\rProcessing step %d" % n, nl=False)
         n += 1
@@ -66,85 +101,94 @@ def gen(output: BinaryIO, api: str, block: str):
         if n >= SANITY_LIMIT:
             raise Exception("Oh no! So many steps! What happened?")
 
-        # reset tracking of the nodes of all steps,
-        # so we can capture which parts are accessed for the production of the new step
-        trac.reset_shims()
-        # Given the trace interface (last step + MPTs + code by hash), produce the new step
-        new_step = next_step(trac)
-        # capture which parts of the last step were accessed to create next_step
-        trac.capture_access()
+        # produce the next step, and capture what it accessed of the last step
+        new_step = trac.trace_next()
+        # the access of the last step is complete, its witness can be written out already
+        full = writer.step_count % sparse == 0
+        uncached_hash_calls += write_step_witness(writer, trac, len(trac.steps)-1, full)
         # adds step, and a new trace entry to track what the step after will access
         trac.add_step(new_step)
+        # the witness is written, only the last step is needed to continue
+        trac.prune()
 
         mode = ExecMode(trac.last().exec_mode)
         if mode == ExecMode.DONE:
             break
 
-    click.echo("generated %d steps!" % n)
+        if checkpoint_every > 0 and n % checkpoint_every == 0:
+            write_checkpoint(checkpoint_path(output), trac, writer, n)
 
-    if len(trac.step_trace) != len(trac.access_trace):
-        raise Exception("steps and access count different: %d <> %d" % (len(trac.step_trace), len(trac.access_trace)))
+    # the final step does not access anything, but its root is the post-state of the step before it
+    uncached_hash_calls += write_step_witness(writer, trac, len(trac.steps)-1, writer.step_count % sparse == 0)
 
-    binary_nodes = dict()
+    click.echo("generated %d steps!" % n)
+    hash_calls = macula.merkle_hash_calls - hash_calls_start
+    click.echo("keccak calls for step trees: %d, saved by hash cache: %d" % (
+        hash_calls, uncached_hash_calls - hash_calls))
 
-    def store_tree(b: PairNode):
-        left, right = b.get_left(), b.get_right()
-        # The merkle-roots are cached, this is fine
-        binary_nodes[encode_hex(b.merkle_root())] = [encode_hex(left.merkle_root()), encode_hex(right.merkle_root())]
-        if not left.is_leaf():
-            store_tree(left)
-        if not right.is_leaf():
-            store_tree(right)
+    if len(trac.steps) != len(trac.access_trace):
+        raise Exception("steps and access count different: %d <> %d" % (len(trac.steps), len(trac.access_trace)))
 
-    click.echo("formatting witness data...")
+    click.echo("writing witness index...")
+    writer.close()
 
-    access_per_step: List[StepAccessList] = []
-    for i in range(n):
-        click.echo("\rProcessing step witness %d" % n, nl=False)
 
-        step = trac.step_trace[i]
-        acc_li = trac.access_trace[i]
+@cli.command()
+@click.argument('api', type=click.STRING)
+@click.argument('block', type=click.STRING)
+@click.option('--rpc-timeout', type=click.FLOAT, default=DEFAULT_TIMEOUT, help="seconds until an API call fails")
+@click.option('--mpt-nodes-per-step', type=click.IntRange(min=1, max=255), default=MPT_READ_NODES_PER_STEP,
+              help="trie levels an MPT read step may descend through")
+def fast_forward(api: str, block: str, rpc_timeout: float, mpt_nodes_per_step: int):
+    """Run the trace without capturing a witness, to get the step count and final root
 
-        # Combine all different MPT witnesses, they are unique by hash anyway
-        nodes = [encode_hex(n) for n in acc_li.accessed_world_mpt_nodes]
-        for node_li in acc_li.accessed_acc_storage_mpt_nodes.values():
-            nodes.extend([encode_hex(n) for n in node_li])
+    API endpoint to fetch state trie and contract code from
 
-        access_per_step.append(StepAccessList(
-            root=encode_hex(step.hash_tree_root()),
-            accessed_gindices=[encode_hex(gi.to_bytes(length=32, byteorder='big')) for gi in acc_li.step_gindices],
-            accessed_world_mpt_nodes=nodes,
-            accessed_code_hashes=[encode_hex(h) for h in acc_li.accessed_codes],
-        ))
+    BLOCK json-encoded minimal execution payload
+    """
+    min_payload = MinimalExecutionPayload.from_obj(json.loads(block))
+    with HttpSource(api, timeout=rpc_timeout) as src:
+        trac = FastForwardTrace(src, load_block(min_payload), nodes_per_step=mpt_nodes_per_step)
+        roots = run_fast_forward(trac, SANITY_LIMIT)
+    click.echo("steps: %d" % (len(roots) - 1))
+    click.echo("final root: 0x%s" % roots[-1].hex())
 
-        # store the nodes in a shared dict
-        store_tree(step.get_backing())
 
-    code_by_hash = {encode_hex(k): encode_hex(v) for k, v in trac.codes.items()}
-    mpt_node_by_hash = {encode_hex(k): encode_hex(v) for k, v in trac.world_mpt.local_db.items()}
+@cli.command()
+@click.option('--rounds', type=click.IntRange(min=1), default=200, help="PUSH1/ADD/POP rounds of the synthetic code")
+def bench(rounds: int):
+    """Compare the fast-forward executor with the capture path of gen, on synthetic code"""
+    steps, ff_time, capture_time = run_bench(rounds, 100 * rounds + 1000)
+    click.echo("steps: %d" % steps)
+    click.echo("fast-forward: %.3fs (%.0f steps/s)" % (ff_time, steps / ff_time))
+    click.echo("capture:      %.3fs (%.0f steps/s)" % (capture_time, steps / capture_time))
+    click.echo("speedup: %.2fx" % (capture_time / ff_time))
 
-    trac_witness = TraceWitnessData(
-        code_by_hash=code_by_hash,
-        mpt_node_by_hash=mpt_node_by_hash,
-        binary_nodes=binary_nodes,
-        steps=access_per_step,
-    )
 
-    click.echo("writing witness data...")
-    json.dump(trac_witness, output)
-    click.echo("done!")
+@cli.command()
+@click.option('--mode', type=click.Choice([mode.name for mode in ExecMode]), default=ExecMode.OpcodeRun.name,
+              help="exec mode of the dispatched step")
+@click.option('--iterations', type=click.IntRange(min=1), default=100000, help="steps to dispatch")
+def bench_dispatch(mode: str, iterations: int):
+    """Per-step overhead of next_step dispatch, against the if-chain it replaced, with stubbed processors"""
+    chain_time, table_time = run_bench_dispatch(ExecMode[mode], iterations)
+    click.echo("if-chain: %.2fus per step" % (chain_time * 1e6))
+    click.echo("table:    %.2fus per step" % (table_time * 1e6))
+    click.echo("speedup: %.2fx" % (chain_time / table_time))
 
 
 @cli.command()
 @click.argument('input', type=click.File('rb'))
 @click.argument('output', type=click.File('wb'))
 @click.argument('step', type=click.INT)
-def step_witness(input: BinaryIO, step: int, output: BinaryIO):
+@click.option('--mpt-nodes-per-step', type=click.IntRange(min=1, max=255), default=MPT_READ_NODES_PER_STEP,
+              help="as the trace was generated with")
+def step_witness(input: BinaryIO, step: int, output: BinaryIO, mpt_nodes_per_step: int):
     """Compute the witness data for a single step by index, using the full trace witness"""
-    obj = json.load(input)
-    trace_witness_data = TraceWitnessData(**obj)
-    step_witness_data = trace_witness_data.get_step_witness(step)
-    json.dump(step_witness_data, output)
+    trace_witness_data = open_witness(input)
+    # steps of a sparse trace are replayed from the last full step before them
+    step_witness_data = replay_step_witness(trace_witness_data, step, mpt_nodes_per_step)
+    output.write(json.dumps(step_witness_data).encode())
 
 
 @cli.command()
@@ -0,0 +1,182 @@
+from typing import Callable, List, Sequence, Tuple
+import io
+import time
+from .step import Step
+from .opcodes import OpCode
+from .exec_mode import ExecMode
+from .external import NoSource
+from .capture import CaptureTrace
+from .fast_forward import FastForwardTrace, fast_forward
+from .witness_stream import WitnessWriter
+from .witness_gen import write_step_witness
+from . import interpreter
+
+# Synthetic workload to compare the fast-forward executor with the capture path of gen.
+# The workload only needs the step itself, no external data.
+
+
+# PUSH1/ADD/POP loop, unrolled: each round pushes a value, adds it to the sum, and pushes and pops a scratch value.
+def synthetic_code(rounds: int) -> bytes:
+    ops = [OpCode.PUSH1, 0]
+    for i in range(rounds):
+        ops += [OpCode.PUSH1, i & 0xff, OpCode.ADD, OpCode.PUSH1, 0, OpCode.POP]
+    ops += [OpCode.POP, OpCode.STOP]
+    return bytes(map(lambda x: int(x.value) if isinstance(x, OpCode) else int(x), ops))
+
+
+def synthetic_step(rounds: int) -> Step:
+    step = Step()
+    step.contract.code = synthetic_code(rounds)
+    step.contract.gas = 1_000_000_000
+    step.exec_mode = ExecMode.CallPre.value
+    return step
+
+
+# The synthetic code ends with a STOP, the steps after it need a calling step, so the run stops there.
+BENCH_UNTIL = ExecMode.ErrSTOP
+
+
+def run_fast_forward(step: Step, limit: int) -> List[bytes]:
+    return fast_forward(FastForwardTrace(NoSource(), step), limit, until=BENCH_UNTIL)
+
+
+# Same work per step as gen: capture the access, and write the witness.
+def run_capture(step: Step, limit: int) -> List[bytes]:
+    trac = CaptureTrace(NoSource())
+    trac.add_step(step)
+    writer = WitnessWriter(io.BytesIO())
+    roots = [step.hash_tree_root()]
+    while ExecMode(trac.last().exec_mode) != BENCH_UNTIL:
+        if len(roots) >= limit:
+            raise Exception("Oh no! So many steps! What happened?")
+        new_step = trac.trace_next()
+        write_step_witness(writer, trac, len(trac.steps)-1)
+        trac.add_step(new_step)
+        trac.prune()
+        roots.append(trac.last().hash_tree_root())
+    write_step_witness(writer, trac, len(trac.steps)-1)
+    writer.close()
+    return roots
+
+
+# Returns the step count, and the seconds it took with fast-forward and with capture.
+def bench(rounds: int, limit: int) -> Tuple[int, float, float]:
+    start = time.perf_counter()
+    ff_roots = run_fast_forward(synthetic_step(rounds), limit)
+    ff_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    capture_roots = run_capture(synthetic_step(rounds), limit)
+    capture_time = time.perf_counter() - start
+
+    if ff_roots != capture_roots:
+        raise Exception("fast-forward and capture runs diverged")
+    return len(ff_roots), ff_time, capture_time
+
+
+# Dispatch microbenchmark of next_step: the step processors are stubbed out, so only the per-step overhead
+# of picking the processor is measured. next_step looks it up in EXEC_MODE_PROCS by the raw exec mode byte.
+# chain_dispatch is the ExecMode if-chain that the table replaced, in the same order, kept for the comparison.
+
+def chain_dispatch(trac: FastForwardTrace, procs: Sequence[Callable]) -> Step:
+    last = trac.last()
+    mode = ExecMode(last.exec_mode)
+
+    if mode == ExecMode.BlockPre:
+        return procs[ExecMode.BlockPre](trac)
+
+    if mode == ExecMode.TxLoad:
+        return procs[ExecMode.TxLoad](trac)
+    if mode == ExecMode.TxProc:
+        return procs[ExecMode.TxProc](trac)
+    if mode == ExecMode.TxFeesPre:
+        return procs[ExecMode.TxFeesPre](trac)
+    if mode == ExecMode.TxFeesPost:
+        return procs[ExecMode.TxFeesPost](trac)
+
+    if mode == ExecMode.CallSetup:
+        return procs[ExecMode.CallSetup](trac)
+    if mode == ExecMode.CallPre:
+        return procs[ExecMode.CallPre](trac)
+    if mode == ExecMode.CallPost:
+        return procs[ExecMode.CallPost](trac)
+    if mode == ExecMode.CallRevert:
+        return procs[ExecMode.CallRevert](trac)
+    if ExecMode.ErrSTOP <= mode <= ExecMode.ErrInsufficientBalance:
+        return procs[mode](trac)
+
+    if mode == ExecMode.CreateSetup:
+        return procs[ExecMode.CreateSetup](trac)
+    if mode == ExecMode.CreateInitPost:
+        return procs[ExecMode.CreateInitPost](trac)
+    if mode == ExecMode.CreateInitRevert:
+        return procs[ExecMode.CreateInitRevert](trac)
+    if mode == ExecMode.CreateInitErr:
+        return procs[ExecMode.CreateInitErr](trac)
+
+    if mode == ExecMode.OpcodeLoad:
+        return procs[ExecMode.OpcodeLoad](trac)
+    if mode == ExecMode.ValidateStack:
+        return procs[ExecMode.ValidateStack](trac)
+    if mode == ExecMode.ReadOnlyCheck:
+        return procs[ExecMode.ReadOnlyCheck](trac)
+    if mode == ExecMode.ConstantGas:
+        return procs[ExecMode.ConstantGas](trac)
+    if mode == ExecMode.CalcMemorySize:
+        return procs[ExecMode.CalcMemorySize](trac)
+    if mode == ExecMode.DynamicGas:
+        return procs[ExecMode.DynamicGas](trac)
+    if mode == ExecMode.UpdateMemorySize:
+        return procs[ExecMode.UpdateMemorySize](trac)
+    if mode == ExecMode.OpcodeRun:
+        return procs[ExecMode.OpcodeRun](trac)
+
+    if ExecMode.ErrInvalidTransactionType <= mode <= ExecMode.ErrInvalidTransactionPubkey:
+        return procs[mode](trac)
+
+    if mode == ExecMode.StateWork:
+        return procs[ExecMode.StateWork](trac)
+    if mode == ExecMode.MPTWork:
+        return procs[ExecMode.MPTWork](trac)
+
+    if mode == ExecMode.BlockPreStateLoad:
+        return procs[ExecMode.BlockPreStateLoad](trac)
+    if mode == ExecMode.BlockHistoryLoad:
+        return procs[ExecMode.BlockHistoryLoad](trac)
+    if mode == ExecMode.BlockCalcBaseFee:
+        return procs[ExecMode.BlockCalcBaseFee](trac)
+    if mode == ExecMode.BlockTxLoop:
+        return procs[ExecMode.BlockTxLoop](trac)
+    if mode == ExecMode.BlockPost:
+        return procs[ExecMode.BlockPost](trac)
+
+    raise Exception("unrecognized execution mode: %d" % mode)
+
+
+def stub_proc(trac: FastForwardTrace) -> Step:
+    return trac.step
+
+
+# Returns the seconds per step of dispatching a step of the given exec mode, with the if-chain and with next_step.
+def bench_dispatch(mode: ExecMode, iterations: int) -> Tuple[float, float]:
+    step = Step()
+    step.exec_mode = mode
+    trac = FastForwardTrace(NoSource(), step)
+    stubs = (stub_proc,) * 256
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        chain_dispatch(trac, stubs)
+    chain_time = time.perf_counter() - start
+
+    # next_step reads the table from the interpreter module, swapped for the stubs during the run
+    procs = interpreter.EXEC_MODE_PROCS
+    interpreter.EXEC_MODE_PROCS = stubs
+    try:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            interpreter.next_step(trac)
+        table_time = time.perf_counter() - start
+    finally:
+        interpreter.EXEC_MODE_PROCS = procs
+    return chain_time / iterations, table_time / iterations
@@ -20,31 +20,31 @@ def load_block(payload: MinimalExecutionPayload) -> Step:
 
 def exec_pre_block(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
+    patch = last.patch()
     sub_index = last.sub_index
 
     # step by step, fully copy over the payload into the right places
     if sub_index == 0:
-        next.block.parent_hash = last.payload.parent_hash
+        patch.set(last.payload.parent_hash, 'block', 'parent_hash')
     elif sub_index == 1:
-        next.block.coinbase = last.payload.coinbase
+        patch.set(last.payload.coinbase, 'block', 'coinbase')
     elif sub_index == 2:
-        next.block.difficulty = last.payload.random
+        patch.set(last.payload.random, 'block', 'difficulty')
     elif sub_index == 3:
-        next.block.block_number = last.payload.block_number
+        patch.set(last.payload.block_number, 'block', 'block_number')
     elif sub_index == 4:
-        next.block.gas_limit = last.payload.gas_limit
+        patch.set(last.payload.gas_limit, 'block', 'gas_limit')
     elif sub_index == 5:
-        next.block.time = last.payload.timestamp
+        patch.set(last.payload.timestamp, 'block', 'time')
     else:
         # note: we don't have to move the transactions, the step.tx.tx_index == 0, and it will load later.
         # Continue with loading pre-state
-        next.exec_mode = ExecMode.BlockPreStateLoad
-        next.sub_index = 0
-        return next
+        patch.set(ExecMode.BlockPreStateLoad, 'exec_mode')
+        patch.set(0, 'sub_index')
+        return patch.apply()
 
-    next.sub_index += 1
-    return next
+    patch.set(sub_index + 1, 'sub_index')
+    return patch.apply()
 
 
 def exec_block_pre_state_load(trac: StepsTrace) -> Step:
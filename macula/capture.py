@@ -1,11 +1,16 @@
-from typing import Dict, Callable, List, Set
+from typing import Dict, Callable, List, Set, Optional, Tuple
+from array import array
 from remerkleable.tree import Gindex
 from .step import Step, Bytes32, Address
 from .trace import StepsTrace
 from . import keccak_256
-from .node_shim import ShimNode
-from .mpt_work import MPT
+from .node_shim import ShimNode, ShimTracker
+from .mpt_work import MPT, MPTReadCache
+from .params import MPT_READ_CACHE_SIZE, MPT_READ_NODES_PER_STEP
 from .external import ExternalSource
+from .interpreter import next_step
+from .jump_table import JumpTable, JumpTableCache
+from .prefetch import prefetch_after_tx_load
 
 
 class CaptureMPT(MPT):
@@ -14,6 +19,9 @@ class CaptureMPT(MPT):
     # node hash -> node contents
     local_db: Dict[bytes, bytes]
 
+    # read steps, by node reference and key
+    reads: MPTReadCache
+
     # track accessed nodes
     on_access: Callable[[Bytes32], None]
 
@@ -21,6 +29,10 @@ class CaptureMPT(MPT):
         self.node_getter = node_getter
         self.on_access = on_access
         self.local_db = dict()
+        self.reads = MPTReadCache(MPT_READ_CACHE_SIZE)
+
+    def read_cache(self) -> MPTReadCache:
+        return self.reads
 
     def get_node(self, key: Bytes32) -> bytes:
         self.on_access(key)
@@ -38,6 +50,9 @@ class CaptureMPT(MPT):
 
 
 class StepAccessedKeys(object):
+    __slots__ = ('step_gindices', 'accessed_world_mpt_nodes', 'accessed_acc_storage_mpt_nodes',
+                 'accessed_codes', 'block_headers')
+
     # all the locations of binary tree nodes that were accessed
     step_gindices: Set[Gindex]
     # TODO: share these between world-nodes and account storage nodes?
@@ -56,6 +71,158 @@ class StepAccessedKeys(object):
         self.block_headers = set()
 
 
+# Gindices of deeply nested steps do not fit in 64 bits. These are interned too,
+# and stored as their index in the table of big gindices, with this flag set.
+BIG_GINDEX_FLAG = 1 << 63
+
+
+# Columnar log of what every step of a trace accessed.
+#
+# The step that is still being traced (the last one) has its own StepAccessedKeys, to collect the accesses into,
+# and so does the step before it. Sealing is deferred by one step: only when a step is appended after that,
+# the accesses of the previous step are sealed into the columns: one array('Q') per kind of access,
+# with the gindices, or indices into a table of hashes and addresses, interned once for the whole log.
+# Per sealed step, the end offsets of its range in every column are stored, also in an array('Q').
+#
+# gen prunes the trace after every step (see CaptureTrace.prune): then the previous step is dropped
+# before it is ever sealed, and the columns stay empty. They only build up in traces that are not pruned.
+#
+# Indexing the log returns a StepAccessedKeys, materialized from the columns for sealed steps:
+# changing it does not change the log.
+class AccessLog(object):
+    __slots__ = ('table', 'table_index', 'big_gindices', 'big_gindex_index',
+                 'gindices', 'world_nodes', 'storage_addrs', 'storage_nodes', 'codes', 'headers',
+                 'ends', 'sealed', 'previous', 'current')
+
+    # interned node hashes, code hashes, block hashes and addresses
+    table: List[bytes]
+    table_index: Dict[bytes, int]
+    big_gindices: List[Gindex]
+    big_gindex_index: Dict[Gindex, int]
+
+    gindices: array
+    world_nodes: array
+    # storage node accesses are pairs: the account address and the node hash
+    storage_addrs: array
+    storage_nodes: array
+    codes: array
+    headers: array
+
+    # per sealed step, the end offsets in the columns, see column_ends
+    ends: array
+    sealed: int
+    previous: Optional[StepAccessedKeys]
+    current: Optional[StepAccessedKeys]
+
+    def __init__(self):
+        self.reset_sealed()
+        self.previous = None
+        self.current = None
+
+    def reset_sealed(self) -> None:
+        self.table = []
+        self.table_index = dict()
+        self.big_gindices = []
+        self.big_gindex_index = dict()
+        self.gindices = array('Q')
+        self.world_nodes = array('Q')
+        self.storage_addrs = array('Q')
+        self.storage_nodes = array('Q')
+        self.codes = array('Q')
+        self.headers = array('Q')
+        self.ends = array('Q')
+        self.sealed = 0
+
+    def columns(self) -> Tuple[array, ...]:
+        # storage_nodes has the same offsets as storage_addrs
+        return self.gindices, self.world_nodes, self.storage_addrs, self.codes, self.headers
+
+    def intern(self, key: bytes) -> int:
+        i = self.table_index.get(key)
+        if i is None:
+            i = len(self.table)
+            self.table.append(key)
+            self.table_index[key] = i
+        return i
+
+    def encode_gindex(self, gindex: Gindex) -> int:
+        if gindex < BIG_GINDEX_FLAG:
+            return gindex
+        i = self.big_gindex_index.get(gindex)
+        if i is None:
+            i = len(self.big_gindices)
+            self.big_gindices.append(gindex)
+            self.big_gindex_index[gindex] = i
+        return i | BIG_GINDEX_FLAG
+
+    def decode_gindex(self, v: int) -> Gindex:
+        if v & BIG_GINDEX_FLAG:
+            return self.big_gindices[v ^ BIG_GINDEX_FLAG]
+        return Gindex(v)
+
+    def seal(self, acc: StepAccessedKeys) -> None:
+        self.gindices.extend(self.encode_gindex(g) for g in sorted(acc.step_gindices))
+        self.world_nodes.extend(self.intern(h) for h in acc.accessed_world_mpt_nodes)
+        for addr, keys in acc.accessed_acc_storage_mpt_nodes.items():
+            a = self.intern(addr)
+            for h in keys:
+                self.storage_addrs.append(a)
+                self.storage_nodes.append(self.intern(h))
+        self.codes.extend(self.intern(h) for h in acc.accessed_codes)
+        self.headers.extend(self.intern(h) for h in acc.block_headers)
+        self.ends.extend(len(col) for col in self.columns())
+        self.sealed += 1
+
+    # the (start, end) offsets of sealed step i in every column
+    def column_ranges(self, i: int) -> List[Tuple[int, int]]:
+        n = len(self.columns())
+        ends = self.ends[i*n:(i+1)*n]
+        starts = self.ends[(i-1)*n:i*n] if i > 0 else [0] * n
+        return list(zip(starts, ends))
+
+    def materialize(self, i: int) -> StepAccessedKeys:
+        (g0, g1), (w0, w1), (s0, s1), (c0, c1), (h0, h1) = self.column_ranges(i)
+        table = self.table
+        out = StepAccessedKeys()
+        out.step_gindices = set(self.decode_gindex(v) for v in self.gindices[g0:g1])
+        out.accessed_world_mpt_nodes = set(table[v] for v in self.world_nodes[w0:w1])
+        for a, h in zip(self.storage_addrs[s0:s1], self.storage_nodes[s0:s1]):
+            addr = table[a]
+            if addr not in out.accessed_acc_storage_mpt_nodes:
+                out.accessed_acc_storage_mpt_nodes[addr] = set()
+            out.accessed_acc_storage_mpt_nodes[addr].add(table[h])
+        out.accessed_codes = set(table[v] for v in self.codes[c0:c1])
+        out.block_headers = set(table[v] for v in self.headers[h0:h1])
+        return out
+
+    # Starts tracking the accesses of a new step. The accesses of the step before the previous one are sealed.
+    def append(self, acc: StepAccessedKeys) -> None:
+        if self.previous is not None:
+            self.seal(self.previous)
+        self.previous = self.current
+        self.current = acc
+
+    def __len__(self) -> int:
+        return self.sealed + (0 if self.previous is None else 1) + (0 if self.current is None else 1)
+
+    def __getitem__(self, i: int) -> StepAccessedKeys:
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("access log index out of range: %d" % i)
+        if i == n - 1 and self.current is not None:
+            return self.current
+        if i == self.sealed:
+            return self.previous
+        return self.materialize(i)
+
+    # Drops all steps but the current one, and the interned keys only they used.
+    def prune(self) -> None:
+        self.reset_sealed()
+        self.previous = None
+
+
 class CaptureTrace(StepsTrace):
     world_mpt: CaptureMPT
     acc_mpt_dict: Dict[Address, CaptureMPT]  # only contracts have an entry here
@@ -63,22 +230,37 @@ class CaptureTrace(StepsTrace):
     headers: Dict[Bytes32, bytes]
 
     # per step, track which contents were accessed (may recurse into embedded step)
-    access_trace: List[StepAccessedKeys]
-    step_trace: List[Step]
+    access_trace: AccessLog
+    steps: List[Step]
 
     src: ExternalSource
 
-    def __init__(self, src: ExternalSource):
+    # shared by the shims of all steps, resetting it resets the access tracking of all steps
+    shim_tracker: ShimTracker
+
+    jump_tables: JumpTableCache
+
+    # prefetch the nodes that a transaction is known to access, when it is loaded, see prefetch.py
+    prefetch: bool
+    # trie levels per MPT read step, see MPTWorkScope.nodes_per_step
+    nodes_per_step: int
+
+    def __init__(self, src: ExternalSource, prefetch: bool = True,
+                 nodes_per_step: int = MPT_READ_NODES_PER_STEP):
         self.world_mpt = CaptureMPT(src.get_world_node, self.on_world_access)
         self.acc_mpt_dict = dict()
         self.codes = dict()
         self.headers = dict()
-        self.step_trace = []
-        self.access_trace = []
+        self.steps = []
+        self.access_trace = AccessLog()
         self.src = src
+        self.shim_tracker = ShimTracker()
+        self.jump_tables = JumpTableCache()
+        self.prefetch = prefetch
+        self.nodes_per_step = nodes_per_step
 
     def on_world_access(self, key: Bytes32) -> None:
-        self.access_trace[len(self.access_trace)-1].accessed_world_mpt_nodes.add(key)
+        self.access_trace.current.accessed_world_mpt_nodes.add(key)
 
     def block_header(self, block_hash: Bytes32) -> bytes:
         if block_hash not in self.headers:
@@ -86,25 +268,42 @@ class CaptureTrace(StepsTrace):
             self.headers[block_hash] = header
         else:
             header = self.headers[block_hash]
-        self.access_trace[len(self.access_trace)-1].block_headers.add(block_hash)
+        self.access_trace.current.block_headers.add(block_hash)
         return header
 
     def world_accounts(self) -> MPT:
         return self.world_mpt
 
+    def on_acc_storage_access(self, address: Address, key: Bytes32) -> None:
+        acc_track = self.access_trace.current.accessed_acc_storage_mpt_nodes
+        if address not in acc_track:
+            acc_track[address] = set()
+        acc_track[address].add(key)
+
+    def new_acc_mpt(self, address: Address) -> CaptureMPT:
+        # accesses are tracked for the current step, not the step that first loaded the storage
+        mpt = CaptureMPT(lambda key: self.src.get_acc_storage_node(address, key),
+                         lambda key: self.on_acc_storage_access(address, key))
+        self.acc_mpt_dict[address] = mpt
+        return mpt
+
+    # the storage trie of the account, without tracking it as access
+    def acc_mpt(self, address: Address) -> CaptureMPT:
+        if address not in self.acc_mpt_dict:
+            return self.new_acc_mpt(address)
+        return self.acc_mpt_dict[address]
+
     def account_storage(self, address: Address) -> MPT:
-        acc_track = self.access_trace[len(self.access_trace)-1].accessed_acc_storage_mpt_nodes
+        acc_track = self.access_trace.current.accessed_acc_storage_mpt_nodes
         if address not in acc_track:
             acc_track[address] = set()
 
         if address not in self.acc_mpt_dict:
-            mpt = CaptureMPT(lambda key: self.src.get_acc_node(address, key), lambda key: acc_track[address].add(key))
-            self.acc_mpt_dict[address] = mpt
-            return mpt
+            return self.new_acc_mpt(address)
         return self.acc_mpt_dict[address]
 
     def code_lookup(self, code_hash: Bytes32) -> bytes:
-        self.access_trace[len(self.access_trace)-1].accessed_codes.add(code_hash)
+        self.access_trace.current.accessed_codes.add(code_hash)
         if code_hash not in self.codes:
             code = self.src.get_code(code_hash)
             self.codes[code_hash] = code
@@ -115,6 +314,12 @@ class CaptureTrace(StepsTrace):
         key = keccak_256(code)
         self.codes[key] = code
 
+    def jump_table(self, block_number: int) -> JumpTable:
+        return self.jump_tables.get(block_number)
+
+    def mpt_nodes_per_step(self) -> int:
+        return self.nodes_per_step
+
     def last(self) -> Step:
         if len(self.steps) == 0:
             raise Exception("step trace is empty, first step needs to be initialized still!")
@@ -122,21 +327,43 @@ class CaptureTrace(StepsTrace):
 
     def add_step(self, step: Step) -> None:
         # wraps the internal tree backing, to track which nodes have been touched.
-        step.set_backing(ShimNode.shim(step.get_backing()))
+        # Only the root is wrapped, nodes are wrapped lazily when touched.
+        step.set_backing(ShimNode.shim(step.get_backing(), self.shim_tracker))
 
         self.steps.append(step)
         # when producing the next step, we track what we access of this step.
         self.access_trace.append(StepAccessedKeys())
 
     def reset_shims(self):
-        for step in self.steps:
-            backing: ShimNode = step.get_backing()
-            backing.reset_shim()
+        # O(1), instead of resetting the nodes of every step
+        self.shim_tracker.reset()
 
     def capture_access(self):
         last = self.last()
         shim: ShimNode = last.get_backing()
         access_list = list(shim.get_touched_gindices(g=1))
-        last_access = self.access_trace[len(self.access_trace)-1]
+        last_access = self.access_trace.current
         last_access.step_gindices.update(access_list)
 
+    # Produces the next step, and captures what it accessed of the last step.
+    # The next step still has to be added with add_step.
+    def trace_next(self) -> Step:
+        # reset tracking of the nodes of all steps,
+        # so we can capture which parts are accessed for the production of the new step
+        self.reset_shims()
+        # Given the trace interface (last step + MPTs + code by hash), produce the new step
+        new_step = next_step(self)
+        # capture which parts of the last step were accessed to create next_step
+        self.capture_access()
+        if self.prefetch:
+            prefetch_after_tx_load(self.last(), new_step, self.src, self.world_mpt.local_db,
+                                   lambda addr: self.acc_mpt(addr).local_db)
+        return new_step
+
+    # Drops all steps (and their access) but the last, once their witness has been written.
+    # The trace only needs the last step to continue.
+    def prune(self) -> None:
+        del self.steps[:-1]
+        self.access_trace.prune()
+
+
@@ -0,0 +1,176 @@
+from typing import BinaryIO, Dict, Iterator, Tuple
+from enum import IntEnum
+import os
+from remerkleable.tree import Node, PairNode, RootNode
+from .step import Step, Address
+from .capture import CaptureTrace
+from .external import ExternalSource
+from .params import MPT_READ_NODES_PER_STEP
+from .witness_stream import WitnessReader, WitnessWriter, RecordKind, RECORD_HEADER_SIZE
+
+# Checkpoint of a trace in progress, to resume the generation of the witness after a crash.
+#
+# The tree of the last step is not stored in the checkpoint: the witness output contains all its binary nodes,
+# only the root is kept. Everything else the trace needs to continue is stored:
+# the MPT nodes of the world and account storage (including the ones no step accessed yet), codes and headers.
+#
+# Layout: CHECKPOINT_MAGIC, followed by records, like the witness container:
+# kind (1 byte) ++ payload length (4 bytes, big-endian) ++ payload.
+
+CHECKPOINT_MAGIC = b"MACK\x00\x01"
+
+
+class CheckpointKind(IntEnum):
+    # step number (8) ++ witness output offset (8) ++ root of the last step (32)
+    META = 0x01
+    # node hash (32) ++ RLP encoded MPT node
+    WORLD_MPT_NODE = 0x02
+    # account address (20) ++ node hash (32) ++ RLP encoded MPT node
+    STORAGE_MPT_NODE = 0x03
+    # code hash (32) ++ code
+    CODE = 0x04
+    # block hash (32) ++ header
+    HEADER = 0x05
+
+
+class Checkpoint(object):
+    # number of steps that were processed
+    step_number: int
+    # size of the witness output, anything after it is from after the checkpoint
+    output_offset: int
+    step_root: bytes
+
+    world_db: Dict[bytes, bytes]
+    acc_dbs: Dict[bytes, Dict[bytes, bytes]]
+    codes: Dict[bytes, bytes]
+    headers: Dict[bytes, bytes]
+
+    def __init__(self, step_number: int, output_offset: int, step_root: bytes):
+        self.step_number = step_number
+        self.output_offset = output_offset
+        self.step_root = step_root
+        self.world_db = dict()
+        self.acc_dbs = dict()
+        self.codes = dict()
+        self.headers = dict()
+
+
+def checkpoint_path(output_path: str) -> str:
+    return output_path + ".ckpt"
+
+
+def write_checkpoint(path: str, trac: CaptureTrace, writer: WitnessWriter, step_number: int) -> None:
+    last = trac.last()
+    # The witness of the last step is not written yet, its accesses are still to come.
+    # Its tree nodes can be written already, so the checkpoint only needs the root.
+    writer.write_tree(last.get_backing())
+    writer.flush()
+
+    def records() -> Iterator[Tuple[CheckpointKind, bytes]]:
+        yield CheckpointKind.META, (step_number.to_bytes(length=8, byteorder='big')
+                                    + writer.offset.to_bytes(length=8, byteorder='big')
+                                    + last.hash_tree_root())
+        for h, node in trac.world_mpt.local_db.items():
+            yield CheckpointKind.WORLD_MPT_NODE, bytes(h) + node
+        for addr, mpt in trac.acc_mpt_dict.items():
+            for h, node in mpt.local_db.items():
+                yield CheckpointKind.STORAGE_MPT_NODE, bytes(addr) + bytes(h) + node
+        for h, code in trac.codes.items():
+            yield CheckpointKind.CODE, bytes(h) + bytes(code)
+        for h, header in trac.headers.items():
+            yield CheckpointKind.HEADER, bytes(h) + bytes(header)
+
+    # write to a temporary file first, a crash while checkpointing should not lose the previous checkpoint
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(CHECKPOINT_MAGIC)
+        for kind, payload in records():
+            f.write(bytes([kind]) + len(payload).to_bytes(length=4, byteorder='big'))
+            f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(f: BinaryIO) -> Checkpoint:
+    if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+        raise Exception("not a checkpoint, or unsupported version")
+    checkpoint = None
+    while True:
+        header = f.read(RECORD_HEADER_SIZE)
+        if len(header) == 0:
+            break
+        if len(header) != RECORD_HEADER_SIZE:
+            raise Exception("truncated checkpoint record header")
+        kind = CheckpointKind(header[0])
+        length = int.from_bytes(header[1:], byteorder='big')
+        payload = f.read(length)
+        if len(payload) != length:
+            raise Exception("truncated checkpoint record")
+        if kind == CheckpointKind.META:
+            checkpoint = Checkpoint(
+                step_number=int.from_bytes(payload[:8], byteorder='big'),
+                output_offset=int.from_bytes(payload[8:16], byteorder='big'),
+                step_root=payload[16:48],
+            )
+            continue
+        if checkpoint is None:
+            raise Exception("checkpoint must start with the meta record")
+        if kind == CheckpointKind.WORLD_MPT_NODE:
+            checkpoint.world_db[payload[:32]] = payload[32:]
+        elif kind == CheckpointKind.STORAGE_MPT_NODE:
+            addr = payload[:20]
+            if addr not in checkpoint.acc_dbs:
+                checkpoint.acc_dbs[addr] = dict()
+            checkpoint.acc_dbs[addr][payload[20:52]] = payload[52:]
+        elif kind == CheckpointKind.CODE:
+            checkpoint.codes[payload[:32]] = payload[32:]
+        elif kind == CheckpointKind.HEADER:
+            checkpoint.headers[payload[:32]] = payload[32:]
+    if checkpoint is None:
+        raise Exception("empty checkpoint")
+    return checkpoint
+
+
+# Rebuilds a tree from the binary nodes in a witness container.
+# Roots that are not a binary node are leaves. Equal subtrees are shared, like in the original tree.
+def load_tree(reader: WitnessReader, root: bytes) -> Node:
+    built: Dict[bytes, Node] = dict()
+    stack = [root]
+    while len(stack) > 0:
+        r = stack[-1]
+        if r in built:
+            stack.pop()
+            continue
+        loc = reader.lookup(RecordKind.BINARY_NODE, r)
+        if loc is None:
+            built[r] = RootNode(r)
+            stack.pop()
+            continue
+        offset, length = loc
+        payload = reader.read_payload(offset + 32, 64)
+        left, right = payload[:32], payload[32:]
+        missing = [child for child in (left, right) if child not in built]
+        if len(missing) > 0:
+            stack.extend(missing)
+            continue
+        node = PairNode(built[left], built[right])
+        # the root is known, no need to hash the whole tree again
+        node._root = r
+        built[r] = node
+        stack.pop()
+    return built[root]
+
+
+def restore_trace(checkpoint: Checkpoint, reader: WitnessReader, src: ExternalSource,
+                  nodes_per_step: int = MPT_READ_NODES_PER_STEP) -> CaptureTrace:
+    trac = CaptureTrace(src, nodes_per_step=nodes_per_step)
+    trac.world_mpt.local_db.update(checkpoint.world_db)
+    for addr, db in checkpoint.acc_dbs.items():
+        trac.new_acc_mpt(Address(addr)).local_db.update(db)
+    trac.codes.update(checkpoint.codes)
+    trac.headers.update(checkpoint.headers)
+    if reader.lookup(RecordKind.BINARY_NODE, checkpoint.step_root) is None:
+        raise Exception("witness output does not contain the step of the checkpoint")
+    trac.add_step(Step.view_from_backing(load_tree(reader, checkpoint.step_root)))
+    return trac
@@ -1,5 +1,11 @@
-from typing import Protocol
+from typing import Any, Coroutine, List, Protocol, TypeVar
+import asyncio
+import threading
 from .step import Bytes32, Address
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from .rpc import RpcClient, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT
+
+T = TypeVar('T')
 
 
 class ExternalSource(Protocol):
@@ -15,23 +21,94 @@ class ExternalSource(Protocol):
     def get_code(self, code_hash: Bytes32) -> bytes:
         raise NotImplementedError
 
+    # Batched node lookups, see prefetch.py. Sources should fetch all keys in one request if they can,
+    # these defaults fetch them one by one.
+    def get_world_nodes(self, keys: List[Bytes32]) -> List[bytes]:
+        return [self.get_world_node(key) for key in keys]
+
+    def get_acc_storage_nodes(self, addr: Address, keys: List[Bytes32]) -> List[bytes]:
+        return [self.get_acc_storage_node(addr, key) for key in keys]
+
+
+# Source without any external data, for traces that only need the step itself, e.g. synthetic benchmarks and tests.
+class NoSource(ExternalSource):
+    pass
+
+
+# Key prefix of contract code in the node database (hash-based state scheme)
+CODE_DB_PREFIX = b"c"
+
+
+def decode_rpc_bytes(key: bytes, value) -> bytes:
+    if value is None:
+        raise KeyError("%s is not available from the rpc" % key.hex())
+    return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+
 
+# Fetches the external data from the JSON-RPC of an archive node:
+# state trie nodes and code with debug_dbGet, headers with debug_getRawHeader.
+#
+# The trace is synchronous, the client is not: it runs on an event loop in a background thread.
+# The batch methods send all their keys in one request, see prefetch.py.
+# Every call fails after the timeout (seconds), including retries. Close the source when done, or use it with "with".
 class HttpSource(ExternalSource):
     api_addr: str
+    timeout: float
+    client: RpcClient
+    loop: asyncio.AbstractEventLoop
+    thread: threading.Thread
 
-    def __init__(self, api_addr: str):
+    def __init__(self, api_addr: str, pool_size: int = DEFAULT_POOL_SIZE, timeout: float = DEFAULT_TIMEOUT):
         self.api_addr = api_addr
+        self.timeout = timeout
+        self.client = RpcClient(api_addr, pool_size, timeout)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="macula-rpc", daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> "HttpSource":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        fut = asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, self.timeout), self.loop)
+        try:
+            # the deadline is enforced within the loop, this only guards against a loop that is stuck
+            return fut.result(self.timeout + 1.0)
+        except FutureTimeoutError:
+            fut.cancel()
+            raise TimeoutError("rpc call to %s timed out after %.1f seconds" % (self.api_addr, self.timeout))
+
+    def close(self) -> None:
+        if self.loop.is_closed():
+            return
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def db_get(self, keys: List[bytes]) -> List[bytes]:
+        values = self.run(self.client.batch([("debug_dbGet", ["0x" + key.hex()]) for key in keys]))
+        return [decode_rpc_bytes(key, value) for key, value in zip(keys, values)]
 
-    # TODO: http client
     def block_header(self, block_hash: Bytes32) -> bytes:
-        ...
+        return decode_rpc_bytes(bytes(block_hash), self.run(
+            self.client.call("debug_getRawHeader", ["0x" + bytes(block_hash).hex()])))
 
+    # trie nodes are keyed by hash, the storage nodes of all accounts are in the same database
     def get_acc_storage_node(self, addr: Address, key: Bytes32) -> bytes:
-        ...
+        return self.db_get([bytes(key)])[0]
+
     def get_world_node(self, key: Bytes32) -> bytes:
-        ...
-    def get_code(self, code_hash: Bytes32) -> bytes:
-        ...
+        return self.db_get([bytes(key)])[0]
 
+    def get_code(self, code_hash: Bytes32) -> bytes:
+        return self.db_get([CODE_DB_PREFIX + bytes(code_hash)])[0]
 
+    def get_world_nodes(self, keys: List[Bytes32]) -> List[bytes]:
+        return self.db_get([bytes(key) for key in keys])
 
+    def get_acc_storage_nodes(self, addr: Address, keys: List[Bytes32]) -> List[bytes]:
+        return self.db_get([bytes(key) for key in keys])
@@ -0,0 +1,117 @@
+from typing import Callable, Dict, List
+from .step import Step, Bytes32, Address
+from .trace import StepsTrace, MPT
+from .mpt_work import MPTReadCache
+from .params import MPT_READ_CACHE_SIZE, MPT_READ_NODES_PER_STEP
+from .external import ExternalSource
+from .exec_mode import ExecMode
+from .interpreter import next_step
+from .jump_table import JumpTable, JumpTableCache
+from .prefetch import prefetch_after_tx_load
+from . import keccak_256
+
+
+# MPT node db without access tracking. Nodes are fetched from the source only once.
+class CachedMPT(MPT):
+    node_getter: Callable[[Bytes32], bytes]
+
+    # node hash -> node contents
+    local_db: Dict[bytes, bytes]
+
+    # read steps, by node reference and key
+    reads: MPTReadCache
+
+    def __init__(self, node_getter: Callable[[Bytes32], bytes]):
+        self.node_getter = node_getter
+        self.local_db = dict()
+        self.reads = MPTReadCache(MPT_READ_CACHE_SIZE)
+
+    def read_cache(self) -> MPTReadCache:
+        return self.reads
+
+    def get_node(self, key: Bytes32) -> bytes:
+        if key not in self.local_db:
+            out = self.node_getter(key)
+            self.local_db[key] = out
+            return out
+        return self.local_db[key]
+
+    def put_node(self, raw: bytes) -> None:
+        self.local_db[keccak_256(raw)] = raw
+
+
+# Runs the steps without capturing anything: no shims, no access lists, and only the last step is kept.
+# To find the number of steps and their roots quickly, before (or instead of) the witness pass of CaptureTrace.
+class FastForwardTrace(StepsTrace):
+    world_mpt: CachedMPT
+    acc_mpt_dict: Dict[Address, CachedMPT]
+    codes: Dict[Bytes32, bytes]
+    headers: Dict[Bytes32, bytes]
+
+    step: Step
+
+    src: ExternalSource
+
+    jump_tables: JumpTableCache
+
+    # prefetch the nodes that a transaction is known to access, when it is loaded, see prefetch.py
+    prefetch: bool
+    # trie levels per MPT read step, see MPTWorkScope.nodes_per_step
+    nodes_per_step: int
+
+    def __init__(self, src: ExternalSource, step: Step, prefetch: bool = True,
+                 nodes_per_step: int = MPT_READ_NODES_PER_STEP):
+        self.world_mpt = CachedMPT(src.get_world_node)
+        self.acc_mpt_dict = dict()
+        self.codes = dict()
+        self.headers = dict()
+        self.step = step
+        self.src = src
+        self.jump_tables = JumpTableCache()
+        self.prefetch = prefetch
+        self.nodes_per_step = nodes_per_step
+
+    def block_header(self, block_hash: Bytes32) -> bytes:
+        if block_hash not in self.headers:
+            self.headers[block_hash] = self.src.block_header(block_hash)
+        return self.headers[block_hash]
+
+    def world_accounts(self) -> MPT:
+        return self.world_mpt
+
+    def account_storage(self, address: Address) -> MPT:
+        if address not in self.acc_mpt_dict:
+            self.acc_mpt_dict[address] = CachedMPT(lambda key: self.src.get_acc_storage_node(address, key))
+        return self.acc_mpt_dict[address]
+
+    def code_lookup(self, code_hash: Bytes32) -> bytes:
+        if code_hash not in self.codes:
+            self.codes[code_hash] = self.src.get_code(code_hash)
+        return self.codes[code_hash]
+
+    def code_store(self, code: bytes) -> None:
+        self.codes[keccak_256(code)] = code
+
+    def jump_table(self, block_number: int) -> JumpTable:
+        return self.jump_tables.get(block_number)
+
+    def mpt_nodes_per_step(self) -> int:
+        return self.nodes_per_step
+
+    def last(self) -> Step:
+        return self.step
+
+
+# Runs until the given mode is reached, and returns the root of every step, including the first.
+def fast_forward(trac: FastForwardTrace, limit: int, until: ExecMode = ExecMode.DONE) -> List[bytes]:
+    roots = [trac.step.hash_tree_root()]
+    while ExecMode(trac.step.exec_mode) != until:
+        if len(roots) >= limit:
+            raise Exception("Oh no! So many steps! What happened?")
+        last = trac.step
+        trac.step = next_step(trac)
+        if trac.prefetch:
+            prefetch_after_tx_load(last, trac.step, trac.src, trac.world_mpt.local_db,
+                                   lambda addr: trac.account_storage(addr).local_db)
+        roots.append(trac.step.hash_tree_root())
+    return roots
@@ -13,38 +13,58 @@ def progress(step: Step) -> Step:
     return step
 
 
+# Fast path for opcodes that pop their inputs and push a single result.
+# Instead of modifying a copy through views, the result replaces the deepest input,
+# the other inputs are zeroed, the stack length is reduced, and the step progresses to the next opcode:
+# all in one batched tree modification, see Step.with_nodes.
+def stack_op_progress(last: Step, inputs: int, result: int) -> Step:
+    length = stack_length(last)
+    pc = int(uint64.view_from_backing(last.get_node(PC_GINDEX)))
+    patches = {stack_item_gindex(length - inputs): RootNode((result & UINT256_MASK).to_bytes(32, 'big'))}
+    for i in range(length - inputs + 1, length):
+        patches[stack_item_gindex(i)] = zero_node(0)
+    patches[STACK_LENGTH_GINDEX] = uint256(length - inputs + 1).get_backing()
+    patches[PC_GINDEX] = uint64(pc + 1).get_backing()
+    patches[EXEC_MODE_GINDEX] = uint8(ExecMode.OpcodeLoad).get_backing()
+    return last.with_nodes(patches)
+
+
+def stack_length(step: Step) -> int:
+    return int(uint256.view_from_backing(step.get_node(STACK_LENGTH_GINDEX)))
+
+
+# The top n stack items as ints, top first, read from the tree without views.
+def stack_ints(step: Step, n: int) -> PyList[int]:
+    length = stack_length(step)
+    if n > length:
+        raise Exception("bad stack access, interpreter bug")
+    backing = step.get_backing()
+    return [int.from_bytes(backing.getter(stack_item_gindex(length - 1 - i)).merkle_root(), 'big')
+            for i in range(n)]
+
+
 def op_add(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    # leave 1 top stack slot in place,
-    # more efficient to not change length more than necessary
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    next.contract.stack.tweak_u256(x+y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, x+y)
 
 
 def op_sub(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    next.contract.stack.tweak_u256(x-y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, x-y)
 
 
 def op_mul(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    next.contract.stack.tweak_u256(x*y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, x*y)
 
 
 def op_div(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    next.contract.stack.tweak_u256(x // y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, x // y if y != 0 else 0)
 
 
 # SDiv interprets x and y as two's complement signed integers,
@@ -52,30 +72,23 @@ def op_div(trac: StepsTrace) -> Step:
 # If y == 0, z is set to 0
 def op_sdiv(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    x, y = stack_ints(last, 2)
     z = 0
     if y != 0:
-        # signed ints now, not the SSZ uint256 anymore
-        x, y = int(x), int(y)
         if x >= (1 << 255): x = x - (1 << 255)
         if y >= (1 << 255): y = y - (1 << 255)
         z = x // y
         # back to uint256 representation
         if z < 0:
             z += 1 << 255
-        z = uint256(z)
 
-    next.contract.stack.tweak_u256(z)
-    return progress(next)
+    return stack_op_progress(last, 2, z)
 
 
 def op_mod(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    next.contract.stack.tweak_u256(x % y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, x % y if y != 0 else 0)
 
 
 # SMod interprets x and y as two's complement signed integers,
@@ -83,8 +96,7 @@ def op_mod(trac: StepsTrace) -> Step:
 # If y == 0, z is set to 0
 def op_smod(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    x, y = stack_ints(last, 2)
     z = 0
     if y != 0:
         # if negative, make it positive
@@ -96,17 +108,13 @@ def op_smod(trac: StepsTrace) -> Step:
             if z >= (1 << 255): z = z - (1 << 255)
             else: z = z + (1 << 255)
 
-    next.contract.stack.tweak_u256(z)
-    return progress(next)
+    return stack_op_progress(last, 2, z)
 
 
 def op_exp(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    z = uint256((int(x)**int(y)) % ((1 << 256)-1))
-    next.contract.stack.tweak_u256(z)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, pow(x, y, 1 << 256))
 
 
 def op_sign_extend(trac: StepsTrace) -> Step:
@@ -115,185 +123,122 @@ def op_sign_extend(trac: StepsTrace) -> Step:
 
 def op_not(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x = next.contract.stack.peek_u256()
-    x ^= (1 << 256)-1
-    next.contract.stack.tweak_u256(x)
-    return progress(next)
+    [x] = stack_ints(last, 1)
+    return stack_op_progress(last, 1, x ^ ((1 << 256)-1))
 
 
 def op_lt(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    if x < y:
-        y = 1
-    else:
-        y = 0
-    next.contract.stack.tweak_u256(y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, 1 if x < y else 0)
 
 
 def op_gt(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    if x > y:
-        y = 1
-    else:
-        y = 0
-    next.contract.stack.tweak_u256(y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, 1 if x > y else 0)
 
 def op_slt(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    x, y = stack_ints(last, 2)
 
-    # signed ints now, not the SSZ uint256 anymore
-    x, y = int(x), int(y)
     if x >= (1 << 255): x = x - (1 << 255)
     if y >= (1 << 255): y = y - (1 << 255)
 
-    if x < y:
-        y = 1
-    else:
-        y = 0
-    next.contract.stack.tweak_u256(y)
-    return progress(next)
+    return stack_op_progress(last, 2, 1 if x < y else 0)
 
 def op_sgt(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    x, y = stack_ints(last, 2)
 
-    # signed ints now, not the SSZ uint256 anymore
-    x, y = int(x), int(y)
     if x >= (1 << 255): x = x - (1 << 255)
     if y >= (1 << 255): y = y - (1 << 255)
 
-    if x > y:
-        y = 1
-    else:
-        y = 0
-    next.contract.stack.tweak_u256(y)
-    return progress(next)
+    return stack_op_progress(last, 2, 1 if x > y else 0)
 
 def op_eq(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    if x == y:
-        y = 1
-    else:
-        y = 0
-    next.contract.stack.tweak_u256(y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, 1 if x == y else 0)
 
 def op_iszero(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x = next.contract.stack.peek_u256()
-    if x == 0:
-        x = 1
-    else:
-        x = 0
-    next.contract.stack.tweak_u256(x)
-    return progress(next)
+    [x] = stack_ints(last, 1)
+    return stack_op_progress(last, 1, 1 if x == 0 else 0)
 
 def op_and(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    y = x & y
-    next.contract.stack.tweak_u256(y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, x & y)
 
 def op_or(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    y = x | y
-    next.contract.stack.tweak_u256(y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, x | y)
 
 def op_xor(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
-    y = x ^ y
-    next.contract.stack.tweak_u256(y)
-    return progress(next)
+    x, y = stack_ints(last, 2)
+    return stack_op_progress(last, 2, x ^ y)
 
 def op_byte(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    th, val = next.contract.stack.pop_u256(), next.contract.stack.peek_b32()
+    th, val = stack_ints(last, 2)
     out = 0
     if th < 32:
-        out = val[th]
+        out = (val >> (8 * (31 - th))) & 0xff
 
-    next.contract.stack.tweak_u256(uint256(out))
-    return progress(next)
+    return stack_op_progress(last, 2, out)
 
 def op_addmod(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y, z = next.contract.stack.pop_u256(), next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    x, y, z = stack_ints(last, 3)
     if z != 0:
-        z = uint256((int(x) + int(y)) % int(z))
+        z = (x + y) % z
 
-    next.contract.stack.tweak_u256(z)
-    return progress(next)
+    return stack_op_progress(last, 3, z)
 
 def op_mulmod(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    x, y, z = next.contract.stack.pop_u256(), next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    x, y, z = stack_ints(last, 3)
     if z != 0:
-        z = uint256((int(x) * int(y)) % int(z))
+        z = (x * y) % z
 
-    next.contract.stack.tweak_u256(z)
-    return progress(next)
+    return stack_op_progress(last, 3, z)
 
 
 def op_shl(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    shift, value = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    shift, value = stack_ints(last, 2)
     if shift < 256:
         value = value << shift
     else:
         value = 0
 
-    next.contract.stack.tweak_u256(value)
-    return progress(next)
+    return stack_op_progress(last, 2, value)
 
 
 def op_shr(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    shift, value = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    shift, value = stack_ints(last, 2)
     if shift < 256:
         value = value >> shift
     else:
         value = 0
 
-    next.contract.stack.tweak_u256(value)
-    return progress(next)
+    return stack_op_progress(last, 2, value)
 
 
 def op_sar(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
-    shift, value = next.contract.stack.pop_u256(), next.contract.stack.peek_u256()
+    shift, value = stack_ints(last, 2)
     if shift > 256:
         # 0 or negative -> clear the value
         if value == 0 or value >= (1 << 255):
-            value = uint256(0)
+            value = 0
         else:
             # max negative shift: all bits set
-            value = uint256((1 << 256)-1)
+            value = (1 << 256)-1
     else:
         # If the MSB is 0, SRsh is same as Rsh.
         if value >= (1 << 255):
@@ -302,8 +247,7 @@ def op_sar(trac: StepsTrace) -> Step:
             # TODO ugly Signed/Arithmetic right shift
             raise NotImplementedError
 
-    next.contract.stack.tweak_u256(value)
-    return progress(next)
+    return stack_op_progress(last, 2, value)
 
 
 def op_sha3(trac: StepsTrace) -> Step:
@@ -394,27 +338,10 @@ def op_call_data_copy(trac: StepsTrace) -> Step:
     if data_offset >= 2**64:  # overflow check, stays well under uint256 this way
         data_offset = 2**64 - 1
 
-    # optimization: if not aligned with 32-bytes, make it align
-    delta = 32 - (data_offset % 32)
-    # we may already be nearly done, length within 32 bytes
-    if delta > length:
-        delta = length
-
     if length > 0:
         # Different than other copy funcs:
         # copying from input data beyond actual range is allowed, it just results in zeroes.
-        # Complete the (maybe not aligned) last bit of actual input,
-        # then start on the padding work in next steps (if any)
-        if data_offset < len(last.contract.input) < data_offset+delta:
-            delta = len(last.contract.input) - data_offset
-
-        if data_offset >= len(last.contract.input):
-            data_copy = b"\x00" * delta
-        else:
-            data_copy = bytes(last.contract.input[data_offset:data_offset+delta])
-
-        # touches two words of memory if the memory offset is not aligned, but that's still manageable
-        next.contract.memory[mem_offset:mem_offset+delta] = data_copy
+        delta = next.contract.memory.copy_from(last.contract.input, mem_offset, data_offset, length)
         mem_offset += delta
         data_offset += delta
         length -= delta
@@ -461,16 +388,8 @@ def op_return_data_copy(trac: StepsTrace) -> Step:
         next.exec_mode = ExecMode.ErrReturnDataOutOfBounds
         return next
 
-    # optimization: if not aligned with 32-bytes, make it align
-    delta = 32 - (data_offset % 32)
-    # we may already be nearly done, length within 32 bytes
-    if delta > length:
-        delta = length
-
     if length > 0:
-        data_copy = bytes(last.contract.ret_data[data_offset:data_offset+delta])
-        # touches two words of memory if the memory offset is not aligned, but that's still manageable
-        next.contract.memory[mem_offset:mem_offset+delta] = data_copy
+        delta = next.contract.memory.copy_from(last.contract.ret_data, mem_offset, data_offset, length)
         mem_offset += delta
         data_offset += delta
         length -= delta
@@ -536,16 +455,9 @@ def op_code_copy(trac: StepsTrace) -> Step:
     if code_offset >= 2**64:  # overflow check, stays well under uint256 this way
         code_offset = 2**64 - 1
 
-    # optimization: if not aligned with 32-bytes, make it align
-    delta = 32 - (code_offset % 32)
-    # we may already be nearly done, length within 32 bytes
-    if delta > length:
-        delta = length
-
     if length > 0:
-        code_copy = bytes(last.contract.code[code_offset:code_offset+delta])
-        # touches two words of memory if the memory offset is not aligned, but that's still manageable
-        next.contract.memory[mem_offset:mem_offset+delta] = code_copy
+        # like calldata, code beyond the end is copied as zeroes
+        delta = next.contract.memory.copy_from(last.contract.code, mem_offset, code_offset, length)
         mem_offset += delta
         code_offset += delta
         length -= delta
@@ -744,7 +656,7 @@ def op_jump(trac: StepsTrace) -> Step:
     last = trac.last()
     next = last.copy()
     pos = next.contract.stack.pop_u256()
-    if not last.contract.code.valid_jump_dest(pos):
+    if not last.contract.valid_jump_dest(pos):
         next.exec_mode = ExecMode.ErrInvalidJump
         return next
     next.contract.pc = uint64(pos)
@@ -756,7 +668,7 @@ def op_jump_i(trac: StepsTrace) -> Step:
     next = last.copy()
     pos, cond = next.contract.stack.pop_u256(), next.contract.stack.pop_u256()
     if cond != uint256(0):
-        if not last.contract.code.valid_jump_dest(pos):
+        if not last.contract.valid_jump_dest(pos):
             next.exec_mode = ExecMode.ErrInvalidJump
             return next
         # perform jump
@@ -847,7 +759,7 @@ def op_create2(trac: StepsTrace) -> Step:
 
 def op_call(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
+    patch = last.patch()
 
     # TODO: geth uses interpreter.evm.callGasTemp here instead, modifying it during gas computation
     gas = last.contract.stack.back_u256(0)
@@ -859,16 +771,16 @@ def op_call(trac: StepsTrace) -> Step:
     return_size = last.contract.stack.back_u256(6)
 
     # pop it all at once
-    next.contract.stack.remove(7)
+    patch.stack_remove(7)
 
     if value != uint256(0):
         gas += CALL_STIPEND
 
-    caller = last.contract.addr
+    caller = last.contract.self_addr
 
     # completely reset the call work scope
     # (sub-tree, just a single node to merge into next state effectively)
-    next.call_work = CallWorkScope(
+    patch.set(CallWorkScope(
         mode=CallMode.START,
         caller=caller,
         code_addr=addr,
@@ -880,16 +792,16 @@ def op_call(trac: StepsTrace) -> Step:
         input_size=input_size,
         return_offset=return_offset,
         return_size=return_size,
-    )
-    next.exec_mode = ExecMode.CallSetup
+    ), 'call_work')
+    patch.set(ExecMode.CallSetup, 'exec_mode')
 
     # stack result push, return data memory copy and gas return is all part of call work
-    return next
+    return patch.apply()
 
 
 def op_call_code(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
+    patch = last.patch()
 
     # TODO: geth uses interpreter.evm.callGasTemp here instead, modifying it during gas computation
     gas = last.contract.stack.back_u256(0)
@@ -901,16 +813,16 @@ def op_call_code(trac: StepsTrace) -> Step:
     return_size = last.contract.stack.back_u256(6)
 
     # pop it all at once
-    next.contract.stack.remove(7)
+    patch.stack_remove(7)
 
     if value != uint256(0):
         gas += CALL_STIPEND
 
-    caller = last.contract.addr
+    caller = last.contract.self_addr
 
     # completely reset the call work scope
     # (sub-tree, just a single node to merge into next state effectively)
-    next.call_work = CallWorkScope(
+    patch.set(CallWorkScope(
         mode=CallMode.START,
         caller=caller,
         code_addr=addr,
@@ -922,16 +834,16 @@ def op_call_code(trac: StepsTrace) -> Step:
         input_size=input_size,
         return_offset=return_offset,
         return_size=return_size,
-    )
-    next.exec_mode = ExecMode.CallSetup
+    ), 'call_work')
+    patch.set(ExecMode.CallSetup, 'exec_mode')
 
     # stack result push, return data memory copy and gas return is all part of call work
-    return next
+    return patch.apply()
 
 
 def op_delegate_call(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
+    patch = last.patch()
 
     # TODO: geth uses interpreter.evm.callGasTemp here instead, modifying it during gas computation
     gas = last.contract.stack.back_u256(0)
@@ -943,7 +855,7 @@ def op_delegate_call(trac: StepsTrace) -> Step:
     return_size = last.contract.stack.back_u256(5)
 
     # pop it all at once
-    next.contract.stack.remove(6)
+    patch.stack_remove(6)
 
     # delegate the caller and value
     caller = last.contract.caller
@@ -951,28 +863,28 @@ def op_delegate_call(trac: StepsTrace) -> Step:
 
     # completely reset the call work scope
     # (sub-tree, just a single node to merge into next state effectively)
-    next.call_work = CallWorkScope(
+    patch.set(CallWorkScope(
         mode=CallMode.START,
         caller=caller,
         code_addr=addr,
         read_only=last.contract.read_only,  # inherit readonly mode
         gas=gas,
-        addr=last.contract.addr,  # like CODE-CALL, the new self-address is the current address
+        addr=last.contract.self_addr,  # like CODE-CALL, the new self-address is the current address
         value=value,
         input_offset=input_offset,
         input_size=input_size,
         return_offset=return_offset,
         return_size=return_size,
-    )
-    next.exec_mode = ExecMode.CallSetup
+    ), 'call_work')
+    patch.set(ExecMode.CallSetup, 'exec_mode')
 
     # stack result push, return data memory copy and gas return is all part of call work
-    return next
+    return patch.apply()
 
 
 def op_static_call(trac: StepsTrace) -> Step:
     last = trac.last()
-    next = last.copy()
+    patch = last.patch()
 
     # TODO: geth uses interpreter.evm.callGasTemp here instead, modifying it during gas computation
     gas = last.contract.stack.back_u256(0)
@@ -984,13 +896,13 @@ def op_static_call(trac: StepsTrace) -> Step:
     return_size = last.contract.stack.back_u256(5)
 
     # pop it all at once
-    next.contract.stack.remove(6)
+    patch.stack_remove(6)
 
-    caller = last.contract.addr
+    caller = last.contract.self_addr
 
     # completely reset the call work scope
     # (sub-tree, just a single node to merge into next state effectively)
-    next.call_work = CallWorkScope(
+    patch.set(CallWorkScope(
         mode=CallMode.START,
         caller=caller,
         code_addr=addr,
@@ -1002,11 +914,11 @@ def op_static_call(trac: StepsTrace) -> Step:
         input_size=input_size,
         return_offset=return_offset,
         return_size=return_size,
-    )
-    next.exec_mode = ExecMode.CallSetup
+    ), 'call_work')
+    patch.set(ExecMode.CallSetup, 'exec_mode')
 
     # stack result push, return data memory copy and gas return is all part of call work
-    return next
+    return patch.apply()
 
 
 def op_return(trac: StepsTrace) -> Step:
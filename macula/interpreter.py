@@ -1,7 +1,8 @@
+from typing import Callable, Tuple
 from .trace import StepsTrace
 from .step import *
 from .exec_mode import *
-from .jump_table import Operation, FRONTIER
+from .jump_table import Operation
 from .call_work import call_work_proc
 from .create_work import create_work_setup_proc, create_work_post_proc, create_work_revert_proc, create_work_err_proc
 from .state_work import state_work_proc
@@ -19,105 +20,39 @@ def rules(block_num: uint64) -> Rules:
     raise NotImplementedError
 
 
-def operation_info(op: int, block_num: uint64) -> Operation:
-    opcode = OpCode(op)
-    # TODO: select opcode jump table based on block number, to support hard-forking
-    return FRONTIER[opcode]
-
-
-def next_step(trac: StepsTrace) -> Step:
+def operation_info(trac: StepsTrace) -> Operation:
+    # The opcode of the current step is cached in the contract scope by exec_opcode_load
     last = trac.last()
-    mode = ExecMode(last.exec_mode)
-
-    if mode == ExecMode.BlockPre:
-        return exec_pre_block(trac)
-
-    if mode == ExecMode.TxLoad:
-        return exec_tx_load(trac)
-    if mode == ExecMode.TxProc:
-        return tx_work_proc(trac)
-    if mode == ExecMode.TxFeesPre:  # TODO validate fee stuff
-        raise NotImplementedError
-    if mode == ExecMode.TxFeesPost:  # TODO: charge tx fees
-        raise NotImplementedError
-
-    if mode == ExecMode.CallSetup:
-        return call_work_proc(trac)
-    if mode == ExecMode.CallPre:
-        return exec_call_pre(trac)
-    if mode == ExecMode.CallPost:
-        return exec_call_post(trac)
-    if mode == ExecMode.CallRevert:
-        return exec_call_revert(trac)
-    if ExecMode.ErrSTOP <= mode <= ExecMode.ErrInsufficientBalance:
-        return exec_call_error(trac)
-
-    if mode == ExecMode.CreateSetup:
-        return create_work_setup_proc(trac)
-    if mode == ExecMode.CreateInitPost:
-        return create_work_post_proc(trac)
-    if mode == ExecMode.CreateInitRevert:
-        return create_work_revert_proc(trac)
-    if mode == ExecMode.CreateInitErr:
-        return create_work_err_proc(trac)
-
-    # Interpreter loop consists of stack/memory/gas checks, and then opcode execution.
-    if mode == ExecMode.OpcodeLoad:
-        return exec_opcode_load(trac)
-    if mode == ExecMode.ValidateStack:
-        return exec_validate_stack(trac)
-    if mode == ExecMode.ReadOnlyCheck:
-        return exec_read_only_check(trac)
-    if mode == ExecMode.ConstantGas:
-        return exec_constant_gas(trac)
-    if mode == ExecMode.CalcMemorySize:
-        return exec_calc_memory_size(trac)
-    if mode == ExecMode.DynamicGas:
-        return exec_dynamic_gas(trac)
-    if mode == ExecMode.UpdateMemorySize:
-        return exec_update_memory_size(trac)
-    if mode == ExecMode.OpcodeRun:
-        return exec_opcode_run(trac)
-
-    # TODO: if the block is invalid, then exit with generic FAIL? or DONE with error indication?
-    if ExecMode.ErrInvalidTransactionType <= mode <= ExecMode.ErrInvalidTransactionPubkey:
-        raise Exception("invalid block")
-
-    if mode == ExecMode.StateWork:
-        return state_work_proc(trac)
-    if mode == ExecMode.MPTWork:
-        return mpt_work_proc(trac)
+    operation = trac.jump_table(last.block.block_number)[last.contract.op]
+    if operation is None:
+        raise Exception("opcode 0x%02x is not supported at block %d" % (last.contract.op, last.block.block_number))
+    return operation
 
-    if mode == ExecMode.BlockPreStateLoad:
-        return exec_block_pre_state_load(trac)
-    if mode == ExecMode.BlockHistoryLoad:
-        return exec_block_history_load(trac)
-    if mode == ExecMode.BlockCalcBaseFee:
-        return exec_block_calc_base_fee(trac)
-    if mode == ExecMode.BlockTxLoop:
-        return exec_block_tx_loop(trac)
-    if mode == ExecMode.BlockPost:
-        return exec_post_block(trac)
 
-    raise ExecMode("unrecognized execution mode: %d" % mode)
+def next_step(trac: StepsTrace) -> Step:
+    # One lookup by the raw exec mode byte, see EXEC_MODE_PROCS at the end of this module.
+    return EXEC_MODE_PROCS[trac.last().exec_mode](trac)
 
 
 def exec_call_pre(trac: StepsTrace) -> Step:
     # Call pre-processing
     last = trac.last()
-    next = last.copy()
+    patch = last.patch()
 
     # increment call depth
     call_depth = last.contract.call_depth
-    next.contract.call_depth = call_depth + 1
+    patch.set(call_depth + 1, 'contract', 'call_depth')
     # reset return data, stack, memory, PC, and more
     # The caller must set the input-data and code.
-    next.contract.ret_data = ReturnData()
-    next.contract.stack = Stack()
-    next.contract.memory = Memory()
-    next.contract.pc = 0
-    next.exec_mode = ExecMode.OpcodeLoad
-    return next
+    patch.set(ReturnData(), 'contract', 'ret_data')
+    patch.set(Stack(), 'contract', 'stack')
+    patch.set(Memory(), 'contract', 'memory')
+    patch.set(0, 'contract', 'pc')
+    # JUMPDEST analysis is shared by all calls of the same code
+    patch.set(CODE_ANALYSIS.jump_dests(last.contract.code), 'contract', 'jump_dests')
+    patch.set(ExecMode.OpcodeLoad, 'exec_mode')
+    # all fields in one pass, the shared contract scope path is rebuilt once
+    return patch.apply()
 
 
 def exec_call_post(trac: StepsTrace) -> Step:
@@ -201,7 +136,7 @@ def exec_validate_stack(trac: StepsTrace) -> Step:
     last = trac.last()
     next = last.copy()
     stack_len = len(last.contract.stack)
-    operation = operation_info(last.contract.op, last.block.block_number)
+    operation = operation_info(trac)
     # ensure there are enough stack items available to perform the operation
     if stack_len < operation.min_stack:
         next.exec_mode = ExecMode.ErrStackUnderflow
@@ -225,7 +160,7 @@ def exec_read_only_check(trac: StepsTrace) -> Step:
     # return with an error.
     if last.contract.read_only:
         op = last.contract.op
-        operation = operation_info(last.contract.op, last.block.block_number)
+        operation = operation_info(trac)
         if operation.writes:
             next.exec_mode = ExecMode.ErrWriteProtection
             return next
@@ -242,7 +177,7 @@ def exec_read_only_check(trac: StepsTrace) -> Step:
 def exec_constant_gas(trac: StepsTrace) -> Step:
     last = trac.last()
     next = last.copy()
-    operation = operation_info(last.contract.op, last.block.block_number)
+    operation = operation_info(trac)
     # Static portion of gas
     if not next.contract.use_gas(operation.constant_gas):
         next.exec_mode = ExecMode.ErrOutOfGas
@@ -255,7 +190,7 @@ def exec_constant_gas(trac: StepsTrace) -> Step:
 def exec_calc_memory_size(trac: StepsTrace) -> Step:
     last = trac.last()
     next = last.copy()
-    operation = operation_info(last.contract.op, last.block.block_number)
+    operation = operation_info(trac)
     memory_size = 0
     # calculate the new memory size and expand the memory to fit
     # the operation
@@ -279,7 +214,7 @@ def exec_calc_memory_size(trac: StepsTrace) -> Step:
 
 def exec_dynamic_gas(trac: StepsTrace) -> Step:
     last = trac.last()
-    operation = operation_info(last.contract.op, last.block.block_number)
+    operation = operation_info(trac)
     if operation.dynamic_gas is not None:
         # Dynamic gas is complex, it steals the step to deal with it,
         # and optionally require more steps before interpreter continuation
@@ -299,13 +234,11 @@ def exec_update_memory_size(trac: StepsTrace) -> Step:
         # no extension to do
         next.exec_mode = ExecMode.OpcodeRun
         return next
-    # If we can efficiently add 32 bytes of memory, go for it.
+    # If the memory is aligned, graft in the largest aligned zero subtree that fits, up to the desired size.
     # Otherwise just align by adding a byte, or finishing trailing non-aligning bytes.
-    if (memory_size-m_length >= 32) and (m_length % 32 == 0):
-        memory_size += 32
-        next.contract.memory.append_zero_32_bytes()
+    if m_length % 32 == 0:
+        next.contract.memory.expand_zero(memory_size)
     else:
-        memory_size += 1
         next.contract.memory.append(uint8(0))
 
     # check if we can exit the memory extension step repeat already
@@ -322,7 +255,7 @@ def exec_update_memory_size(trac: StepsTrace) -> Step:
 def exec_opcode_run(trac: StepsTrace) -> Step:
     # when done running, continue with ExecOpcodeLoad. Or any error
     last = trac.last()
-    operation = operation_info(last.contract.op, last.block.block_number)
+    operation = operation_info(trac)
     return operation.proc(trac)
 
 
@@ -330,3 +263,72 @@ def to_word_size(size: uint64) -> uint64:
     if size > (((1 << 64) - 1) - 31):
         return (((1 << 64) - 1) // 32) + 1
     return (size + 31) // 32
+
+
+def exec_tx_fees_pre(trac: StepsTrace) -> Step:
+    # TODO validate fee stuff
+    raise NotImplementedError
+
+
+def exec_tx_fees_post(trac: StepsTrace) -> Step:
+    # TODO: charge tx fees
+    raise NotImplementedError
+
+
+def exec_invalid_block(trac: StepsTrace) -> Step:
+    # TODO: if the block is invalid, then exit with generic FAIL? or DONE with error indication?
+    raise Exception("invalid block")
+
+
+def exec_unrecognized(trac: StepsTrace) -> Step:
+    raise Exception("unrecognized execution mode: %d" % trac.last().exec_mode)
+
+
+def build_exec_mode_procs() -> Tuple[Callable[[StepsTrace], Step], ...]:
+    procs = [exec_unrecognized] * 256
+
+    procs[ExecMode.BlockPre] = exec_pre_block
+
+    procs[ExecMode.TxLoad] = exec_tx_load
+    procs[ExecMode.TxProc] = tx_work_proc
+    procs[ExecMode.TxFeesPre] = exec_tx_fees_pre
+    procs[ExecMode.TxFeesPost] = exec_tx_fees_post
+
+    procs[ExecMode.CallSetup] = call_work_proc
+    procs[ExecMode.CallPre] = exec_call_pre
+    procs[ExecMode.CallPost] = exec_call_post
+    procs[ExecMode.CallRevert] = exec_call_revert
+    for mode in range(ExecMode.ErrSTOP, ExecMode.ErrInsufficientBalance + 1):
+        procs[mode] = exec_call_error
+
+    procs[ExecMode.CreateSetup] = create_work_setup_proc
+    procs[ExecMode.CreateInitPost] = create_work_post_proc
+    procs[ExecMode.CreateInitRevert] = create_work_revert_proc
+    procs[ExecMode.CreateInitErr] = create_work_err_proc
+
+    # Interpreter loop consists of stack/memory/gas checks, and then opcode execution.
+    procs[ExecMode.OpcodeLoad] = exec_opcode_load
+    procs[ExecMode.ValidateStack] = exec_validate_stack
+    procs[ExecMode.ReadOnlyCheck] = exec_read_only_check
+    procs[ExecMode.ConstantGas] = exec_constant_gas
+    procs[ExecMode.CalcMemorySize] = exec_calc_memory_size
+    procs[ExecMode.DynamicGas] = exec_dynamic_gas
+    procs[ExecMode.UpdateMemorySize] = exec_update_memory_size
+    procs[ExecMode.OpcodeRun] = exec_opcode_run
+
+    for mode in range(ExecMode.ErrInvalidTransactionType, ExecMode.ErrInvalidTransactionPubkey + 1):
+        procs[mode] = exec_invalid_block
+
+    procs[ExecMode.StateWork] = state_work_proc
+    procs[ExecMode.MPTWork] = mpt_work_proc
+
+    procs[ExecMode.BlockPreStateLoad] = exec_block_pre_state_load
+    procs[ExecMode.BlockHistoryLoad] = exec_block_history_load
+    procs[ExecMode.BlockCalcBaseFee] = exec_block_calc_base_fee
+    procs[ExecMode.BlockTxLoop] = exec_block_tx_loop
+    procs[ExecMode.BlockPost] = exec_post_block
+    return tuple(procs)
+
+
+# Step processor for each exec mode byte. Unknown modes raise.
+EXEC_MODE_PROCS = build_exec_mode_procs()
@@ -1,5 +1,6 @@
-from typing import Optional, Callable, Tuple
+from typing import Dict, Optional, Callable, Tuple
 from .instructions import *
+from .eips import op_chain_id, op_base_fee, op_self_balance
 from .stack_table import *
 from .gas import *
 from .gas_table import *
@@ -23,6 +24,8 @@ class Operation(object):
     max_stack: uint64
     # stack -> size, overflow flag
     memory_size: Optional[MemorySizeFunc]
+    # modifies the state, not allowed in a static call
+    writes: bool
 
     def __init__(self,
                  proc: Processor,
@@ -30,13 +33,15 @@ class Operation(object):
                  dynamic_gas=None,
                  min_stack=0,
                  max_stack=0,
-                 memory_size=None):
+                 memory_size=None,
+                 writes=False):
         self.proc = proc
         self.constant_gas = uint64(constant_gas)
         self.dynamic_gas = dynamic_gas
         self.min_stack = uint64(min_stack)
         self.max_stack = uint64(max_stack)
         self.memory_size = memory_size
+        self.writes = writes
 
 
 FRONTIER = {
@@ -348,7 +353,7 @@ FRONTIER = {
         dynamic_gas=gas_sstore,
         min_stack=min_stack(2, 0),
         max_stack=max_stack(2, 0),
-        # writes=true,
+        writes=True,
     ),
     OpCode.JUMP: Operation(
         proc=op_jump,
@@ -778,7 +783,7 @@ FRONTIER = {
         min_stack=min_stack(2, 0),
         max_stack=max_stack(2, 0),
         memory_size=memory_log,
-        # writes=true,
+        writes=True,
     ),
     OpCode.LOG1: Operation(
         proc=make_log(1),
@@ -786,7 +791,7 @@ FRONTIER = {
         min_stack=min_stack(3, 0),
         max_stack=max_stack(3, 0),
         memory_size=memory_log,
-        # writes=true,
+        writes=True,
     ),
     OpCode.LOG2: Operation(
         proc=make_log(2),
@@ -794,7 +799,7 @@ FRONTIER = {
         min_stack=min_stack(4, 0),
         max_stack=max_stack(4, 0),
         memory_size=memory_log,
-        # writes=true,
+        writes=True,
     ),
     OpCode.LOG3: Operation(
         proc=make_log(3),
@@ -802,7 +807,7 @@ FRONTIER = {
         min_stack=min_stack(5, 0),
         max_stack=max_stack(5, 0),
         memory_size=memory_log,
-        # writes=true,
+        writes=True,
     ),
     OpCode.LOG4: Operation(
         proc=make_log(4),
@@ -810,7 +815,7 @@ FRONTIER = {
         min_stack=min_stack(6, 0),
         max_stack=max_stack(6, 0),
         memory_size=memory_log,
-        # writes=true,
+        writes=True,
     ),
     OpCode.CREATE: Operation(
         proc=op_create,
@@ -819,7 +824,7 @@ FRONTIER = {
         min_stack=min_stack(3, 1),
         max_stack=max_stack(3, 1),
         memory_size=memory_create,
-        # writes=true,
+        writes=True,
         # returns=true,
     ),
     OpCode.CALL: Operation(
@@ -854,7 +859,7 @@ FRONTIER = {
         min_stack=min_stack(1, 0),
         max_stack=max_stack(1, 0),
         # halts=true,
-        # writes=true,
+        writes=True,
     )
 }
 
@@ -871,37 +876,267 @@ HOMESTEAD = {
     )
 }
 
+# EIP-150: gas repricing of IO-heavy operations
 TANGERINE_WHISTLE = {
     **HOMESTEAD,
-    # TODO
+    OpCode.BALANCE: Operation(
+        proc=op_balance,
+        constant_gas=BALANCE_GAS_EIP150,
+        min_stack=min_stack(1, 1),
+        max_stack=max_stack(1, 1),
+    ),
+    OpCode.EXTCODESIZE: Operation(
+        proc=op_ext_code_size,
+        constant_gas=EXTCODE_SIZE_GAS_EIP150,
+        min_stack=min_stack(1, 1),
+        max_stack=max_stack(1, 1),
+    ),
+    OpCode.EXTCODECOPY: Operation(
+        proc=op_ext_code_copy,
+        constant_gas=EXTCODE_COPY_BASE_EIP150,
+        dynamic_gas=gas_ext_code_copy,
+        min_stack=min_stack(4, 0),
+        max_stack=max_stack(4, 0),
+        memory_size=memory_ext_code_copy,
+    ),
+    OpCode.SLOAD: Operation(
+        proc=op_sload,
+        constant_gas=SLOAD_GAS_EIP150,
+        min_stack=min_stack(1, 1),
+        max_stack=max_stack(1, 1),
+    ),
+    OpCode.CALL: Operation(
+        proc=op_call,
+        constant_gas=CALL_GAS_EIP150,
+        dynamic_gas=gas_call,
+        min_stack=min_stack(7, 1),
+        max_stack=max_stack(7, 1),
+        memory_size=memory_call,
+        # returns=true,
+    ),
+    OpCode.CALLCODE: Operation(
+        proc=op_call_code,
+        constant_gas=CALL_GAS_EIP150,
+        dynamic_gas=gas_call_code,
+        min_stack=min_stack(7, 1),
+        max_stack=max_stack(7, 1),
+        memory_size=memory_call,
+        # returns=true,
+    ),
+    OpCode.DELEGATECALL: Operation(
+        proc=op_delegate_call,
+        constant_gas=CALL_GAS_EIP150,
+        dynamic_gas=gas_delegate_call,
+        min_stack=min_stack(6, 1),
+        max_stack=max_stack(6, 1),
+        memory_size=memory_delegate_call,
+        # returns=true,
+    ),
+    OpCode.SELFDESTRUCT: Operation(
+        proc=op_self_destruct,
+        constant_gas=SELFDESTRUCT_GAS_EIP150,
+        dynamic_gas=gas_self_destruct,
+        min_stack=min_stack(1, 0),
+        max_stack=max_stack(1, 0),
+        # halts=true,
+        writes=True,
+    ),
 }
 
+# EIP-160: EXP cost increase
 SPURIOUS_DRAGON = {
     **TANGERINE_WHISTLE,
-    # TODO
+    OpCode.EXP: Operation(
+        proc=op_exp,
+        dynamic_gas=gas_exp_eip158,
+        min_stack=min_stack(2, 1),
+        max_stack=max_stack(2, 1),
+    ),
 }
 
 BYZANTIUM = {
     **SPURIOUS_DRAGON,
-    # TODO
+    OpCode.STATICCALL: Operation(
+        proc=op_static_call,
+        constant_gas=CALL_GAS_EIP150,
+        dynamic_gas=gas_static_call,
+        min_stack=min_stack(6, 1),
+        max_stack=max_stack(6, 1),
+        memory_size=memory_static_call,
+        # returns=true,
+    ),
+    OpCode.RETURNDATASIZE: Operation(
+        proc=op_return_data_size,
+        constant_gas=GAS_QUICK_STEP,
+        min_stack=min_stack(0, 1),
+        max_stack=max_stack(0, 1),
+    ),
+    OpCode.RETURNDATACOPY: Operation(
+        proc=op_return_data_copy,
+        constant_gas=GAS_FASTEST_STEP,
+        dynamic_gas=gas_return_data_copy,
+        min_stack=min_stack(3, 0),
+        max_stack=max_stack(3, 0),
+        memory_size=memory_return_data_copy,
+    ),
+    OpCode.REVERT: Operation(
+        proc=op_revert,
+        dynamic_gas=gas_revert,
+        min_stack=min_stack(2, 0),
+        max_stack=max_stack(2, 0),
+        memory_size=memory_revert,
+        # reverts=true,
+        # returns=true,
+    ),
 }
 
 CONSTANTINOPLE = {
     **BYZANTIUM,
-    # TODO
+    OpCode.SHL: Operation(
+        proc=op_shl,
+        constant_gas=GAS_FASTEST_STEP,
+        min_stack=min_stack(2, 1),
+        max_stack=max_stack(2, 1),
+    ),
+    OpCode.SHR: Operation(
+        proc=op_shr,
+        constant_gas=GAS_FASTEST_STEP,
+        min_stack=min_stack(2, 1),
+        max_stack=max_stack(2, 1),
+    ),
+    OpCode.SAR: Operation(
+        proc=op_sar,
+        constant_gas=GAS_FASTEST_STEP,
+        min_stack=min_stack(2, 1),
+        max_stack=max_stack(2, 1),
+    ),
+    OpCode.EXTCODEHASH: Operation(
+        proc=op_ext_code_hash,
+        constant_gas=EXTCODE_HASH_GAS_CONSTANTINOPLE,
+        min_stack=min_stack(1, 1),
+        max_stack=max_stack(1, 1),
+    ),
+    OpCode.CREATE2: Operation(
+        proc=op_create2,
+        constant_gas=CREATE2GAS,
+        dynamic_gas=gas_create2,
+        min_stack=min_stack(4, 1),
+        max_stack=max_stack(4, 1),
+        memory_size=memory_create2,
+        writes=True,
+        # returns=true,
+    ),
 }
 
+# EIP-1344 (CHAINID), EIP-1884 (repricing, SELFBALANCE), EIP-2200 (SSTORE gas)
 ISTANBUL = {
     **CONSTANTINOPLE,
-    # TODO
+    OpCode.CHAINID: Operation(
+        proc=op_chain_id,
+        constant_gas=GAS_QUICK_STEP,
+        min_stack=min_stack(0, 1),
+        max_stack=max_stack(0, 1),
+    ),
+    OpCode.SELFBALANCE: Operation(
+        proc=op_self_balance,
+        constant_gas=GAS_FAST_STEP,
+        min_stack=min_stack(0, 1),
+        max_stack=max_stack(0, 1),
+    ),
+    OpCode.BALANCE: Operation(
+        proc=op_balance,
+        constant_gas=BALANCE_GAS_EIP1884,
+        min_stack=min_stack(1, 1),
+        max_stack=max_stack(1, 1),
+    ),
+    OpCode.EXTCODEHASH: Operation(
+        proc=op_ext_code_hash,
+        constant_gas=EXTCODE_HASH_GAS_EIP1884,
+        min_stack=min_stack(1, 1),
+        max_stack=max_stack(1, 1),
+    ),
+    OpCode.SLOAD: Operation(
+        proc=op_sload,
+        constant_gas=SLOAD_GAS_EIP1884,
+        min_stack=min_stack(1, 1),
+        max_stack=max_stack(1, 1),
+    ),
+    OpCode.SSTORE: Operation(
+        proc=op_sstore,
+        dynamic_gas=gas_sstore_eip2200,
+        min_stack=min_stack(2, 0),
+        max_stack=max_stack(2, 0),
+        writes=True,
+    ),
 }
 
 BERLIN = {
     **ISTANBUL,
-    # TODO
+    # TODO: EIP-2929 access lists, for warm/cold gas costs
 }
 
+# EIP-3198: BASEFEE
 LONDON = {
     **BERLIN,
-    # TODO
+    OpCode.BASEFEE: Operation(
+        proc=op_base_fee,
+        constant_gas=GAS_QUICK_STEP,
+        min_stack=min_stack(0, 1),
+        max_stack=max_stack(0, 1),
+    ),
+    # TODO: EIP-3529 refunds
 }
+
+
+# Operation by opcode byte, None for undefined opcodes.
+JumpTable = Tuple[Optional[Operation], ...]
+
+
+def to_jump_table(ops: Dict[OpCode, Operation]) -> JumpTable:
+    return tuple(ops.get(op) for op in range(256))
+
+
+FRONTIER_TABLE = to_jump_table(FRONTIER)
+HOMESTEAD_TABLE = to_jump_table(HOMESTEAD)
+TANGERINE_WHISTLE_TABLE = to_jump_table(TANGERINE_WHISTLE)
+SPURIOUS_DRAGON_TABLE = to_jump_table(SPURIOUS_DRAGON)
+BYZANTIUM_TABLE = to_jump_table(BYZANTIUM)
+CONSTANTINOPLE_TABLE = to_jump_table(CONSTANTINOPLE)
+ISTANBUL_TABLE = to_jump_table(ISTANBUL)
+BERLIN_TABLE = to_jump_table(BERLIN)
+LONDON_TABLE = to_jump_table(LONDON)
+
+# latest fork first
+FORK_TABLES = (
+    (LONDON_BLOCK, LONDON_TABLE),
+    (BERLIN_BLOCK, BERLIN_TABLE),
+    (ISTANBUL_BLOCK, ISTANBUL_TABLE),
+    (CONSTANTINOPLE_BLOCK, CONSTANTINOPLE_TABLE),
+    (BYZANTIUM_BLOCK, BYZANTIUM_TABLE),
+    (SPURIOUS_DRAGON_BLOCK, SPURIOUS_DRAGON_TABLE),
+    (TANGERINE_WHISTLE_BLOCK, TANGERINE_WHISTLE_TABLE),
+    (HOMESTEAD_BLOCK, HOMESTEAD_TABLE),
+)
+
+
+def select_jump_table(block_number: int) -> JumpTable:
+    for fork_block, table in FORK_TABLES:
+        if block_number >= fork_block:
+            return table
+    return FRONTIER_TABLE
+
+
+# Remembers the jump table of the last block, so a trace selects it only once per block.
+class JumpTableCache(object):
+    block_number: Optional[int]
+    table: Optional[JumpTable]
+
+    def __init__(self):
+        self.block_number = None
+        self.table = None
+
+    def get(self, block_number: int) -> JumpTable:
+        if self.block_number != block_number:
+            self.table = select_jump_table(block_number)
+            self.block_number = block_number
+        return self.table
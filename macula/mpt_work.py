@@ -4,8 +4,27 @@ from enum import IntEnum
 from . import keccak_256
 
 
-# Doesn't decode recursively. Returns a list of element bytes (including their RLP length-prefix etc.)
-def rlp_decode_node(data: bytes) -> list:
+# Size of the header (the prefix, including any length of the length) and of the payload,
+# of the RLP item at the given offset. Works on bytes and memoryviews alike, without copying.
+def rlp_item_header(data: PyUnion[bytes, memoryview], pos: int) -> Tuple[int, int]:
+    first_byte = data[pos]
+    if first_byte <= 0x7f:
+        return 0, 1
+    elif first_byte <= 0xb7:
+        return 1, first_byte - 0x80
+    elif first_byte <= 0xbf:
+        length_of_length = first_byte - 0xb7
+        return 1 + length_of_length, int.from_bytes(data[pos+1:pos+1+length_of_length], byteorder='big')
+    elif first_byte <= 0xf7:
+        return 1, first_byte - 0xc0
+    else:
+        length_of_length = first_byte - 0xf7
+        return 1 + length_of_length, int.from_bytes(data[pos+1:pos+1+length_of_length], byteorder='big')
+
+
+# Doesn't decode recursively. Returns the (offset, size) of every element in the list,
+# including their RLP length-prefix etc. Only offsets are computed, no element is copied.
+def rlp_decode_node_offsets(data: PyUnion[bytes, memoryview]) -> PyList[Tuple[int, int]]:
     if len(data) == 0:  # empty byte strings are used to represent none-existent nodes
         return []
     # generator/verifier just reverts with error if the MPT node data is malformatted
@@ -13,42 +32,30 @@ def rlp_decode_node(data: bytes) -> list:
     if first_byte < 0xc0:
         # not decoding the bytestring here
         raise Exception("invalid first byte in RLP data: %d" % first_byte)
-    data = data[1:]  # strip first byte
-    list_length: int  # byte size of total RLP payload, i.e. everything except the prefix length
-    if first_byte <= 0xf7:
-        list_length = first_byte - 0xc0
-    else:
-        length_of_length = first_byte - 0xf7
-        if len(data) < length_of_length:
-            raise Exception("not enough bytes for list length")
-        list_length = int.from_bytes(data[:length_of_length], byteorder='big')
-        data = data[length_of_length:]
-
-    if list_length != len(data):
+    header_size, list_length = rlp_item_header(data, 0)
+    if len(data) < header_size:
+        raise Exception("not enough bytes for list length")
+    # list_length: byte size of total RLP payload, i.e. everything except the prefix length
+    end = len(data)
+    if list_length != end - header_size:
         raise Exception("unexpected list length")
 
     out = []
-    while len(data) > 0:
-        elem_first_byte = data[0]
-        size: int
+    pos = header_size
+    while pos < end:
+        elem_first_byte = data[pos]
+        # the common cases inline: single bytes, short strings (e.g. hashes) and short lists (embedded nodes)
         if elem_first_byte <= 0x7f:
             size = 1
         elif elem_first_byte <= 0xb7:
-            elem_str_length = elem_first_byte - 0x80
-            size = 1+elem_str_length
-        elif elem_first_byte <= 0xbf:
-            elem_length_of_length = elem_first_byte - 0xb7
-            elem_str_length = int.from_bytes(data[1:1+elem_length_of_length], byteorder='big')
-            size = 1+elem_length_of_length+elem_str_length
-        elif elem_first_byte <= 0xf7:
-            list_payload_length = elem_first_byte - 0xc0
-            size = 1 + list_payload_length
+            size = elem_first_byte - 0x7f
+        elif 0xc0 <= elem_first_byte <= 0xf7:
+            size = elem_first_byte - 0xbf
         else:
-            elem_length_of_length = elem_first_byte - 0xf7
-            list_payload_length = int.from_bytes(data[1:1+elem_length_of_length], byteorder='big')
-            size = 1+elem_length_of_length+list_payload_length
-        out.append(data[:size])
-        data = data[size:]
+            elem_header_size, elem_payload_size = rlp_item_header(data, pos)
+            size = elem_header_size + elem_payload_size
+        out.append((pos, size))
+        pos += size
 
     if len(out) != 2 and len(out) != 17:
         raise Exception("unexpected amount of elements in list RLP")
@@ -56,20 +63,44 @@ def rlp_decode_node(data: bytes) -> list:
     return out
 
 
-# Strip the length prefix of a RLP string (leaves the bare string) or list (leaves the concatenated RLP payloads).
-def rlp_strip_length_prefix(data: bytes) -> bytes:
-    elem_first_byte = data[0]
+# Doesn't decode recursively. Returns a list of element bytes (including their RLP length-prefix etc.)
+# Every element is copied once, instead of copying the remainder of the node for every element.
+def rlp_decode_node(data: bytes) -> list:
+    return [data[offset:offset+size] for offset, size in rlp_decode_node_offsets(data)]
+
+
+# Decoded MPT nodes by node hash. Branch nodes near the root are decoded by nearly every MPT step.
+class RLPNodeCache(object):
     size: int
-    if elem_first_byte <= 0xb7:
-        return data[1:]
-    elif elem_first_byte <= 0xbf:
-        elem_length_of_length = elem_first_byte - 0xb7
-        return data[1+elem_length_of_length:]
-    elif elem_first_byte <= 0xf7:
+    entries: Dict[bytes, Tuple[bytes, ...]]
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+
+    # The data must be checked against the hash already. Returns a new list, callers may modify it.
+    def decode(self, key: bytes, data: bytes) -> list:
+        items = self.entries.get(key)
+        if items is not None:
+            self.entries.move_to_end(key)
+            return list(items)
+        items = tuple(rlp_decode_node(data))
+        self.entries[key] = items
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return list(items)
+
+
+RLP_NODES = RLPNodeCache(4096)
+
+
+# Strip the length prefix of a RLP string (leaves the bare string) or list (leaves the concatenated RLP payloads).
+# Slices bytes or a memoryview alike, a memoryview is not copied.
+def rlp_strip_length_prefix(data: PyUnion[bytes, memoryview]) -> PyUnion[bytes, memoryview]:
+    if data[0] <= 0x7f:
         return data[1:]
-    else:
-        elem_length_of_length = elem_first_byte - 0xb7
-        return data[1+elem_length_of_length:]
+    header_size, _ = rlp_item_header(data, 0)
+    return data[header_size:]
 
 
 def int_byte_length(l: int) -> int:
@@ -95,16 +126,17 @@ def rlp_add_str_length_prefix(data: bytes) -> bytes:
 
 
 # takes a list of RLP-encoded elements, concatenates them, and adds the appropriate list-prefix
+# The elements may be bytes or memoryviews (e.g. of a decoded node), they are copied just once.
 def rlp_encode_node(items: list) -> bytes:
     if len(items) == 0:
         return b""
-    data = b''.join(items)
-    if len(data) <= 55:
-        return (0xc0 + len(data)).to_bytes(length=1, byteorder='big') + data
+    l = sum(len(item) for item in items)
+    if l <= 55:
+        prefix = (0xc0 + l).to_bytes(length=1, byteorder='big')
     else:
-        l = len(data)
         ll = int_byte_length(l)  # figure out byte length of the length
-        return (0xbf + ll).to_bytes(length=1, byteorder='big') + l.to_bytes(length=ll, byteorder='big') + data
+        prefix = (0xf7 + ll).to_bytes(length=1, byteorder='big') + l.to_bytes(length=ll, byteorder='big')
+    return b''.join([prefix] + items)
 
 
 class MPTTreeSource(IntEnum):
@@ -242,6 +274,128 @@ def rlp_if_bytes32(v: bytes) -> bytes:
 
 
 def mpt_step_with_trie(last: Step, trie: MPT) -> Step:
+    next = mpt_cached_node_step(last, trie)
+
+    # Pure reads may descend through several trie levels at once, see MPTWorkScope.nodes_per_step.
+    # Every node is still looked up by hash, and checked against it, so each is part of the witness of this step.
+    # Reads that prepare a write or deletion go one node per step: unwinding needs the step of every node.
+    budget = int(last.mpt_work.nodes_per_step)
+    if budget <= 1 or last.mpt_work.mode != MPTAccessMode.READING \
+            or last.mpt_work.mode_on_finish in (MPTAccessMode.READY_WRITE, MPTAccessMode.READY_DELETE):
+        return next
+    nodes = 1
+    while nodes < budget and next.mpt_work.mode == MPTAccessMode.READING:
+        next = mpt_cached_node_step(next, trie)
+        nodes += 1
+    # The intermediate steps are not part of the trace, the parent is the step we started from.
+    next.mpt_work.parent_node_step.change(selector=1, value=last)
+    return next
+
+
+# The outcome of a read step on a trie node: the nodes that were looked up, and the resulting MPT work fields.
+class MPTReadLevel(object):
+    __slots__ = ('accessed', 'mode', 'current_root', 'lookup_nibble_depth', 'value', 'fail_lookup')
+
+    accessed: Tuple[bytes, ...]
+    mode: int
+    current_root: bytes
+    lookup_nibble_depth: int
+    value: bytes
+    fail_lookup: int
+
+    def __init__(self, accessed: Tuple[bytes, ...], work: MPTWorkScope):
+        self.accessed = accessed
+        self.mode = int(work.mode)
+        self.current_root = bytes(work.current_root)
+        self.lookup_nibble_depth = int(work.lookup_nibble_depth)
+        self.value = bytes(work.value)
+        self.fail_lookup = int(work.fail_lookup)
+
+    # The same next step as processing the node, but without decoding it.
+    def apply(self, last: Step) -> Step:
+        parent = RecursiveStep()
+        parent.change(selector=1, value=last)
+        patch = last.patch()
+        patch.set(parent, 'mpt_work', 'parent_node_step')
+        patch.set(self.mode, 'mpt_work', 'mode')
+        patch.set(self.current_root, 'mpt_work', 'current_root')
+        patch.set(self.lookup_nibble_depth, 'mpt_work', 'lookup_nibble_depth')
+        patch.set(self.value, 'mpt_work', 'value')
+        patch.set(self.fail_lookup, 'mpt_work', 'fail_lookup')
+        return patch.apply()
+
+
+# Read steps by everything a read step depends on: the node reference, the key and the progress,
+# plus the result fields that the step may leave untouched.
+MPTReadKey = Tuple[bytes, int, int, int, int, bytes, int]
+
+
+def mpt_read_key(work: MPTWorkScope) -> MPTReadKey:
+    return (bytes(work.current_root), int(work.lookup_key), int(work.lookup_key_nibbles),
+            int(work.lookup_nibble_depth), int(work.mode_on_finish), bytes(work.value), int(work.fail_lookup))
+
+
+# Cache of read steps, for hot accounts and storage slots that are read again and again within a block.
+# A read from a root follows the same path every time: every level of it is cached, by node reference.
+#
+# Writes do not invalidate anything: nodes are referenced by hash (or embedded, if small),
+# a write creates new nodes and roots, the cached reads of the old nodes stay valid.
+class MPTReadCache(object):
+    size: int
+    entries: Dict[MPTReadKey, MPTReadLevel]
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key: MPTReadKey) -> Optional[MPTReadLevel]:
+        out = self.entries.get(key)
+        if out is not None:
+            self.entries.move_to_end(key)
+        return out
+
+    def put(self, key: MPTReadKey, level: MPTReadLevel) -> None:
+        self.entries[key] = level
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+# Records the nodes that are looked up, to replay them on a cache hit.
+class RecordingMPT(MPT):
+    trie: MPT
+    accessed: PyList[bytes]
+
+    def __init__(self, trie: MPT):
+        self.trie = trie
+        self.accessed = []
+
+    def get_node(self, key: Bytes32) -> bytes:
+        self.accessed.append(bytes(key))
+        return self.trie.get_node(key)
+
+    def put_node(self, raw: bytes) -> None:
+        self.trie.put_node(raw)
+
+
+def mpt_cached_node_step(last: Step, trie: MPT) -> Step:
+    cache = trie.read_cache()
+    if cache is None or last.mpt_work.mode != MPTAccessMode.READING:
+        return mpt_node_step_with_trie(last, trie)
+    key = mpt_read_key(last.mpt_work)
+    level = cache.get(key)
+    if level is None:
+        recorder = RecordingMPT(trie)
+        next = mpt_node_step_with_trie(last, recorder)
+        cache.put(key, MPTReadLevel(tuple(recorder.accessed), next.mpt_work))
+        return next
+    # Replay the lookups, the trie tracks them as witness of this step. The nodes were checked against their hash already.
+    for h in level.accessed:
+        trie.get_node(h)
+    return level.apply(last)
+
+
+# Processes a single trie node.
+def mpt_node_step_with_trie(last: Step, trie: MPT) -> Step:
 
     def new_2_node(path: bytes, content: bytes, rlp_encode_hash=False):
         # The content must already be RLP encoded (i.e. it's a length prefixed hash or a small RLP structure).
@@ -385,6 +539,7 @@ def mpt_step_with_trie(last: Step, trie: MPT) -> Step:
         raise NotImplementedError
 
     data = bytes(content.mpt_work.current_root)
+    key = None
     if len(data) >= 32:  # if not encoded in-place, then need a DB lookup
         # If not arrived yet, then expand it
         key = data
@@ -395,7 +550,10 @@ def mpt_step_with_trie(last: Step, trie: MPT) -> Step:
 
     # decode into a list of raw byte strings.
     # These strings may be 32-byte hashes, or RLP-encoded data if < 32 bytes
-    data_li = rlp_decode_node(data)
+    if key is not None and len(data) > 0:
+        data_li = RLP_NODES.decode(key, data)
+    else:
+        data_li = rlp_decode_node(data)
     if len(data_li) == 0:
         if access == MPTAccessMode.READING:
             next.mpt_work.current_root = b""
@@ -1,71 +1,127 @@
-from typing import Generator
+from typing import Generator, Optional
 from remerkleable.tree import Node, PairNode, Gindex
+import remerkleable.settings as remerkleable_settings
 
+# Roots of all-zero subtrees of any depth. The macula package sets the hash function before this is loaded.
+ZERO_ROOTS = frozenset(remerkleable_settings.zero_hashes[1:])
 
-class ShimNode(PairNode):
-    __slots__ = ('_touched_left', '_touched_right')
 
-    _touched_left: bool
-    _touched_right: bool
+# Shared by all the shim nodes of a trace.
+# A shim node side counts as touched if it was marked with the current generation,
+# so resetting the access tracking of every step is just a counter increment.
+class ShimTracker(object):
+    generation: int
 
-    def __init__(self, left: Node, right: Node):
-        self.reset_shim()
+    def __init__(self):
+        # 0 is reserved for "never touched"
+        self.generation = 1
 
-        if not left.is_leaf():
-            if isinstance(left, ShimNode):
-                left.reset_shim()
-            else:
-                left_root = left.merkle_root()  # preserve hash cache
-                left = ShimNode(left.get_left(), left.get_right())
-                left._root = left_root
+    def reset(self) -> None:
+        self.generation += 1
 
-        if not right.is_leaf():
-            if isinstance(right, ShimNode):
-                right.reset_shim()
-            else:
-                right_root = right.merkle_root()  # preserve hash cache
-                right = ShimNode(right.get_left(), right.get_right())
-                right._root = right_root
 
+class ShimNode(PairNode):
+    __slots__ = ('tracker', '_touched_left', '_touched_right', '_pair_count')
+
+    tracker: ShimTracker
+    # generation in which the left/right child was last touched
+    _touched_left: int
+    _touched_right: int
+    _pair_count: Optional[int]
+
+    def __init__(self, left: Node, right: Node, tracker: Optional[ShimTracker] = None):
         super(ShimNode, self).__init__(left, right)
+        self.tracker = ShimTracker() if tracker is None else tracker
+        self.reset_shim()
+        self._pair_count = None
 
     @staticmethod
-    def shim(node: Node) -> Node:
+    def shim(node: Node, tracker: Optional[ShimTracker] = None) -> Node:
         if isinstance(node, ShimNode):
             node.reset_shim()
             return node
         if node.is_leaf():
             return node
-        # calc root first, cached hashed can then hydrate the shim
-        node_root = node.merkle_root()
-        sh = ShimNode(node.get_left(), node.get_right())
-        sh._root = node_root
+        # Children are not wrapped here, but lazily, when they are touched (see get_left and get_right).
+        sh = ShimNode(node.get_left(), node.get_right(), tracker)
+        # Take over the hash cache of the original node, but don't force hashing it:
+        # if the root is not known yet, it is computed lazily, from the cached roots of the children.
+        # Unchanged subtrees are shared shims, so only the paths that changed since the last step are hashed.
+        if isinstance(node, PairNode):
+            sh._root = node._root
         return sh
 
+    # Number of pair-nodes in this subtree, i.e. the keccak calls to hash it without any cached roots.
+    # Zero subtrees are not counted, remerkleable has their roots precomputed.
+    # Computed once per shim, unchanged subtrees share the count with the previous steps.
+    # Counted over the children as they are: counting does not wrap them, that stays lazy.
+    @property
+    def pair_count(self) -> int:
+        if self._pair_count is None:
+            if self.merkle_root() in ZERO_ROOTS:
+                self._pair_count = 0
+                return 0
+            self._pair_count = 1 + node_pair_count(self.left) + node_pair_count(self.right)
+        return self._pair_count
+
+    # Yields the gindices of the touched nodes that were not traversed any further.
+    # Untouched siblings are not included: they are not read, and only needed as multiproof helpers,
+    # which the witness derives from these gindices (see witness.get_helper_indices).
+    #
+    # A touched zero subtree is yielded as a whole, its root is enough to know all of its contents.
+    # This also makes the access independent of how the zero subtree is represented:
+    # remerkleable summarizes zero list contents into a leaf, a tree loaded from binary nodes expands it.
     def get_touched_gindices(self, g: int = 1) -> Generator[Gindex, None, None]:
-        if self._touched_left:
+        generation = self.tracker.generation
+        touched_left = self._touched_left == generation
+        touched_right = self._touched_right == generation
+        if (not touched_left and not touched_right) or self.merkle_root() in ZERO_ROOTS:
+            # only the root of this subtree was used
+            yield g
+            return
+        if touched_left:
             if isinstance(self.left, ShimNode):
                 yield from self.left.get_touched_gindices(g*2)
             else:
                 yield g*2
-        else:
-            yield g*2
-        if self._touched_right:
+        if touched_right:
             if isinstance(self.right, ShimNode):
                 yield from self.right.get_touched_gindices(g*2+1)
             else:
                 yield g*2+1
-        else:
-            yield g*2+1
 
+    # Resets just this node. To reset the tracking of all nodes at once, reset the tracker.
     def reset_shim(self) -> None:
-        self._touched_left = False
-        self._touched_right = False
+        self._touched_left = 0
+        self._touched_right = 0
+
+    def wrap_left(self) -> Node:
+        left = self.left
+        if not left.is_leaf() and not isinstance(left, ShimNode):
+            left = ShimNode.shim(left, self.tracker)
+            self.left = left
+        return left
+
+    def wrap_right(self) -> Node:
+        right = self.right
+        if not right.is_leaf() and not isinstance(right, ShimNode):
+            right = ShimNode.shim(right, self.tracker)
+            self.right = right
+        return right
 
     def get_left(self) -> Node:
-        self._touched_left = True
-        return super().get_left()
+        self._touched_left = self.tracker.generation
+        return self.wrap_left()
 
     def get_right(self) -> Node:
-        self._touched_right = True
-        return super().get_right()
+        self._touched_right = self.tracker.generation
+        return self.wrap_right()
+
+
+# Pair count of any node, shimmed or not. See ShimNode.pair_count.
+def node_pair_count(node: Node) -> int:
+    if isinstance(node, ShimNode):
+        return node.pair_count
+    if node.is_leaf() or node.merkle_root() in ZERO_ROOTS:
+        return 0
+    return 1 + node_pair_count(node.get_left()) + node_pair_count(node.get_right())
@@ -140,3 +140,20 @@ REFUND_QUOTIENT_EIP3529 = 5
 
 # TODO
 CHAIN_ID = 42
+
+# Mainnet hard fork activation blocks
+HOMESTEAD_BLOCK = 1_150_000
+TANGERINE_WHISTLE_BLOCK = 2_463_000  # EIP-150
+SPURIOUS_DRAGON_BLOCK = 2_675_000  # EIP-155, EIP-158
+BYZANTIUM_BLOCK = 4_370_000
+CONSTANTINOPLE_BLOCK = 7_280_000  # activated together with Petersburg
+ISTANBUL_BLOCK = 9_069_000
+BERLIN_BLOCK = 12_244_000
+LONDON_BLOCK = 12_965_000
+
+# Trie levels that a single MPT read step may descend through. 1 is one node per step.
+# Stored in the MPT work scope of the step when a read is started, the verifier does not need to know it.
+MPT_READ_NODES_PER_STEP = 1
+
+# Read steps cached per trie by the generator, see mpt_work.MPTReadCache
+MPT_READ_CACHE_SIZE = 1 << 14
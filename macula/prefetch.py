@@ -0,0 +1,138 @@
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+import rlp
+from .step import Step, Address, NormalizedTransaction
+from .exec_mode import ExecMode
+from .external import ExternalSource
+from .mpt_work import rlp_decode_node, rlp_strip_length_prefix, mpt_hash
+from . import keccak_256
+
+# Prefetching of the MPT nodes that a transaction is known to access: the signer, the destination,
+# and the accounts and storage slots of the access list (EIP-2930).
+#
+# Without it, every MPT node miss is a separate request to the external source, one trie level at a time.
+# The prefetcher walks the paths to all the keys at once, level by level, so every level is one batched request.
+# The nodes go straight into the local node db of the trace: prefetching is not an access of any step,
+# the steps that read the nodes later still capture them as their witness.
+
+# Fetches the nodes for a list of node hashes, in the same order
+NodeBatchGetter = Callable[[List[bytes]], List[bytes]]
+
+# Root of a trie without any keys, the hash of the RLP empty string
+EMPTY_TRIE_ROOT = keccak_256(b"\x80")
+
+
+def key_nibbles(key: bytes) -> List[int]:
+    out = []
+    for b in key:
+        out.append(b >> 4)
+        out.append(b & 0xf)
+    return out
+
+
+# The nibbles of a hex-prefix encoded path, and whether it is a leaf.
+def path_nibbles(encoded_path: bytes) -> Tuple[List[int], bool]:
+    flag_nibble = encoded_path[0] >> 4
+    nibbles = key_nibbles(encoded_path[1:])
+    if flag_nibble & 0b0001:  # odd length: the second nibble is part of the path
+        nibbles.insert(0, encoded_path[0] & 0xf)
+    return nibbles, flag_nibble & 0b0010 != 0
+
+
+# A child reference in a node: a hash (length-prefixed in the RLP), an embedded node, or empty.
+def child_ref(item: bytes) -> bytes:
+    if len(item) >= 32:
+        return bytes(rlp_strip_length_prefix(item))
+    if item == b"\x80":
+        return b""
+    return item
+
+
+# Walks down one node from the given depth. Returns the next node reference and depth,
+# or the value of the key (None if the key is not in the trie) when the walk ends here.
+def walk_node(node: bytes, nibbles: List[int], depth: int) -> Tuple[bytes, int, bytes]:
+    if node in (b"", b"\x80"):
+        return b"", depth, None
+    items = rlp_decode_node(node)
+    if len(items) == 17:
+        if depth == len(nibbles):
+            return b"", depth, rlp.decode(bytes(items[16])) or None
+        return child_ref(items[nibbles[depth]]), depth + 1, None
+    if len(items) == 2:
+        path, leaf = path_nibbles(rlp.decode(bytes(items[0])))
+        if nibbles[depth:depth + len(path)] != path:
+            return b"", depth, None
+        if leaf:
+            if depth + len(path) != len(nibbles):
+                return b"", depth, None
+            return b"", depth + len(path), rlp.decode(bytes(items[1]))
+        return child_ref(items[1]), depth + len(path), None
+    return b"", depth, None
+
+
+# Resolves the full trie paths to the given keys, and stores the nodes in the local db.
+# All nodes of a level are fetched in one batch, only the nodes that are not in the local db yet.
+# Returns the values that were found, by key.
+def prefetch_paths(root: bytes, keys: Iterable[bytes], local_db: Dict[bytes, bytes],
+                   fetch: NodeBatchGetter) -> Dict[bytes, bytes]:
+    values: Dict[bytes, bytes] = dict()
+    # per key: the nibbles, the depth reached so far, and the next node to walk into
+    frontier = [(key, key_nibbles(key), 0, bytes(root)) for key in set(keys)]
+    while len(frontier) > 0:
+        missing = sorted(set(ref for _, _, _, ref in frontier if len(ref) >= 32 and ref not in local_db))
+        if len(missing) > 0:
+            for h, node in zip(missing, fetch(missing)):
+                if mpt_hash(node) != h:
+                    raise Exception("prefetched mpt node %s does not match its hash" % h.hex())
+                local_db[h] = node
+        next_frontier = []
+        for key, nibbles, depth, ref in frontier:
+            # embedded nodes are walked in place, until the next node that is referenced by hash
+            while len(ref) > 0:
+                node = local_db[ref] if len(ref) >= 32 else ref
+                ref, depth, value = walk_node(node, nibbles, depth)
+                if value is not None:
+                    values[key] = value
+                if len(ref) >= 32:
+                    next_frontier.append((key, nibbles, depth, ref))
+                    break
+        frontier = next_frontier
+    return values
+
+
+# The accounts and storage slots that a transaction is known to access.
+def tx_access_keys(tx: NormalizedTransaction) -> Dict[Address, Set[bytes]]:
+    out: Dict[Address, Set[bytes]] = {Address(tx.signer_address): set()}
+    if not tx.is_contract_creation:
+        out[Address(tx.destination)] = set()
+    for entry in tx.access_list:
+        slots = out.setdefault(Address(entry.address), set())
+        slots.update(bytes(key) for key in entry.storage_keys)
+    return out
+
+
+def prefetch_tx(src: ExternalSource, world_db: Dict[bytes, bytes],
+                storage_db: Callable[[Address], Dict[bytes, bytes]],
+                state_root: bytes, tx: NormalizedTransaction) -> None:
+    accounts = tx_access_keys(tx)
+    by_key = {keccak_256(addr): addr for addr in accounts.keys()}
+    account_values = prefetch_paths(state_root, by_key.keys(), world_db, src.get_world_nodes)
+    for key, value in account_values.items():
+        addr = by_key[key]
+        slots = accounts[addr]
+        if len(slots) == 0:
+            continue
+        # account RLP: nonce, balance, storage root, code hash
+        storage_root = rlp.decode(value)[2]
+        if storage_root == EMPTY_TRIE_ROOT:
+            continue
+        prefetch_paths(storage_root, [keccak_256(slot) for slot in slots], storage_db(addr),
+                       lambda keys: src.get_acc_storage_nodes(addr, keys))
+
+
+# To call after producing a step: if the step before loaded a transaction,
+# the nodes that the transaction is known to access are prefetched.
+def prefetch_after_tx_load(last: Step, next: Step, src: ExternalSource, world_db: Dict[bytes, bytes],
+                           storage_db: Callable[[Address], Dict[bytes, bytes]]) -> None:
+    if last.exec_mode != ExecMode.TxLoad or next.exec_mode != ExecMode.TxProc:
+        return
+    prefetch_tx(src, world_db, storage_db, bytes(next.state_root), next.tx.current_tx_normalized)
@@ -0,0 +1,255 @@
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import json
+import ssl
+from urllib.parse import urlsplit
+
+# Async JSON-RPC client, over HTTP/1.1 with just the standard library.
+#
+# Connections are kept alive and reused, up to a maximum number of concurrent connections.
+# Identical calls that are in flight at the same time are coalesced: only the first is sent,
+# the others wait for its result. Calls that are made together are sent as one JSON-RPC batch request.
+
+DEFAULT_POOL_SIZE = 8
+# seconds, for connecting, and for each request until the response is read
+DEFAULT_TIMEOUT = 30.0
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class ConnectionPool(object):
+    host: str
+    port: int
+    ssl_ctx: Optional[ssl.SSLContext]
+    size: int
+    timeout: float
+    # open connections that are not in use
+    idle: List[Connection]
+    # created lazily, within the event loop that uses the pool
+    slots: Optional[asyncio.Semaphore]
+    # number of connections that were opened, for stats
+    opened: int
+
+    def __init__(self, host: str, port: int, ssl_ctx: Optional[ssl.SSLContext], size: int = DEFAULT_POOL_SIZE,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.ssl_ctx = ssl_ctx
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.slots = None
+        self.opened = 0
+
+    # Returns a connection, and whether it was used before
+    async def acquire(self) -> Tuple[Connection, bool]:
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.size)
+        await self.slots.acquire()
+        if len(self.idle) > 0:
+            return self.idle.pop(), True
+        try:
+            conn = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.ssl_ctx), self.timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.opened += 1
+        return conn, False
+
+    def release(self, conn: Connection, reusable: bool) -> None:
+        if reusable:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+        self.slots.release()
+
+    async def close(self) -> None:
+        idle, self.idle = self.idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+# Sends a POST request on the connection, and reads the response.
+# Returns the status code, the body, and whether the connection can be reused.
+async def http_post(conn: Connection, host: str, path: str, body: bytes) -> Tuple[int, bytes, bool]:
+    reader, writer = conn
+    writer.write((
+        "POST %s HTTP/1.1\r\n"
+        "Host: %s\r\n"
+        "Content-Type: application/json\r\n"
+        "Content-Length: %d\r\n"
+        "Connection: keep-alive\r\n"
+        "\r\n" % (path, host, len(body))).encode('latin-1') + body)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if len(status_line) == 0:
+        raise ConnectionResetError("connection closed before response")
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+        raise Exception("invalid http status line: %r" % status_line)
+    status = int(parts[1])
+    headers: Dict[str, str] = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    reusable = parts[0] == b"HTTP/1.1" and headers.get('connection', '').lower() != 'close'
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # skip the trailer
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        data = b"".join(chunks)
+    elif 'content-length' in headers:
+        data = await reader.readexactly(int(headers['content-length']))
+    else:
+        # the body ends when the server closes the connection
+        data = await reader.read()
+        reusable = False
+    return status, data, reusable
+
+
+def rpc_result(response: Any) -> Any:
+    if not isinstance(response, dict):
+        raise Exception("invalid rpc response: %r" % (response,))
+    if response.get('error') is not None:
+        err = response['error']
+        if isinstance(err, dict):
+            raise Exception("rpc error %s: %s" % (err.get('code'), err.get('message')))
+        raise Exception("rpc error: %r" % (err,))
+    return response.get('result')
+
+
+class RpcClient(object):
+    host: str
+    path: str
+    pool: ConnectionPool
+    timeout: float
+    # calls that were sent and did not complete yet, by method and params
+    inflight: Dict[str, asyncio.Future]
+    next_id: int
+    # number of http requests that were sent, for stats
+    requests: int
+
+    def __init__(self, api_addr: str, pool_size: int = DEFAULT_POOL_SIZE, timeout: float = DEFAULT_TIMEOUT):
+        url = urlsplit(api_addr)
+        if url.scheme not in ('http', 'https'):
+            raise Exception("unsupported rpc url scheme: %r" % url.scheme)
+        secure = url.scheme == 'https'
+        self.host = url.netloc
+        self.path = url.path or "/"
+        if url.query:
+            self.path += "?" + url.query
+        port = url.port or (443 if secure else 80)
+        self.timeout = timeout
+        self.pool = ConnectionPool(url.hostname, port, ssl.create_default_context() if secure else None,
+                                   pool_size, timeout)
+        self.inflight = dict()
+        self.next_id = 0
+        self.requests = 0
+
+    async def post(self, payload: Any) -> Any:
+        body = json.dumps(payload).encode('utf-8')
+        while True:
+            conn, reused = await self.pool.acquire()
+            try:
+                # a stalled server fails the request, the connection is not reused
+                status, data, reusable = await asyncio.wait_for(
+                    http_post(conn, self.host, self.path, body), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.pool.release(conn, False)
+                # the server may have closed the idle connection in the meantime, retry on another one
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                self.pool.release(conn, False)
+                raise
+            self.pool.release(conn, reusable)
+            self.requests += 1
+            if status != 200:
+                raise Exception("rpc http status %d: %r" % (status, data[:200]))
+            return json.loads(data)
+
+    async def call(self, method: str, params: list) -> Any:
+        return (await self.batch([(method, params)]))[0]
+
+    # Makes all calls at once, as a single batch request.
+    # Calls that are already in flight are not sent again, but share the result.
+    async def batch(self, calls: List[Tuple[str, list]]) -> List[Any]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        send = []
+        for method, params in calls:
+            key = json.dumps([method, params])
+            fut = self.inflight.get(key)
+            if fut is None:
+                fut = loop.create_future()
+                self.inflight[key] = fut
+                send.append((key, method, params, fut))
+            futures.append(fut)
+
+        if len(send) > 0:
+            try:
+                await self.send(send)
+            except Exception as e:
+                for _, _, _, fut in send:
+                    if not fut.done():
+                        fut.set_exception(e)
+            except BaseException:
+                for _, _, _, fut in send:
+                    fut.cancel()
+                raise
+            finally:
+                for key, _, _, _ in send:
+                    del self.inflight[key]
+
+        # shielded: a cancelled caller does not cancel the calls that others are waiting for too
+        results = await asyncio.gather(*(asyncio.shield(fut) for fut in futures), return_exceptions=True)
+        for res in results:
+            if isinstance(res, BaseException):
+                raise res
+        return results
+
+    async def send(self, send: List[Tuple[str, str, list, asyncio.Future]]) -> None:
+        requests = []
+        for _, method, params, _ in send:
+            requests.append({"jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params})
+            self.next_id += 1
+        if len(requests) == 1:
+            responses = [await self.post(requests[0])]
+        else:
+            responses = await self.post(requests)
+            if not isinstance(responses, list):
+                # servers answer a batch with a single error if they reject it as a whole
+                rpc_result(responses)
+                raise Exception("invalid rpc batch response: %r" % (responses,))
+        by_id = {res.get('id'): res for res in responses if isinstance(res, dict)}
+        for req, (_, _, _, fut) in zip(requests, send):
+            res = by_id.get(req['id'])
+            if res is None:
+                fut.set_exception(Exception("no rpc response for %s call" % req['method']))
+                continue
+            try:
+                fut.set_result(rpc_result(res))
+            except Exception as e:
+                fut.set_exception(e)
+
+    async def close(self) -> None:
+        await self.pool.close()
@@ -67,11 +67,12 @@ def state_work_proc(trac: StepsTrace) -> Step:
                 next.exec_mode = ExecMode.MPTWork
                 next.mpt_work = MPTWorkScope(
                     mode=MPTAccessMode.STARTING_READ,
-                    tree_source=MPTTreeSource.WORLD_ACCOUNT,
-                    current_root=last.state_root,
+                    tree_source=MPTTreeSource.WORLD_ACCOUNTS,
+                    current_root=bytes(last.state_root),
                     lookup_key=b32_to_uint256(key),
                     lookup_key_nibbles=32*2,
                     lookup_nibble_depth=0,
+                    nodes_per_step=trac.mpt_nodes_per_step(),
                 )
                 # we'll return to this current step, but with MPT mode set to DONE
                 next.return_to_step.change(selector=1, value=last)
@@ -1,10 +1,15 @@
-from typing import Optional, BinaryIO, Union as PyUnion, Any
+from typing import Dict, List as PyList, Optional, BinaryIO, Union as PyUnion, Any, Tuple
+from collections import OrderedDict
+from functools import lru_cache
 from enum import IntEnum
 from remerkleable.complex import Container, Vector, List, Type, TypeVar
 from remerkleable.union import Union
 from remerkleable.byte_arrays import Bytes32, ByteVector, ByteList
 from remerkleable.basic import uint8, uint64, uint256, boolean
+from remerkleable.bitfields import Bitlist
+from remerkleable.tree import Node as TreeNode, PairNode, RootNode, zero_node, to_gindex
 from remerkleable.core import BackedView, View, Node, ViewHook, ObjType
+import remerkleable.settings as remerkleable_settings
 from .opcodes import OpCode
 
 
@@ -56,30 +61,160 @@ class BlockHistory(Vector[Bytes32, 256]):
     pass
 
 
+# Zero subtrees of each height, with every pair node present, so they can be modified like any other part of a tree.
+# Unlike zero_node(height), a summary that needs to be expanded first.
+# All nodes of the same height are shared, and the roots are known already, none of it is hashed again.
+ZERO_SUBTREES: PyList[TreeNode] = [zero_node(0)]
+
+
+def zero_subtree(height: int) -> TreeNode:
+    while len(ZERO_SUBTREES) <= height:
+        h = len(ZERO_SUBTREES)
+        node = PairNode(ZERO_SUBTREES[h-1], ZERO_SUBTREES[h-1])
+        node._root = zero_node(h).merkle_root()
+        ZERO_SUBTREES.append(node)
+    return ZERO_SUBTREES[height]
+
+
+# Heights of the zero summaries by root, for expanding a summary leaf without knowing where it is in the tree.
+# The macula package sets the hash function before this is loaded.
+ZERO_SUMMARY_HEIGHTS: Dict[bytes, int] = {root: h for h, root in enumerate(remerkleable_settings.zero_hashes) if h > 0}
+
+
+# Replaces the subtree of the given height at position index with sub.
+# Zero summaries on the way down are expanded, with zero subtrees of the right height.
+def graft_subtree(node: TreeNode, node_height: int, index: int, sub: TreeNode, sub_height: int) -> TreeNode:
+    if node_height == sub_height:
+        return sub
+    if node.is_leaf():
+        node = zero_subtree(node_height)
+    if (index >> (node_height - sub_height - 1)) & 1:
+        return PairNode(node.get_left(), graft_subtree(node.get_right(), node_height - 1, index, sub, sub_height))
+    else:
+        return PairNode(graft_subtree(node.get_left(), node_height - 1, index, sub, sub_height), node.get_right())
+
+
+# The subtree of the given height at position index. A zero summary on the way down contains it, then it is zero.
+def get_subtree(node: TreeNode, node_height: int, index: int, sub_height: int) -> TreeNode:
+    for height in range(node_height, sub_height, -1):
+        if node.is_leaf():
+            return zero_subtree(sub_height)
+        if (index >> (height - sub_height - 1)) & 1:
+            node = node.get_right()
+        else:
+            node = node.get_left()
+    return node
+
+
 # TODO: 64 MiB memory maximum enough or too much? Every 2x makes the tree a layer deeper,
 # but otherwise not much cost for unused space
 class Memory(List[uint8, 64 << 20]):
 
     def append_zero_32_bytes(self) -> None:
-        # TODO: if the length aligns to 32, this can be optimized
-        for i in range(32):
-            self.append(0)
+        self.expand_zero(len(self) + 32)
+
+    # Grows the memory towards max_length with zero bytes, in a single tree modification:
+    # the largest zero subtree that fits is grafted in, 2**k chunks of 32 bytes, aligned to 2**k chunks.
+    # Repeating this reaches any size in O(log size) grafts. The length must be aligned to 32 bytes.
+    def expand_zero(self, max_length: int) -> None:
+        length = len(self)
+        if length % 32 != 0:
+            raise Exception("memory length must be aligned to expand it with zero chunks")
+        if max_length > self.__class__.limit():
+            raise Exception("memory is at maximum capacity, cannot expand")
+        if max_length <= length:
+            return
+        chunk_i = length // 32
+        chunks = (max_length - length + 31) // 32
+        contents_depth = self.__class__.contents_depth()
+        k = 0
+        while k < contents_depth and (chunk_i >> k) & 1 == 0 and (2 << k) <= chunks:
+            k += 1
+        backing = self.get_backing()
+        contents = graft_subtree(backing.get_left(), contents_depth, chunk_i >> k, zero_subtree(k), k)
+        # a partial last chunk is zero beyond the length, like the rest of the contents
+        new_length = min(length + (32 << k), max_length)
+        self.set_backing(PairNode(contents, uint256(new_length).get_backing()))
+
+    # Copies bytes of a uint8 list (code, input, return data) into the memory, part of it per step.
+    # Bytes beyond the end of the source are copied as zeroes. The memory must be large enough already.
+    # Returns the number of bytes that were copied.
+    #
+    # If the source and destination are both aligned to 32 bytes, whole subtrees are spliced from the source tree
+    # into the memory tree: the largest aligned subtree that fits in the remaining length.
+    # Otherwise up to 32 bytes are copied, up to the next 32 byte boundary in the source.
+    def copy_from(self, src: List, mem_offset: int, src_offset: int, length: int) -> int:
+        if length == 0:
+            return 0
+        src_len = len(src)
+        if mem_offset % 32 == 0 and src_offset % 32 == 0 and length >= 32:
+            mem_chunk = mem_offset // 32
+            src_chunk = src_offset // 32
+            chunks = length // 32
+            mem_depth = self.__class__.contents_depth()
+            src_depth = src.__class__.contents_depth()
+            # Beyond the length the source tree may have zero summaries, which can't be modified in the memory.
+            # A subtree is either within the length, or completely after it and replaced by a zero subtree.
+            src_chunks = (src_len + 31) // 32
+            beyond = src_chunk >= src_chunks
+            k = 0
+            while (k < min(mem_depth, src_depth) and ((mem_chunk | src_chunk) >> k) & 1 == 0
+                   and (2 << k) <= chunks and (beyond or src_chunk + (2 << k) <= src_chunks)):
+                k += 1
+            if beyond:
+                sub = zero_subtree(k)
+            else:
+                sub = get_subtree(src.get_backing().get_left(), src_depth, src_chunk >> k, k)
+            backing = self.get_backing()
+            contents = graft_subtree(backing.get_left(), mem_depth, mem_chunk >> k, sub, k)
+            self.set_backing(PairNode(contents, backing.get_right()))
+            return 32 << k
+
+        delta = min(32 - (src_offset % 32), length)
+        if src_offset >= src_len:
+            data = b"\x00" * delta
+        else:
+            data = bytes(src[src_offset:min(src_offset + delta, src_len)]).ljust(delta, b"\x00")
+        # touches two words of memory if the memory offset is not aligned, but that's still manageable
+        self[mem_offset:mem_offset + delta] = data
+        return delta
+
+    # Memory words are read and written through the packed 32 byte chunks of the tree, not byte by byte.
+    # A word at an unaligned offset spans 2 adjacent chunks.
+
+    def get_chunk(self, chunk_i: int) -> bytes:
+        if chunk_i * 32 >= len(self):
+            # beyond the length, the contents are zero
+            return b"\x00" * 32
+        return self.get_backing().getter(to_gindex(chunk_i, self.__class__.tree_depth())).merkle_root()
 
     def get_ptr_32_bytes(self, offset: uint64) -> Bytes32:
         # note: gas and memory size checks ensure the below is safe from
         # over/under-flows and out-of-bound reads.
+        offset = int(offset)
         if len(self) > offset:
-            # note: may not align with 32-byte tree leaf values
-            # (bytes are packed together in the binary tree that backs the memory),
-            # but can be read in max 2 adjacent leaf nodes.
-            return Bytes32(self[offset:offset + 32])
+            chunk_i, shift = divmod(offset, 32)
+            if shift == 0:
+                return Bytes32(self.get_chunk(chunk_i))
+            return Bytes32((self.get_chunk(chunk_i) + self.get_chunk(chunk_i + 1))[shift:shift + 32])
         return Bytes32()
 
     def set_32_bytes(self, offset: uint64, val: Bytes32):
+        offset = int(offset)
         if offset + 32 > len(self):
             raise Exception("invalid memory access, must be a bug")
-        # note: alignment, either touches one or two tree leaf nodes.
-        self[offset:offset + 32] = val
+        depth = self.__class__.tree_depth()
+        chunk_i, shift = divmod(offset, 32)
+        backing = self.get_backing()
+        if shift == 0:
+            backing = backing.setter(to_gindex(chunk_i, depth))(RootNode(bytes(val)))
+        else:
+            # note: the bytes after the length are zero in the chunk, and stay zero
+            both = self.get_chunk(chunk_i) + self.get_chunk(chunk_i + 1)
+            both = both[:shift] + bytes(val) + both[shift + 32:]
+            backing = backing.setter(to_gindex(chunk_i, depth))(RootNode(both[:32]))
+            backing = backing.setter(to_gindex(chunk_i + 1, depth))(RootNode(both[32:]))
+        self.set_backing(backing)
 
 
 def uint256_to_b32(v: uint256) -> Bytes32:
@@ -90,6 +225,9 @@ def b32_to_uint256(v: Bytes32) -> uint256:
     return uint256.decode_bytes(v)  # uint256 is configured to be big-endian in the remerkleable settings
 
 
+UINT256_MASK = (1 << 256) - 1
+
+
 # EVM stack is max 1024 words
 class Stack(List[Bytes32, 1024]):
 
@@ -168,9 +306,12 @@ class ReturnData(List[uint8, 64 << 20]):
     pass
 
 
+MAX_CODE_SIZE = 0x6000
+
+
 # See https://github.com/ethereum/EIPs/blob/master/EIPS/eip-170.md
 # ~24.5 KB
-class Code(List[uint8, 0x6000]):
+class Code(List[uint8, MAX_CODE_SIZE]):
 
     def get_op(self, pc: uint64) -> OpCode:
         if pc >= self.length():
@@ -183,12 +324,56 @@ class Code(List[uint8, 0x6000]):
         # Don't bother checking for JUMPDEST in that case.
         if int(dest) >= len(self):
             return False
-        # Only JUMPDESTs allowed for destinations
-        if self[dest] != uint8(OpCode.CALL):
-            return False
-        # TODO: jump-dest analysis is missing! Cannot jump into data segment.
-        # we likely want to cache jump-dest analysis in the step data to not repeat it for every step
-        return True
+        # Only JUMPDESTs allowed for destinations, and not in PUSH data
+        return bool(CODE_ANALYSIS.jump_dests(self)[dest])
+
+
+# Bit per code byte: 1 if it is a JUMPDEST opcode, not PUSH data.
+# Committed in the contract scope, so a jump can be verified without analysing the code.
+class JumpDests(Bitlist[MAX_CODE_SIZE]):
+    pass
+
+
+def analyse_jump_dests(code: bytes) -> JumpDests:
+    bits = 0
+    pc = 0
+    end = len(code)
+    while pc < end:
+        op = code[pc]
+        if op == OpCode.JUMPDEST:
+            bits |= 1 << pc
+        elif OpCode.PUSH1 <= op <= OpCode.PUSH32:
+            # skip the push data
+            pc += op - OpCode.PUSH1 + 1
+        pc += 1
+    # SSZ bitlist encoding: little-endian bits, with a delimiter bit after the last bit
+    bits |= 1 << end
+    return JumpDests.decode_bytes(bits.to_bytes(length=(end // 8) + 1, byteorder='little'))
+
+
+# JUMPDEST analysis of recently executed code, with LRU eviction.
+# Keyed by the root of the code, which is cached in the code tree, and doesn't need the code bytes.
+class CodeAnalysisCache(object):
+    size: int
+    entries: Dict[bytes, JumpDests]
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def jump_dests(self, code: Code) -> JumpDests:
+        key = code.hash_tree_root()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        out = analyse_jump_dests(code.encode_bytes())
+        self.entries[key] = out
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return out
+
+
+CODE_ANALYSIS = CodeAnalysisCache(1024)
 
 
 # Assuming a tx input can be max 400M gas, and 4 gas is paid per zero byte, then put a 100M limit on input.
@@ -220,6 +405,9 @@ class LazyStep(BackedView):
 
     @classmethod
     def coerce_view(cls: Type[V], v: Any) -> V:
+        # A step is used as-is: Container.coerce_view would rebuild it field by field.
+        if isinstance(v, Step):
+            return v
         return Step.coerce_view(v)
 
     @classmethod
@@ -449,6 +637,8 @@ class ContractScope(Container):
     ret_data: ReturnData
     code: Code
     code_hash: Bytes32
+    # JUMPDEST analysis of the code, set when the call starts (see interpreter.exec_call_pre)
+    jump_dests: JumpDests
     # address of the *code*, used for code opcodes.
     # Not of the self contract, which may have a delegated address
     code_addr: Address
@@ -480,6 +670,12 @@ class ContractScope(Container):
         # no overflow, assuming gas total is capped within uint64
         self.gas += delta
 
+    def valid_jump_dest(self, dest: uint256) -> bool:
+        # the committed analysis is as long as the code, anything beyond it is not a valid destination
+        if int(dest) >= len(self.jump_dests):
+            return False
+        return bool(self.jump_dests[dest])
+
 
 class StateWorkType(IntEnum):
     NO_ACTION = 0
@@ -686,6 +882,10 @@ class MPTWorkScope(Container):
     # E.g. RLP-encoded account
     value: ByteList[2048]
 
+    # Pure reads may descend through this many trie levels per step, every node is still a witness of the step.
+    # 0 and 1 both mean one node per step.
+    nodes_per_step: uint8
+
 
 class Step(Container):
     # Loaded from data-availability layer. Easily embedded (ssz merkle root)
@@ -719,3 +919,154 @@ class Step(Container):
     # When doing a return, continue with the operations after this step.
     # Also used for internal returns, e.g. unwinding back to caller of state-work.
     return_to_step: RecursiveStep
+
+    # The node at the given gindex, without constructing any views.
+    def get_node(self, gindex: int) -> TreeNode:
+        return self.get_backing().getter(gindex)
+
+    # A new step, with the nodes at the given gindices replaced, in one batched pass over the tree.
+    # Subtrees without any patches are shared with this step. No views or hooks are involved,
+    # for processors that know what changes, see e.g. instructions.stack_op_progress.
+    def with_nodes(self, patches: Dict[int, TreeNode]) -> "Step":
+        return Step.view_from_backing(patch_nodes(self.get_backing(), patches))
+
+    # Collect several field writes, to apply them at once, see StepPatchSet.
+    def patch(self) -> "StepPatchSet":
+        return StepPatchSet(self)
+
+
+def concat_gindices(a: int, b: int) -> int:
+    anchor = b.bit_length() - 1
+    return (a << anchor) | (b ^ (1 << anchor))
+
+
+# The gindex and type of a field of a (nested) container, by field names.
+# Cached: looking up container fields is expensive, and the same fields are patched over and over.
+@lru_cache(maxsize=None)
+def field_info(cls: Type[Container], *names: str) -> Tuple[int, Type[View]]:
+    gindex = 1
+    for name in names:
+        keys = list(cls.fields().keys())
+        gindex = concat_gindices(gindex, to_gindex(keys.index(name), cls.tree_depth()))
+        cls = cls.fields()[name]
+    return gindex, cls
+
+
+def field_gindex(cls: Type[Container], *names: str) -> int:
+    return field_info(cls, *names)[0]
+
+
+# Replaces the nodes at the given gindices (relative to node) in one pass: every node on the way
+# to the patches is rebuilt once, other subtrees are shared. Like remerkleable setters, the sibling of
+# every node on the way is navigated, so a shimmed tree tracks the same access as a setter would.
+def patch_nodes(node: TreeNode, patches: Dict[int, TreeNode]) -> TreeNode:
+    if 1 in patches:
+        return patches[1]
+    left: Dict[int, TreeNode] = dict()
+    right: Dict[int, TreeNode] = dict()
+    for gindex, sub in patches.items():
+        anchor = 1 << (gindex.bit_length() - 2)
+        if gindex & anchor:
+            right[anchor | (gindex & (anchor - 1))] = sub
+        else:
+            left[anchor | (gindex & (anchor - 1))] = sub
+    if node.is_leaf():
+        # zero summary, like the unused part of a list: expanded like graft_subtree does
+        height = ZERO_SUMMARY_HEIGHTS.get(node.merkle_root())
+        if height is None:
+            raise Exception("cannot patch within a leaf node, interpreter bug")
+        node = zero_subtree(height)
+    node_left, node_right = node.get_left(), node.get_right()
+    if len(left) > 0:
+        node_left = patch_nodes(node_left, left)
+    if len(right) > 0:
+        node_right = patch_nodes(node_right, right)
+    return PairNode(node_left, node_right)
+
+
+# Gindices of the step fields that most steps read and write.
+EXEC_MODE_GINDEX = field_gindex(Step, 'exec_mode')
+PC_GINDEX = field_gindex(Step, 'contract', 'pc')
+STACK_GINDEX = field_gindex(Step, 'contract', 'stack')
+STACK_LENGTH_GINDEX = concat_gindices(STACK_GINDEX, 3)
+STACK_DEPTH = Stack.tree_depth()
+
+
+def stack_item_gindex(i: int) -> int:
+    return concat_gindices(STACK_GINDEX, to_gindex(i, STACK_DEPTH))
+
+
+# The gindex of desc relative to anc, desc must be within the subtree of anc.
+def relative_gindex(anc: int, desc: int) -> int:
+    depth = desc.bit_length() - anc.bit_length()
+    return (1 << depth) | (desc & ((1 << depth) - 1))
+
+
+def is_within(anc: int, desc: int) -> bool:
+    depth = desc.bit_length() - anc.bit_length()
+    return depth > 0 and (desc >> depth) == anc
+
+
+# Collects writes to several fields of a step, and applies them in one batched pass:
+# the ancestors that the fields share are rebuilt once, not once per assignment.
+# Fields are addressed by name, e.g. patch.set(7, 'contract', 'pc').
+# Writes apply in order, like assignments: a write within a field that was staged before patches the staged
+# value, a write to a field replaces the staged writes within it.
+# Reads through the patch set see the writes that were staged before, reads of the step don't.
+class StepPatchSet(object):
+    step: Step
+    patches: Dict[int, TreeNode]
+
+    def __init__(self, step: Step):
+        self.step = step
+        self.patches = dict()
+
+    def set(self, value: Any, *names: str) -> "StepPatchSet":
+        gindex, typ = field_info(Step, *names)
+        if not isinstance(value, typ):
+            value = typ.coerce_view(value)
+        return self.set_node(gindex, value.get_backing())
+
+    def staged_ancestor(self, gindex: int) -> Optional[int]:
+        anc = gindex >> 1
+        while anc > 0:
+            if anc in self.patches:
+                return anc
+            anc >>= 1
+        return None
+
+    def set_node(self, gindex: int, node: TreeNode) -> "StepPatchSet":
+        anc = self.staged_ancestor(gindex)
+        if anc is not None:
+            self.patches[anc] = patch_nodes(self.patches[anc], {relative_gindex(anc, gindex): node})
+            return self
+        for g in [g for g in self.patches.keys() if is_within(gindex, g)]:
+            del self.patches[g]
+        self.patches[gindex] = node
+        return self
+
+    def get_node(self, gindex: int) -> TreeNode:
+        if gindex in self.patches:
+            return self.patches[gindex]
+        anc = self.staged_ancestor(gindex)
+        if anc is not None:
+            return self.patches[anc].getter(relative_gindex(anc, gindex))
+        within = {relative_gindex(gindex, g): node for g, node in self.patches.items() if is_within(gindex, g)}
+        if len(within) > 0:
+            return patch_nodes(self.step.get_node(gindex), within)
+        return self.step.get_node(gindex)
+
+    def stack_length(self) -> int:
+        return int(uint256.view_from_backing(self.get_node(STACK_LENGTH_GINDEX)))
+
+    # Like Stack.remove, zeroes the top n items and shortens the stack.
+    def stack_remove(self, n: int) -> "StepPatchSet":
+        length = self.stack_length()
+        if n > length:
+            raise Exception("bad stack access, interpreter bug")
+        for i in range(length - n, length):
+            self.set_node(stack_item_gindex(i), zero_node(0))
+        return self.set_node(STACK_LENGTH_GINDEX, uint256(length - n).get_backing())
+
+    def apply(self) -> Step:
+        return self.step.with_nodes(self.patches)
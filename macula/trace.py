@@ -1,5 +1,10 @@
-from typing import Callable, Protocol
+from typing import Callable, Optional, Protocol, TYPE_CHECKING
 from .step import Step, Address, Bytes32
+from .params import MPT_READ_NODES_PER_STEP
+
+if TYPE_CHECKING:
+    from .jump_table import JumpTable
+    from .mpt_work import MPTReadCache
 
 
 # raw node access, can be tracked as global dictionary without pruning.
@@ -9,6 +14,10 @@ class MPT(Protocol):
     # note: key is computed as hash of the raw value (an RLP encoded MPT node)
     def put_node(self, raw: bytes) -> None: ...
 
+    # Cache of read steps, see mpt_work.MPTReadCache. None if the trie does not cache reads.
+    def read_cache(self) -> Optional['MPTReadCache']:
+        return None
+
 
 class StepsTrace(Protocol):
     # returns the block header (RLP encoded), i.e. preimage of the block hash
@@ -21,6 +30,16 @@ class StepsTrace(Protocol):
     # persists code in an account, to retrieve by code_hash later
     def code_store(self, code: bytes) -> None: ...
 
+    # opcode jump table of the hard fork that the block number is in.
+    # Traces should cache it, to select it once per block, see jump_table.JumpTableCache.
+    def jump_table(self, block_number: int) -> 'JumpTable':
+        from .jump_table import select_jump_table  # the jump table imports the instructions, which import this
+        return select_jump_table(block_number)
+
+    # Trie levels that an MPT read step may descend through, see MPTWorkScope.nodes_per_step
+    def mpt_nodes_per_step(self) -> int:
+        return MPT_READ_NODES_PER_STEP
+
     def last(self) -> Step: ...
 
 
@@ -1,4 +1,15 @@
-from typing import Dict, List, TypedDict
+from typing import Dict, Iterable, List, Optional, TypedDict, Set, Iterator, Tuple
+from remerkleable.tree import Node
+
+
+def encode_hex(v: bytes) -> str:
+    return '0x' + v.hex()
+
+
+def decode_hex(v: str) -> bytes:
+    if v.startswith('0x'):
+        v = v[2:]
+    return bytes.fromhex(v)
 
 
 class StepWitnessData(TypedDict):
@@ -16,6 +27,9 @@ class StepWitnessData(TypedDict):
     # Each gindex (key) is encodes as big-endian hex string with 0x prefix.
     # Each root (value) is 0x prefixed + hex encoded
     contents: Dict[str, str]
+    # Multiproof helper nodes: the siblings needed to verify the contents against the root, and nothing more.
+    # Same encoding as the contents.
+    helpers: Dict[str, str]
 
 
 class StepAccessList(TypedDict):
@@ -30,8 +44,8 @@ class StepAccessList(TypedDict):
     # TODO: support block header witness data
 
 
-# This is JSON object that the fraud-proof generator outputs.
-# It represents all witness data of the trace, in a compressed form.
+# This represents all witness data of the trace, in a compressed form.
+# The fraud-proof generator streams it to a binary container, see witness_stream.
 # To get the witness of a single step, use get_step_witness.
 class TraceWitnessData(TypedDict):
     # dict: hash -> code  (key and values are 0x prefixed + hex encoded)
@@ -44,41 +58,115 @@ class TraceWitnessData(TypedDict):
     # root node reference of each step (0x prefixed + hex encoded)
     steps: List[StepAccessList]
 
-    def get_step_witness(self, i: int) -> StepWitnessData:
-
-        step_acc_li = self.steps[i]
-
-        root = step_acc_li['root']
-        code_by_hash = {h: self.code_by_hash[h] for h in step_acc_li['accessed_code_hashes']}
-        mpt_node_by_hash = {h: self.mpt_node_by_hash[h] for h in step_acc_li['accessed_world_mpt_nodes']}
-
-        bin_db = self.binary_nodes
-
-        def retrieve_node_by_gindex(i: int, root: str) -> str:
-            if i == 1:
-                return root
-
-            if root not in bin_db:
-                raise Exception("this should be 1")
-
-            pivot = 1 << (i.bit_length() - 2)
-            go_right = i & pivot != 0
-            # mask out the top bit, and set the new top bit
-            child = (i | pivot) - (pivot << 1)
-            left, right = bin_db[root]
-            if go_right:
-                return retrieve_node_by_gindex(child, right)
-            else:
-                return retrieve_node_by_gindex(child, left)
-
-        contents = {g: retrieve_node_by_gindex(int.from_bytes(bytes.fromhex(g[2:]), byteorder='big'), root)
-                    for g in step_acc_li['accessed_gindices']}
 
-        post_root = self.steps[i+1]['root']
-        return StepWitnessData(
-            root=root,
-            expected_next_root=post_root,
-            code_by_hash=code_by_hash,
-            mpt_node_by_hash=mpt_node_by_hash,
-            contents=contents,
-        )
+# Tracks which binary tree nodes have been emitted already, across all steps of a trace.
+# Consecutive steps share nearly all of their subtrees, and a subtree with a known root
+# has had all of its nodes emitted before, so the traversal stops at the first known root.
+class BinaryNodeStore(object):
+    # roots of all pair-nodes that have been emitted
+    known: Set[bytes]
+
+    def __init__(self):
+        self.known = set()
+
+    # Yields (root, left root, right root) of every pair-node in the tree that has not been emitted before.
+    # Iterative, to not hit the recursion limit on deep trees such as the contract memory.
+    def new_nodes(self, node: Node) -> Iterator[Tuple[bytes, bytes, bytes]]:
+        stack = [node]
+        while len(stack) > 0:
+            b = stack.pop()
+            if b.is_leaf():
+                continue
+            # The merkle-roots are cached, this is fine
+            root = b.merkle_root()
+            if root in self.known:
+                continue
+            self.known.add(root)
+            left, right = b.get_left(), b.get_right()
+            yield root, left.merkle_root(), right.merkle_root()
+            stack.append(right)
+            stack.append(left)
+
+
+# The sibling of each node on the path from the gindex to the root, bottom-up
+def get_branch_indices(gindex: int) -> List[int]:
+    out = []
+    while gindex > 1:
+        out.append(gindex ^ 1)
+        gindex >>= 1
+    return out
+
+
+# The gindex itself and its ancestors, excluding the root, bottom-up
+def get_path_indices(gindex: int) -> List[int]:
+    out = []
+    while gindex > 1:
+        out.append(gindex)
+        gindex >>= 1
+    return out
+
+
+# The minimal set of extra nodes to merkleize the given gindices to the root, in descending order.
+# Siblings that are in the set already, or can be computed from it, are not included.
+def get_helper_indices(gindices: Iterable[int]) -> List[int]:
+    all_helper_indices = set()
+    all_path_indices = set()
+    for gi in gindices:
+        all_helper_indices.update(get_branch_indices(gi))
+        all_path_indices.update(get_path_indices(gi))
+    return sorted(all_helper_indices - all_path_indices, reverse=True)
+
+
+# Resolves the nodes at all the gindices in a single top-down traversal of the binary node db.
+# Each node on the shared path prefixes is looked up once, instead of once per gindex.
+def resolve_gindices(bin_db: Dict[str, list], root: str, gindices: Iterable[int]) -> Dict[int, str]:
+    gindices = list(gindices)
+    # all the nodes that have to be expanded to reach the gindices
+    expand = set()
+    for gi in gindices:
+        gi >>= 1
+        # stop at the first ancestor that was added for an earlier gindex, the rest of the path is shared
+        while gi >= 1 and gi not in expand:
+            expand.add(gi)
+            gi >>= 1
+    nodes = {1: root}
+    # a parent has a lower gindex than its children, so it is always resolved first
+    for gi in sorted(expand):
+        node = nodes[gi]
+        if node not in bin_db:
+            raise Exception("missing binary node %s at gindex %d" % (node, gi))
+        nodes[gi*2], nodes[gi*2+1] = bin_db[node]
+    return {gi: nodes[gi] for gi in gindices}
+
+
+# Works on the decoded JSON trace, as well as on the lazy views of a binary witness container (see witness_stream).
+# The root of the next step is read from the trace, unless it is given:
+# the next step of a sparse trace may not be a full step, then only its root is known (see WitnessReader.step_root).
+def get_step_witness(trace: TraceWitnessData, i: int, post_root: Optional[str] = None) -> StepWitnessData:
+
+    step_acc_li = trace['steps'][i]
+
+    root = step_acc_li['root']
+    code_by_hash = {h: trace['code_by_hash'][h] for h in step_acc_li['accessed_code_hashes']}
+    mpt_node_by_hash = {h: trace['mpt_node_by_hash'][h] for h in step_acc_li['accessed_world_mpt_nodes']}
+
+    gindices = sorted(int.from_bytes(decode_hex(g), byteorder='big') for g in step_acc_li['accessed_gindices'])
+    helper_indices = get_helper_indices(gindices)
+    nodes = resolve_gindices(trace['binary_nodes'], root, gindices + helper_indices)
+
+    def encode_gindex(gi: int) -> str:
+        return encode_hex(gi.to_bytes(length=32, byteorder='big'))
+
+    contents = {encode_gindex(gi): nodes[gi] for gi in gindices}
+    helpers = {encode_gindex(gi): nodes[gi] for gi in helper_indices}
+
+    if post_root is None:
+        post_root = trace['steps'][i+1]['root']
+    return StepWitnessData(
+        root=root,
+        expected_next_root=post_root,
+        code_by_hash=code_by_hash,
+        mpt_node_by_hash=mpt_node_by_hash,
+        contents=contents,
+        helpers=helpers,
+    )
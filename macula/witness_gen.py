@@ -0,0 +1,119 @@
+import io
+from .step import Step, Bytes32, Address
+from .capture import CaptureTrace
+from .external import ExternalSource
+from .witness import StepWitnessData, get_step_witness, encode_hex
+from .witness_stream import WitnessReader, WitnessWriter, RecordKind, open_witness
+from .checkpoint import load_tree
+from .params import MPT_READ_NODES_PER_STEP
+
+
+# Writes the witness of step i, returns the number of keccak calls it would take to hash the step without caching.
+#
+# In a sparse trace only some steps are full: of the others only the root is written, not the binary nodes
+# and access list. Their MPT nodes, codes and headers are still written, so the steps can be replayed
+# from the last full step before them, without the external source (see replay_step_witness).
+def write_step_witness(writer: WitnessWriter, trac: CaptureTrace, i: int, full: bool = True) -> int:
+    step = trac.steps[i]
+    acc_li = trac.access_trace[i]
+
+    # Combine all different MPT witnesses, they are unique by hash anyway
+    nodes = []
+    for h in acc_li.accessed_world_mpt_nodes:
+        writer.write_mpt_node(h, trac.world_mpt.local_db[h])
+        nodes.append(h)
+    for addr, node_li in acc_li.accessed_acc_storage_mpt_nodes.items():
+        acc_db = trac.acc_mpt_dict[addr].local_db
+        for h in node_li:
+            writer.write_mpt_node(h, acc_db[h])
+            nodes.append(h)
+    for h in acc_li.accessed_codes:
+        writer.write_code(h, trac.codes[h])
+    for h in acc_li.block_headers:
+        writer.write_header(h, trac.headers[h])
+
+    if not full:
+        writer.write_step_root(step.hash_tree_root())
+        return step.get_backing().pair_count
+
+    # store the nodes, skipping the subtrees that previous steps already stored
+    writer.write_tree(step.get_backing())
+
+    writer.write_step(
+        root=step.hash_tree_root(),
+        gindices=acc_li.step_gindices,
+        mpt_nodes=nodes,
+        code_hashes=acc_li.accessed_codes,
+    )
+    return step.get_backing().pair_count
+
+
+# Serves the external data of a trace from a witness container, to replay steps offline.
+class WitnessSource(ExternalSource):
+    reader: WitnessReader
+
+    def __init__(self, reader: WitnessReader):
+        self.reader = reader
+
+    def read_keyed(self, kind: RecordKind, key: bytes) -> bytes:
+        loc = self.reader.lookup(kind, bytes(key))
+        if loc is None:
+            raise KeyError("%s %s is not in the witness" % (kind.name, key.hex()))
+        offset, length = loc
+        return self.reader.read_payload(offset + 32, length - 32)
+
+    def block_header(self, block_hash: Bytes32) -> bytes:
+        return self.read_keyed(RecordKind.HEADER, block_hash)
+
+    def get_acc_storage_node(self, addr: Address, key: Bytes32) -> bytes:
+        return self.read_keyed(RecordKind.MPT_NODE, key)
+
+    def get_world_node(self, key: Bytes32) -> bytes:
+        return self.read_keyed(RecordKind.MPT_NODE, key)
+
+    def get_code(self, code_hash: Bytes32) -> bytes:
+        return self.read_keyed(RecordKind.CODE, code_hash)
+
+
+# The witness of step i. For a step of a sparse trace that is not full,
+# the steps since the last full step are replayed, with next_step, to regenerate the witness.
+# MPT reads have to be replayed with the nodes per step that the trace was generated with.
+def replay_step_witness(reader: WitnessReader, i: int,
+                        nodes_per_step: int = MPT_READ_NODES_PER_STEP) -> StepWitnessData:
+    if i < 0:
+        i += reader.step_count
+    if reader.is_full_step(i):
+        return get_step_witness(reader, i, encode_hex(reader.step_root(i+1)))
+    start = i
+    while not reader.is_full_step(start):
+        start -= 1
+        if start < 0:
+            raise Exception("no full step to replay step %d from" % i)
+
+    # the witness only has the nodes that steps accessed, prefetching would ask for more
+    trac = CaptureTrace(WitnessSource(reader), prefetch=False, nodes_per_step=nodes_per_step)
+    trac.add_step(Step.view_from_backing(load_tree(reader, reader.step_root(start))))
+
+    # Only the witness of step i is needed, and the root of the step after it.
+    out = io.BytesIO()
+    writer = WitnessWriter(out)
+    for j in range(start, i+1):
+        new_step = trac.trace_next()
+        if new_step.hash_tree_root() != reader.step_root(j+1):
+            raise Exception("replay of step %d does not match the trace" % (j+1))
+        if j == i:
+            write_step_witness(writer, trac, len(trac.steps)-1)
+        trac.add_step(new_step)
+        trac.prune()
+    write_step_witness(writer, trac, len(trac.steps)-1)
+    return get_step_witness(WitnessReader(out.getvalue()), 0)
+
+
+# Library entrypoint: the witness of a single step, straight from a witness container file.
+def read_step_witness(path: str, i: int, nodes_per_step: int = MPT_READ_NODES_PER_STEP) -> StepWitnessData:
+    with open(path, 'rb') as f:
+        reader = open_witness(f)
+        try:
+            return replay_step_witness(reader, i, nodes_per_step)
+        finally:
+            reader.data.close()
@@ -0,0 +1,468 @@
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+from enum import IntEnum
+from abc import abstractmethod
+import mmap
+from remerkleable.tree import Node
+from .witness import BinaryNodeStore, StepAccessList, TraceWitnessData, encode_hex, decode_hex
+
+# Binary container of the trace witness data.
+#
+# The container is appended to step by step while the trace runs,
+# instead of building the full TraceWitnessData in memory and dumping it as JSON at the end.
+#
+# Layout: WITNESS_MAGIC, followed by a sequence of records.
+# Each record is: kind (1 byte) ++ payload length (4 bytes, big-endian) ++ payload.
+# All hashes and roots are raw 32 bytes, no hex encoding.
+#
+# When the writer is closed, an INDEX record and a FOOTER record are appended.
+# The footer is always the last 13 bytes of the file, and points to the index payload.
+# The index is an open-addressing hash table of (kind, key) -> record, plus a table of step records,
+# so a reader can memory-map the file and look up any record without scanning or parsing the file.
+# A container without footer (e.g. an interrupted trace) is still readable, by scanning all records.
+
+WITNESS_MAGIC = b"MACW\x00\x01"
+
+RECORD_HEADER_SIZE = 1 + 4
+
+
+class RecordKind(IntEnum):
+    # code hash (32) ++ code
+    CODE = 0x01
+    # node hash (32) ++ RLP encoded MPT node
+    MPT_NODE = 0x02
+    # root (32) ++ left root (32) ++ right root (32)
+    BINARY_NODE = 0x03
+    # step access list, see encode_step
+    STEP = 0x04
+    # lookup table of all other records, see WitnessWriter.close
+    INDEX = 0x05
+    # index payload offset (8)
+    FOOTER = 0x06
+    # block hash (32) ++ block header
+    HEADER = 0x07
+    # root (32) of a step without access list, in a sparse trace (see write_step_witness)
+    STEP_ROOT = 0x08
+
+
+# records that are looked up by their key, the first 32 bytes of the payload
+KEYED_KINDS = (RecordKind.CODE, RecordKind.MPT_NODE, RecordKind.BINARY_NODE, RecordKind.HEADER)
+
+
+FOOTER_SIZE = RECORD_HEADER_SIZE + 8
+
+# key (32) ++ kind (1) ++ payload offset (8) ++ payload length (4). Empty slots have kind 0.
+INDEX_SLOT_SIZE = 32 + 1 + 8 + 4
+# payload offset (8) ++ payload length (4)
+INDEX_STEP_SIZE = 8 + 4
+
+
+def encode_step(root: bytes, gindices: Iterable[int], mpt_nodes: Iterable[bytes], code_hashes: Iterable[bytes]) -> bytes:
+    # root (32)
+    # ++ gindex count (4) ++ per gindex: byte length (1) ++ big-endian gindex
+    # ++ mpt node count (4) ++ node hashes (32 each)
+    # ++ code count (4) ++ code hashes (32 each)
+    out = [bytes(root)]
+    gindices = list(gindices)
+    out.append(len(gindices).to_bytes(length=4, byteorder='big'))
+    for gi in gindices:
+        gi_len = (gi.bit_length() + 7) // 8
+        out.append(gi_len.to_bytes(length=1, byteorder='big'))
+        out.append(gi.to_bytes(length=gi_len, byteorder='big'))
+    mpt_nodes = [bytes(h) for h in mpt_nodes]
+    out.append(len(mpt_nodes).to_bytes(length=4, byteorder='big'))
+    out.extend(mpt_nodes)
+    code_hashes = [bytes(h) for h in code_hashes]
+    out.append(len(code_hashes).to_bytes(length=4, byteorder='big'))
+    out.extend(code_hashes)
+    return b"".join(out)
+
+
+def decode_step(payload: bytes) -> Tuple[bytes, List[int], List[bytes], List[bytes]]:
+    root = payload[:32]
+    pos = 32
+
+    def read_count() -> int:
+        nonlocal pos
+        count = int.from_bytes(payload[pos:pos+4], byteorder='big')
+        pos += 4
+        return count
+
+    gindices = []
+    for _ in range(read_count()):
+        gi_len = payload[pos]
+        gindices.append(int.from_bytes(payload[pos+1:pos+1+gi_len], byteorder='big'))
+        pos += 1 + gi_len
+
+    def read_hashes() -> List[bytes]:
+        nonlocal pos
+        count = read_count()
+        hashes = [payload[pos+j*32:pos+(j+1)*32] for j in range(count)]
+        pos += count * 32
+        return hashes
+
+    mpt_nodes = read_hashes()
+    code_hashes = read_hashes()
+    if pos != len(payload):
+        raise Exception("unexpected step record length: %d <> %d" % (pos, len(payload)))
+    return root, gindices, mpt_nodes, code_hashes
+
+
+def step_access_list(payload: bytes) -> StepAccessList:
+    root, gindices, mpt_nodes, code_hashes = decode_step(payload)
+    return StepAccessList(
+        root=encode_hex(root),
+        accessed_gindices=[encode_hex(gi.to_bytes(length=32, byteorder='big')) for gi in gindices],
+        accessed_world_mpt_nodes=[encode_hex(h) for h in mpt_nodes],
+        accessed_code_hashes=[encode_hex(h) for h in code_hashes],
+    )
+
+
+def index_slot(key: bytes, mask: int) -> int:
+    # keys are hashes already, the first bytes are uniformly distributed
+    return int.from_bytes(key[:8], byteorder='big') & mask
+
+
+def encode_index(entries: Dict[Tuple[RecordKind, bytes], Tuple[int, int]], steps: List[Tuple[int, int]]) -> bytes:
+    # count per keyed kind (4 each) ++ slot count (4) ++ slots ++ step count (4) ++ steps
+    counts = {kind: 0 for kind in KEYED_KINDS}
+    # keep the load factor at or below 1/2, so probe sequences stay short
+    slot_count = 1
+    while slot_count < len(entries) * 2:
+        slot_count <<= 1
+    mask = slot_count - 1
+    slots = bytearray(slot_count * INDEX_SLOT_SIZE)
+    for (kind, key), (offset, length) in entries.items():
+        counts[kind] += 1
+        i = index_slot(key, mask)
+        while slots[i * INDEX_SLOT_SIZE + 32] != 0:
+            i = (i + 1) & mask
+        slots[i*INDEX_SLOT_SIZE:(i+1)*INDEX_SLOT_SIZE] = (
+            key + bytes([kind]) + offset.to_bytes(length=8, byteorder='big') + length.to_bytes(length=4, byteorder='big'))
+    out = [count.to_bytes(length=4, byteorder='big') for count in counts.values()]
+    out.append(slot_count.to_bytes(length=4, byteorder='big'))
+    out.append(bytes(slots))
+    out.append(len(steps).to_bytes(length=4, byteorder='big'))
+    for offset, length in steps:
+        out.append(offset.to_bytes(length=8, byteorder='big') + length.to_bytes(length=4, byteorder='big'))
+    return b"".join(out)
+
+
+class WitnessWriter(object):
+    out: BinaryIO
+    # position in the output, to know the offsets of the records for the index
+    offset: int
+
+    # binary nodes are shared between steps, only new ones are written
+    node_store: BinaryNodeStore
+    # codes, MPT nodes and binary nodes that were written, to index them when closing
+    # Codes and MPT nodes are written only once, the first time a step accesses them.
+    entries: Dict[Tuple[RecordKind, bytes], Tuple[int, int]]
+    steps: List[Tuple[int, int]]
+
+    # To continue an existing container, pass a reader of its contents, with the output positioned at the end.
+    def __init__(self, out: BinaryIO, existing: Optional["WitnessReader"] = None):
+        self.out = out
+        self.offset = 0
+        self.node_store = BinaryNodeStore()
+        self.entries = dict()
+        self.steps = []
+        if existing is None:
+            self.write(WITNESS_MAGIC)
+            return
+        if existing.indexed:
+            raise Exception("cannot continue a closed witness container")
+        self.offset = len(existing.data)
+        self.entries.update(existing.offsets)
+        self.steps.extend(existing.step_offsets)
+        self.node_store.known.update(key for kind, key in existing.offsets.keys() if kind == RecordKind.BINARY_NODE)
+
+    @property
+    def step_count(self) -> int:
+        return len(self.steps)
+
+    def write(self, data: bytes) -> None:
+        self.out.write(data)
+        self.offset += len(data)
+
+    # Writes a record, and returns the offset of its payload
+    def write_record(self, kind: RecordKind, payload: bytes) -> int:
+        self.write(bytes([kind]) + len(payload).to_bytes(length=4, byteorder='big'))
+        offset = self.offset
+        self.write(payload)
+        return offset
+
+    def write_keyed_record(self, kind: RecordKind, key: bytes, payload: bytes) -> None:
+        key = bytes(key)
+        if (kind, key) in self.entries:
+            return
+        offset = self.write_record(kind, key + payload)
+        self.entries[(kind, key)] = (offset, 32 + len(payload))
+
+    def write_code(self, code_hash: bytes, code: bytes) -> None:
+        self.write_keyed_record(RecordKind.CODE, code_hash, bytes(code))
+
+    def write_mpt_node(self, node_hash: bytes, node: bytes) -> None:
+        self.write_keyed_record(RecordKind.MPT_NODE, node_hash, bytes(node))
+
+    def write_header(self, block_hash: bytes, header: bytes) -> None:
+        self.write_keyed_record(RecordKind.HEADER, block_hash, bytes(header))
+
+    def write_tree(self, backing: Node) -> None:
+        for root, left, right in self.node_store.new_nodes(backing):
+            self.write_keyed_record(RecordKind.BINARY_NODE, root, left + right)
+
+    def write_step(self, root: bytes, gindices: Iterable[int],
+                   mpt_nodes: Iterable[bytes], code_hashes: Iterable[bytes]) -> None:
+        payload = encode_step(root, gindices, mpt_nodes, code_hashes)
+        offset = self.write_record(RecordKind.STEP, payload)
+        self.steps.append((offset, len(payload)))
+
+    def write_step_root(self, root: bytes) -> None:
+        offset = self.write_record(RecordKind.STEP_ROOT, bytes(root))
+        self.steps.append((offset, 32))
+
+    # Writes out everything that was written so far, up to self.offset
+    def flush(self) -> None:
+        self.out.flush()
+
+    # Appends the index and the footer. No records can be written after closing.
+    def close(self) -> None:
+        index_offset = self.write_record(RecordKind.INDEX, encode_index(self.entries, self.steps))
+        self.write_record(RecordKind.FOOTER, index_offset.to_bytes(length=8, byteorder='big'))
+
+
+# Iterates (kind, payload offset, payload length) of all records, without reading the payloads.
+def iter_records(data: bytes) -> Iterator[Tuple[RecordKind, int, int]]:
+    if data[:len(WITNESS_MAGIC)] != WITNESS_MAGIC:
+        raise Exception("not a witness container, or unsupported version")
+    pos = len(WITNESS_MAGIC)
+    while pos < len(data):
+        if pos + RECORD_HEADER_SIZE > len(data):
+            raise Exception("truncated record header")
+        kind = RecordKind(data[pos])
+        length = int.from_bytes(data[pos+1:pos+RECORD_HEADER_SIZE], byteorder='big')
+        offset = pos + RECORD_HEADER_SIZE
+        if offset + length > len(data):
+            raise Exception("truncated record")
+        yield kind, offset, length
+        pos = offset + length
+
+
+# Lazy mapping of 0x prefixed hex keys to records, values are only read and hex-encoded on access.
+# Abstract (Mapping is an ABC): subclasses decode the record payloads.
+class _HexKeyedView(Mapping[str, object]):
+    reader: "WitnessReader"
+    kind: RecordKind
+
+    def __init__(self, reader: "WitnessReader", kind: RecordKind):
+        self.reader = reader
+        self.kind = kind
+
+    @abstractmethod
+    def decode_value(self, payload: bytes) -> object:
+        ...
+
+    def __getitem__(self, key: str) -> object:
+        loc = self.reader.lookup(self.kind, decode_hex(key))
+        if loc is None:
+            raise KeyError(key)
+        offset, length = loc
+        return self.decode_value(self.reader.read_payload(offset + 32, length - 32))
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.reader.lookup(self.kind, decode_hex(key)) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (encode_hex(k) for k in self.reader.keys(self.kind))
+
+    def __len__(self) -> int:
+        return self.reader.counts[self.kind]
+
+
+class _BytesView(_HexKeyedView):
+    def decode_value(self, payload: bytes) -> str:
+        return encode_hex(payload)
+
+
+class _BinaryNodesView(_HexKeyedView):
+    def decode_value(self, payload: bytes) -> list:
+        return [encode_hex(payload[:32]), encode_hex(payload[32:64])]
+
+
+class _StepsView(Sequence[StepAccessList]):
+    reader: "WitnessReader"
+
+    def __init__(self, reader: "WitnessReader"):
+        self.reader = reader
+
+    def __getitem__(self, i: int) -> StepAccessList:
+        if not self.reader.is_full_step(i):
+            # only the root is known, the step has to be replayed for the rest
+            raise Exception("step %d is not a full step of this sparse trace, "
+                            "use witness_gen.replay_step_witness to get its witness" % i)
+        offset, length = self.reader.step_location(i)
+        return step_access_list(self.reader.read_payload(offset, length))
+
+    def __len__(self) -> int:
+        return self.reader.step_count
+
+
+# Reads a binary witness container lazily, from any buffer: bytes, or a memory-mapped file (see open_witness).
+#
+# If the container has an index, records are looked up in the on-disk hash table,
+# and nothing but the footer and index header is read upfront.
+# Otherwise the records are scanned once, and their keys and offsets are kept in memory.
+#
+# Implements the same mapping as the TraceWitnessData JSON object, so get_step_witness works with it.
+class WitnessReader(Mapping[str, object]):
+    data: Union[bytes, mmap.mmap]
+
+    counts: Dict[RecordKind, int]
+    step_count: int
+
+    # on-disk index: offsets of the slots and the steps table, in the data
+    indexed: bool
+    slots_offset: int
+    slot_mask: int
+    steps_offset: int
+
+    # fallback when there is no index: (kind, key) -> (offset, length)
+    offsets: Dict[Tuple[RecordKind, bytes], Tuple[int, int]]
+    step_offsets: List[Tuple[int, int]]
+
+    views: TraceWitnessData
+
+    def __init__(self, data: Union[bytes, mmap.mmap]):
+        self.data = data
+        if data[:len(WITNESS_MAGIC)] != WITNESS_MAGIC:
+            raise Exception("not a witness container, or unsupported version")
+        index_offset = self.find_index()
+        if index_offset is not None:
+            self.load_index(index_offset)
+        else:
+            self.scan()
+        self.views = TraceWitnessData(
+            code_by_hash=_BytesView(self, RecordKind.CODE),
+            mpt_node_by_hash=_BytesView(self, RecordKind.MPT_NODE),
+            binary_nodes=_BinaryNodesView(self, RecordKind.BINARY_NODE),
+            steps=_StepsView(self),
+        )
+
+    # The offset of the index payload, if the container ends with a footer that points to a valid index.
+    # The last bytes of a container without index (e.g. of an interrupted trace) may look like a footer by chance,
+    # so the index record itself is checked too: it has to end right before the footer, and its size has to match
+    # the slot and step counts it contains.
+    def find_index(self) -> Optional[int]:
+        data = self.data
+        end = len(data) - FOOTER_SIZE
+        if end < len(WITNESS_MAGIC) + RECORD_HEADER_SIZE:
+            return None
+        footer = data[end:]
+        if footer[0] != RecordKind.FOOTER or int.from_bytes(footer[1:RECORD_HEADER_SIZE], byteorder='big') != 8:
+            return None
+        pos = int.from_bytes(footer[RECORD_HEADER_SIZE:], byteorder='big')
+        if pos < len(WITNESS_MAGIC) + RECORD_HEADER_SIZE or pos > end:
+            return None
+        header = data[pos-RECORD_HEADER_SIZE:pos]
+        length = int.from_bytes(header[1:], byteorder='big')
+        if header[0] != RecordKind.INDEX or pos + length != end:
+            return None
+        # counts per keyed kind (4 each) ++ slot count (4) ++ slots ++ step count (4) ++ steps
+        slots_pos = pos + 4 * len(KEYED_KINDS) + 4
+        if slots_pos + 4 > end:
+            return None
+        slot_count = int.from_bytes(data[slots_pos-4:slots_pos], byteorder='big')
+        if slot_count == 0 or slot_count & (slot_count - 1) != 0:
+            return None
+        steps_pos = slots_pos + slot_count * INDEX_SLOT_SIZE + 4
+        if steps_pos > end:
+            return None
+        step_count = int.from_bytes(data[steps_pos-4:steps_pos], byteorder='big')
+        if steps_pos + step_count * INDEX_STEP_SIZE != end:
+            return None
+        return pos
+
+    def load_index(self, pos: int) -> None:
+        self.indexed = True
+        self.counts = {kind: int.from_bytes(self.data[pos+j*4:pos+(j+1)*4], byteorder='big')
+                       for j, kind in enumerate(KEYED_KINDS)}
+        pos += 4 * len(KEYED_KINDS)
+        slot_count = int.from_bytes(self.data[pos:pos+4], byteorder='big')
+        self.slots_offset = pos + 4
+        self.slot_mask = slot_count - 1
+        pos = self.slots_offset + slot_count * INDEX_SLOT_SIZE
+        self.step_count = int.from_bytes(self.data[pos:pos+4], byteorder='big')
+        self.steps_offset = pos + 4
+
+    def scan(self) -> None:
+        self.indexed = False
+        self.offsets = dict()
+        self.step_offsets = []
+        self.counts = {kind: 0 for kind in KEYED_KINDS}
+        for kind, offset, length in iter_records(self.data):
+            if kind == RecordKind.STEP or kind == RecordKind.STEP_ROOT:
+                self.step_offsets.append((offset, length))
+            elif kind in self.counts:
+                key = self.read_payload(offset, 32)
+                self.offsets[(kind, key)] = (offset, length)
+                self.counts[kind] += 1
+        self.step_count = len(self.step_offsets)
+
+    # Returns the (payload offset, payload length) of the record, or None if it's not in the container
+    def lookup(self, kind: RecordKind, key: bytes) -> Optional[Tuple[int, int]]:
+        if not self.indexed:
+            return self.offsets.get((kind, key))
+        i = index_slot(key, self.slot_mask)
+        while True:
+            pos = self.slots_offset + i * INDEX_SLOT_SIZE
+            slot_kind = self.data[pos+32]
+            if slot_kind == 0:
+                return None
+            if slot_kind == kind and self.data[pos:pos+32] == key:
+                return (int.from_bytes(self.data[pos+33:pos+41], byteorder='big'),
+                        int.from_bytes(self.data[pos+41:pos+45], byteorder='big'))
+            i = (i + 1) & self.slot_mask
+
+    def keys(self, kind: RecordKind) -> Iterator[bytes]:
+        if not self.indexed:
+            return (key for k, key in self.offsets.keys() if k == kind)
+        return (self.data[pos:pos+32] for pos in range(
+            self.slots_offset, self.slots_offset + (self.slot_mask + 1) * INDEX_SLOT_SIZE, INDEX_SLOT_SIZE)
+            if self.data[pos+32] == kind)
+
+    def step_location(self, i: int) -> Tuple[int, int]:
+        if i < 0:
+            i += self.step_count
+        if i < 0 or i >= self.step_count:
+            raise IndexError("step %d out of range, trace has %d steps" % (i, self.step_count))
+        if not self.indexed:
+            return self.step_offsets[i]
+        pos = self.steps_offset + i * INDEX_STEP_SIZE
+        return (int.from_bytes(self.data[pos:pos+8], byteorder='big'),
+                int.from_bytes(self.data[pos+8:pos+12], byteorder='big'))
+
+    # False if only the root of the step was stored, in a sparse trace
+    def is_full_step(self, i: int) -> bool:
+        offset, _ = self.step_location(i)
+        return self.data[offset - RECORD_HEADER_SIZE] == RecordKind.STEP
+
+    def step_root(self, i: int) -> bytes:
+        offset, _ = self.step_location(i)
+        return self.read_payload(offset, 32)
+
+    def read_payload(self, offset: int, length: int) -> bytes:
+        return self.data[offset:offset+length]
+
+    def __getitem__(self, key: str) -> object:
+        return self.views[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.views)
+
+    def __len__(self) -> int:
+        return len(self.views)
+
+
+# Memory-maps a witness container file, the OS pages in only the parts that are looked up.
+def open_witness(f: BinaryIO) -> WitnessReader:
+    return WitnessReader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
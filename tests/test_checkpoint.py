@@ -0,0 +1,64 @@
+import io
+from macula.step import Step
+from macula.capture import CaptureTrace
+from macula.external import NoSource
+from macula.checkpoint import write_checkpoint, read_checkpoint, restore_trace
+from macula.witness_stream import WitnessWriter, WitnessReader
+
+
+def test_checkpoint_resume(tmp_path):
+    out_path = tmp_path / "trace.witness"
+    ckpt_path = str(tmp_path / "trace.witness.ckpt")
+
+    trac = CaptureTrace(NoSource())
+    step = Step()
+    step.contract.code = b"\x60\x01\x60\x02\x01"
+    step.contract.stack.append(b"\x11" * 32)
+    trac.add_step(step)
+    trac.world_mpt.put_node(b"\xc1\x80")
+    acc = b"\x22" * 20
+    trac.new_acc_mpt(acc).put_node(b"\xc1\x01")
+    trac.code_store(b"\x60\x01")
+    trac.headers[b"\x33" * 32] = b"header"
+
+    with open(out_path, 'wb') as f:
+        writer = WitnessWriter(f)
+        write_checkpoint(ckpt_path, trac, writer, 42)
+        entries = dict(writer.entries)
+        # records after the checkpoint are dropped when resuming
+        writer.write_code(b"\x44" * 32, b"\x00")
+        writer.flush()
+
+    with open(ckpt_path, 'rb') as f:
+        checkpoint = read_checkpoint(f)
+    assert checkpoint.step_number == 42
+    assert checkpoint.step_root == step.hash_tree_root()
+
+    data = out_path.read_bytes()[:checkpoint.output_offset]
+    reader = WitnessReader(data)
+    resumed = restore_trace(checkpoint, reader, NoSource())
+    assert resumed.last().hash_tree_root() == step.hash_tree_root()
+    assert resumed.last().contract.stack[0] == b"\x11" * 32
+    assert resumed.world_mpt.local_db == trac.world_mpt.local_db
+    assert resumed.acc_mpt_dict[acc].local_db == trac.acc_mpt_dict[acc].local_db
+    assert resumed.codes == trac.codes
+    assert resumed.headers == trac.headers
+
+    out = io.BytesIO()
+    resumed_writer = WitnessWriter(out, reader)
+    assert resumed_writer.offset == checkpoint.output_offset
+    assert resumed_writer.entries == entries
+    assert resumed_writer.node_store.known == writer.node_store.known
+
+    # the resumed writer appends to the existing output, and skips what it already contains
+    resumed_writer.write_tree(step.get_backing())
+    assert out.getvalue() == b""
+    resumed_writer.write_code(b"\x55" * 32, b"\x01\x02")
+    resumed_writer.write_step(step.hash_tree_root(), [1], [], [b"\x55" * 32])
+    resumed_writer.close()
+    full = WitnessReader(data + out.getvalue())
+    assert full.indexed
+    assert resumed_writer.offset == len(data) + len(out.getvalue())
+    assert full['code_by_hash']["0x" + (b"\x55" * 32).hex()] == "0x0102"
+    assert set(full['binary_nodes'].keys()) >= set("0x" + r.hex() for r in writer.node_store.known)
+    assert len(full['steps']) == 1
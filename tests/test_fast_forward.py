@@ -0,0 +1,16 @@
+from macula.bench import synthetic_step, run_fast_forward, run_capture
+
+
+def test_fast_forward_matches_capture():
+    ff_roots = run_fast_forward(synthetic_step(5), 1000)
+    capture_roots = run_capture(synthetic_step(5), 1000)
+    assert len(ff_roots) > 5 * 3
+    assert ff_roots == capture_roots
+
+
+def test_fast_forward_limit():
+    try:
+        run_fast_forward(synthetic_step(5), 10)
+        assert False, "expected the limit to be hit"
+    except Exception as e:
+        assert "many steps" in str(e)
@@ -0,0 +1,155 @@
+from macula.interpreter import EXEC_MODE_PROCS, exec_unrecognized, exec_call_error, next_step
+from macula.exec_mode import ExecMode
+from macula.opcodes import OpCode
+from macula.jump_table import select_jump_table, JumpTableCache, FRONTIER_TABLE, ISTANBUL_TABLE, LONDON_TABLE
+from macula.params import ISTANBUL_BLOCK, LONDON_BLOCK
+from macula.step import Step, Code, CodeAnalysisCache, analyse_jump_dests
+from macula.fast_forward import FastForwardTrace
+from macula.external import NoSource
+from macula.bench import chain_dispatch, bench_dispatch
+import macula.interpreter
+
+
+class LastOnly(object):
+    def __init__(self, step: Step):
+        self.step = step
+
+    def last(self) -> Step:
+        return self.step
+
+
+def test_exec_mode_procs():
+    assert len(EXEC_MODE_PROCS) == 256
+    for mode in range(ExecMode.ErrSTOP, ExecMode.ErrInsufficientBalance + 1):
+        assert EXEC_MODE_PROCS[mode] is exec_call_error
+    # modes that are only entered as the result of a step are not processed
+    assert EXEC_MODE_PROCS[ExecMode.DONE] is exec_unrecognized
+    assert EXEC_MODE_PROCS[0x20] is exec_unrecognized
+
+
+def test_unrecognized_exec_mode():
+    step = Step()
+    step.exec_mode = 0x20
+    try:
+        next_step(LastOnly(step))
+        assert False, "expected an error"
+    except Exception as e:
+        assert "unrecognized execution mode: 32" in str(e)
+
+
+
+def test_dispatch_bench():
+    # the if-chain of the benchmark picks the same processor as the table, for every mode
+    stubs = tuple((lambda trac, i=i: i) for i in range(256))
+    for mode in ExecMode:
+        step = Step()
+        step.exec_mode = mode
+        trac = FastForwardTrace(NoSource(), step)
+        if EXEC_MODE_PROCS[mode] is exec_unrecognized:
+            try:
+                chain_dispatch(trac, stubs)
+                assert False, "expected an error"
+            except Exception as e:
+                assert "unrecognized execution mode" in str(e)
+        else:
+            assert chain_dispatch(trac, stubs) == mode
+    chain_time, table_time = bench_dispatch(ExecMode.OpcodeRun, 10)
+    assert chain_time > 0 and table_time > 0
+    # the processors are restored after the run
+    assert macula.interpreter.EXEC_MODE_PROCS is EXEC_MODE_PROCS
+
+def test_select_jump_table():
+    assert select_jump_table(0) is FRONTIER_TABLE
+    assert select_jump_table(ISTANBUL_BLOCK - 1)[OpCode.CHAINID] is None
+    assert select_jump_table(ISTANBUL_BLOCK) is ISTANBUL_TABLE
+    assert select_jump_table(ISTANBUL_BLOCK)[OpCode.CHAINID] is not None
+    assert select_jump_table(LONDON_BLOCK + 1) is LONDON_TABLE
+    assert LONDON_TABLE[OpCode.BASEFEE] is not None
+    assert ISTANBUL_TABLE[OpCode.BASEFEE] is None
+    # repricing of later forks
+    assert FRONTIER_TABLE[OpCode.SLOAD].constant_gas < ISTANBUL_TABLE[OpCode.SLOAD].constant_gas
+    assert all(len(table) == 256 for table in (FRONTIER_TABLE, ISTANBUL_TABLE, LONDON_TABLE))
+
+
+def test_jump_table_cache():
+    cache = JumpTableCache()
+    assert cache.get(ISTANBUL_BLOCK) is ISTANBUL_TABLE
+    assert cache.block_number == ISTANBUL_BLOCK
+    assert cache.get(LONDON_BLOCK) is LONDON_TABLE
+
+
+def test_jump_dest_analysis():
+    # PUSH1 0x5b is push data, not a JUMPDEST
+    code = bytes([OpCode.PUSH1, 0x5b, OpCode.JUMPDEST, OpCode.PUSH2, 0x5b, 0x5b, OpCode.JUMPDEST])
+    bits = analyse_jump_dests(code)
+    assert len(bits) == len(code)
+    assert [i for i in range(len(code)) if bits[i]] == [2, 6]
+
+    cache = CodeAnalysisCache(2)
+    codes = [Code(*code), Code(*code[:3]), Code(*code[:5])]
+    first = cache.jump_dests(codes[0])
+    assert cache.jump_dests(Code(*code)) is first
+    cache.jump_dests(codes[1])
+    cache.jump_dests(codes[2])
+    # least recently used is evicted
+    assert codes[0].hash_tree_root() not in cache.entries
+    assert len(cache.entries) == 2
+
+
+def run_jump(dest: int) -> ExecMode:
+    code = bytes([OpCode.PUSH1, dest, OpCode.JUMP, OpCode.PUSH1, 0x5b, OpCode.JUMPDEST, OpCode.STOP])
+    step = Step()
+    step.contract.code = Code(*code)
+    step.contract.gas = 100000
+    step.exec_mode = ExecMode.CallPre
+    trac = FastForwardTrace(NoSource(), step)
+    while ExecMode(trac.step.exec_mode) not in (ExecMode.ErrSTOP, ExecMode.ErrInvalidJump):
+        trac.step = next_step(trac)
+    return ExecMode(trac.step.exec_mode)
+
+
+def test_jump_into_push_data():
+    assert run_jump(5) == ExecMode.ErrSTOP
+    assert run_jump(4) == ExecMode.ErrInvalidJump
+    assert run_jump(100) == ExecMode.ErrInvalidJump
+
+
+def test_memory_expansion_steps():
+    # MSTORE at offset 0x80 * 0x40 needs 8KB+32 of memory
+    code = bytes([OpCode.PUSH1, 1, OpCode.PUSH1, 0x80, OpCode.PUSH1, 0x40, OpCode.MUL, OpCode.MSTORE, OpCode.STOP])
+    step = Step()
+    step.contract.code = Code(*code)
+    step.contract.gas = 100000
+    step.exec_mode = ExecMode.CallPre
+    trac = FastForwardTrace(NoSource(), step)
+    expansion_steps = 0
+    while ExecMode(trac.step.exec_mode) != ExecMode.ErrSTOP:
+        memory_size = len(trac.step.contract.memory)
+        trac.step = next_step(trac)
+        if len(trac.step.contract.memory) != memory_size:
+            expansion_steps += 1
+    assert len(trac.step.contract.memory) == 0x2000 + 32
+    assert trac.step.contract.memory.get_ptr_32_bytes(0x2000)[31] == 1
+    # one graft of 256 chunks, and one of the last chunk
+    assert expansion_steps == 2
+
+
+def test_aligned_call_data_copy_steps():
+    data = bytes(i % 251 for i in range(10 * 1024))
+    # CALLDATACOPY(mem_offset=0, data_offset=0, length=0x28 * 0x100)
+    code = bytes([OpCode.PUSH1, 0x28, OpCode.PUSH1, 0x10, OpCode.PUSH1, 0x10, OpCode.MUL, OpCode.MUL,
+                  OpCode.PUSH1, 0, OpCode.PUSH1, 0, OpCode.CALLDATACOPY, OpCode.STOP])
+    step = Step()
+    step.contract.code = Code(*code)
+    step.contract.input = data
+    step.contract.gas = 1000000
+    step.exec_mode = ExecMode.CallPre
+    trac = FastForwardTrace(NoSource(), step)
+    copy_steps = 0
+    while ExecMode(trac.step.exec_mode) != ExecMode.ErrSTOP:
+        if trac.step.exec_mode == ExecMode.OpcodeRun and trac.step.contract.op == OpCode.CALLDATACOPY:
+            copy_steps += 1
+        trac.step = next_step(trac)
+    assert bytes(trac.step.contract.memory) == data
+    # 10KB in 32 byte steps would be 320 steps
+    assert copy_steps <= 4
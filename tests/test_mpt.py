@@ -1,7 +1,14 @@
 from .test_proof_gen import TestMPT
-from macula.mpt_work import mpt_hash, MPTAccessMode, mpt_step_with_trie
-from macula.step import Step, uint256, MPTWorkScope
+from macula.mpt_work import mpt_hash, MPTAccessMode, mpt_step_with_trie, MPTReadCache, rlp_decode_node,\
+    rlp_decode_node_offsets, rlp_encode_node, rlp_strip_length_prefix, RLPNodeCache
+from macula.step import Step, uint256, MPTWorkScope, Address, StateWorkScope, StateWork_GetContractCodeHash,\
+    StateWorkMode, StateWorkType
 from macula.trace import StepsTrace
+from macula.exec_mode import ExecMode
+from macula.external import ExternalSource
+from macula.fast_forward import FastForwardTrace
+from macula.interpreter import next_step
+import rlp
 
 
 def test_mpt_read():
@@ -35,3 +42,146 @@ def test_mpt_read():
         step = out
 
     raise Exception("infinite loop? cut off at 512, abnormally large tree")
+
+
+class LoggingMPT(TestMPT):
+    def __init__(self):
+        super().__init__()
+        self.accessed = []
+
+    def get_node(self, key):
+        self.accessed.append(bytes(key))
+        return super().get_node(key)
+
+
+def read_steps(mpt: LoggingMPT, key: bytes, nodes_per_step: int):
+    step = Step(
+        mpt_work=MPTWorkScope(
+            mode=MPTAccessMode.READING.value,
+            current_root=mpt.trie.root_hash,
+            lookup_key=uint256(int.from_bytes(key, byteorder='big')),
+            lookup_key_nibbles=64,
+            lookup_nibble_depth=0,
+            mode_on_finish=0xff,
+            nodes_per_step=nodes_per_step,
+        )
+    )
+    mpt.accessed = []
+    roots = []
+    while step.mpt_work.mode != 0xff:
+        step = mpt_step_with_trie(step, mpt)
+        roots.append(step.hash_tree_root())
+        assert len(roots) < 512
+    return step, roots
+
+
+def test_mpt_read_nodes_per_step():
+    mpt = LoggingMPT()
+    keys = [mpt_hash(i.to_bytes(length=2, byteorder='big')) for i in range(300)]
+    for i, key in enumerate(keys):
+        mpt.insert(key, b'\x42' * (i % 40 + 1))
+    for key in keys[:20]:
+        single, single_roots = read_steps(mpt, key, 1)
+        single_nodes = mpt.accessed
+        multi, multi_roots = read_steps(mpt, key, 4)
+        assert multi.mpt_work.value == single.mpt_work.value
+        assert multi.mpt_work.fail_lookup == single.mpt_work.fail_lookup
+        # the same nodes are read, just in fewer steps
+        assert mpt.accessed == single_nodes
+        assert len(multi_roots) == (len(single_roots) + 3) // 4
+
+
+class TrieSource(ExternalSource):
+    def __init__(self, mpt: TestMPT):
+        self.mpt = mpt
+
+    def get_world_node(self, key):
+        return self.mpt.get_node(bytes(key))
+
+
+# The trace decides how many trie levels the MPT reads of state work descend through per step
+def test_state_work_nodes_per_step():
+    mpt = TestMPT()
+    addresses = [Address(i.to_bytes(length=20, byteorder='big')) for i in range(300)]
+    for i, addr in enumerate(addresses):
+        # short values: reads of values of 32 bytes or more are not supported yet
+        mpt.insert(mpt_hash(addr), rlp.encode([i, 7]))
+
+    def read_account(addr: Address, nodes_per_step: int):
+        step = Step(exec_mode=ExecMode.StateWork, state_root=mpt.mpt_root(), state_work=StateWorkScope(
+            mode=StateWorkMode.REQUESTING, mode_on_finish=StateWorkMode.RETURNED))
+        step.state_work.work.change(selector=StateWorkType.GET_CONTRACT_CODE_HASH,
+                                    value=StateWork_GetContractCodeHash(address=addr))
+        trac = FastForwardTrace(TrieSource(mpt), step, nodes_per_step=nodes_per_step)
+        trac.step = next_step(trac)
+        assert trac.step.mpt_work.nodes_per_step == nodes_per_step
+        count = 0
+        while trac.step.exec_mode == ExecMode.MPTWork:
+            trac.step = next_step(trac)
+            count += 1
+            assert count < 512
+        return trac.step.mpt_work, count
+
+    for addr in addresses[:10]:
+        single, single_count = read_account(addr, 1)
+        multi, multi_count = read_account(addr, 4)
+        assert single.fail_lookup == multi.fail_lookup == 0
+        assert single.value == multi.value
+        assert multi_count < single_count
+
+
+class CachingMPT(LoggingMPT):
+    def __init__(self):
+        super().__init__()
+        self.reads = MPTReadCache(1000)
+
+    def read_cache(self):
+        return self.reads
+
+
+def test_mpt_read_cache():
+    mpt = CachingMPT()
+    keys = [mpt_hash(i.to_bytes(length=2, byteorder='big')) for i in range(300)]
+    for i, key in enumerate(keys):
+        mpt.insert(key, b'\x42' * (i % 40 + 1))
+    uncached = LoggingMPT()
+    uncached.trie = mpt.trie
+    for key in keys[:10]:
+        _, expected_roots = read_steps(uncached, key, 1)
+        for nodes_per_step in (1, 1, 3):
+            _, roots = read_steps(mpt, key, nodes_per_step)
+            if nodes_per_step == 1:
+                # same steps, and the same nodes accessed, also when replayed from the cache
+                assert roots == expected_roots
+                assert mpt.accessed == uncached.accessed
+    assert 0 < len(mpt.reads.entries) <= 1000
+    entries = len(mpt.reads.entries)
+    read_steps(mpt, keys[0], 1)
+    # a repeated read only hits the cache
+    assert len(mpt.reads.entries) == entries
+
+
+def test_rlp_node_roundtrip():
+    for count in (2, 17):
+        # short and long strings and lists, to cover every kind of length prefix
+        for size in (0, 1, 20, 32, 60, 300):
+            items = [rlp.encode(bytes([(i * 7 + size) % 256]) * size) for i in range(count - 1)]
+            items.append(rlp.encode([b"\x01" * size]))
+            node = rlp_encode_node(items)
+            assert node == rlp.encode([rlp.decode(item) for item in items])
+            assert rlp_decode_node(node) == items
+            offsets = rlp_decode_node_offsets(node)
+            assert [node[offset:offset + size] for offset, size in offsets] == items
+            assert rlp_strip_length_prefix(node) == b"".join(items)
+            assert bytes(rlp_strip_length_prefix(memoryview(node))) == b"".join(items)
+            for item in items[:-1]:
+                if len(item) > 1:
+                    assert rlp_strip_length_prefix(item) == rlp.decode(item)
+            assert rlp_strip_length_prefix(items[-1]) == rlp.encode(b"\x01" * size)
+
+    cache = RLPNodeCache(1)
+    node = rlp_encode_node([b"\x80"] * 17)
+    li = cache.decode(mpt_hash(node), node)
+    li[0] = b"\x01"
+    # callers get a copy to modify
+    assert cache.decode(mpt_hash(node), node) == [b"\x80"] * 17
@@ -0,0 +1,111 @@
+from typing import Dict, List
+import pytest
+from macula.step import Address, Bytes32, NormalizedTransaction, AccessListEntry
+from macula.external import ExternalSource
+from macula.prefetch import prefetch_paths, prefetch_tx, tx_access_keys, EMPTY_TRIE_ROOT
+from macula import keccak_256
+from ethereum.trie import Trie
+from ethereum.db import EphemDB
+import rlp
+
+
+# Serves nodes from tries in memory, and counts the batched requests
+class BatchSource(ExternalSource):
+    world: Trie
+    storage: Dict[Address, Trie]
+    batches: List[List[bytes]]
+
+    def __init__(self):
+        self.world = Trie(EphemDB())
+        self.storage = dict()
+        self.batches = []
+
+    def get_world_nodes(self, keys: List[Bytes32]) -> List[bytes]:
+        self.batches.append(list(keys))
+        return [self.world.db.get(key) for key in keys]
+
+    def get_acc_storage_nodes(self, addr: Address, keys: List[Bytes32]) -> List[bytes]:
+        self.batches.append(list(keys))
+        return [self.storage[addr].db.get(key) for key in keys]
+
+
+def addr_of(i: int) -> Address:
+    return Address(i.to_bytes(length=20, byteorder='big'))
+
+
+def trie_depth(trie: Trie, key: bytes) -> int:
+    # number of hash-referenced nodes on the path to the key
+    refs = []
+
+    def fetch(keys):
+        refs.extend(keys)
+        return [trie.db.get(k) for k in keys]
+    prefetch_paths(trie.root_hash, [key], dict(), fetch)
+    return len(refs)
+
+
+def test_prefetch_paths():
+    src = BatchSource()
+    keys = [keccak_256(i.to_bytes(length=4, byteorder='big')) for i in range(300)]
+    for i, key in enumerate(keys):
+        src.world.update(key, b'\x42' * (i % 40 + 1))
+
+    local_db = dict()
+    wanted = keys[:20] + [keccak_256(b"missing")]
+    values = prefetch_paths(src.world.root_hash, wanted, local_db, src.get_world_nodes)
+    assert values == {key: src.world.get(key) for key in keys[:20]}
+    # one request per trie level, not per key and level
+    assert len(src.batches) == max(trie_depth(src.world, key) for key in wanted)
+    for batch in src.batches:
+        assert len(batch) == len(set(batch))
+    for h, node in local_db.items():
+        assert keccak_256(node) == h
+
+    # everything is local now
+    src.batches.clear()
+    assert prefetch_paths(src.world.root_hash, wanted, local_db, src.get_world_nodes) == values
+    assert src.batches == []
+
+
+def test_prefetch_hash_mismatch():
+    src = BatchSource()
+    src.world.update(keccak_256(b"a"), b"\x01" * 20)
+    src.world.update(keccak_256(b"b"), b"\x02" * 20)
+    with pytest.raises(Exception):
+        prefetch_paths(src.world.root_hash, [keccak_256(b"a")], dict(),
+                       lambda keys: [b"\xc0" for _ in keys])
+
+
+def test_prefetch_tx():
+    src = BatchSource()
+    signer, dest, listed = addr_of(1), addr_of(2), addr_of(3)
+    storage = Trie(EphemDB())
+    slots = [i.to_bytes(length=32, byteorder='big') for i in range(50)]
+    for i, slot in enumerate(slots):
+        storage.update(keccak_256(slot), rlp.encode(i + 1))
+    src.storage[listed] = storage
+    for i in range(100):
+        addr = addr_of(i)
+        root = storage.root_hash if addr == listed else EMPTY_TRIE_ROOT
+        src.world.update(keccak_256(addr), rlp.encode([i, 1000, root, keccak_256(b"")]))
+
+    tx = NormalizedTransaction(
+        signer_address=signer,
+        destination=dest,
+        access_list=[AccessListEntry(address=listed, storage_keys=[Bytes32(slot) for slot in slots[:5]])],
+    )
+    assert tx_access_keys(tx) == {signer: set(), dest: set(), listed: set(slots[:5])}
+
+    world_db = dict()
+    storage_dbs = dict()
+    prefetch_tx(src, world_db, lambda addr: storage_dbs.setdefault(addr, dict()), src.world.root_hash, tx)
+    assert list(storage_dbs.keys()) == [listed]
+    assert len(src.batches) == (max(trie_depth(src.world, keccak_256(addr)) for addr in (signer, dest, listed))
+                                + max(trie_depth(storage, keccak_256(slot)) for slot in slots[:5]))
+    # the nodes are enough to read the accounts and slots locally
+    for addr in (signer, dest, listed):
+        assert prefetch_paths(src.world.root_hash, [keccak_256(addr)], world_db, lambda keys: []) \
+               == {keccak_256(addr): src.world.get(keccak_256(addr))}
+    for slot in slots[:5]:
+        assert prefetch_paths(storage.root_hash, [keccak_256(slot)], storage_dbs[listed], lambda keys: []) \
+               == {keccak_256(slot): storage.get(keccak_256(slot))}
@@ -0,0 +1,204 @@
+from typing import Dict, List
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from macula.external import HttpSource, CODE_DB_PREFIX
+from macula.rpc import RpcClient
+from macula import keccak_256
+
+
+# Stand-in for the JSON-RPC of an archive node
+class RpcServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    db: Dict[str, str]
+    headers: Dict[str, str]
+    # the method calls of every request
+    requests: List[List[str]]
+    connections: int
+    delay: float
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RpcHandler)
+        self.db = dict()
+        self.headers = dict()
+        self.requests = []
+        self.connections = 0
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def url(self) -> str:
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def handle_call(self, req: dict) -> dict:
+        method, params = req['method'], req['params']
+        table = self.db if method == "debug_dbGet" else self.headers if method == "debug_getRawHeader" else None
+        if table is None:
+            return {"jsonrpc": "2.0", "id": req['id'], "error": {"code": -32601, "message": "method not found"}}
+        if params[0] not in table:
+            return {"jsonrpc": "2.0", "id": req['id'], "error": {"code": -32000, "message": "not found"}}
+        return {"jsonrpc": "2.0", "id": req['id'], "result": table[params[0]]}
+
+
+class RpcHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: RpcServer
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        calls = payload if isinstance(payload, list) else [payload]
+        with self.server.lock:
+            self.server.requests.append([call['method'] for call in calls])
+        time.sleep(self.server.delay)
+        responses = [self.server.handle_call(call) for call in calls]
+        body = json.dumps(responses if isinstance(payload, list) else responses[0]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        except ConnectionError:
+            # the client gave up on a delayed response
+            self.close_connection = True
+
+
+@pytest.fixture
+def server():
+    srv = RpcServer()
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def fill_db(server: RpcServer, n: int) -> List[bytes]:
+    keys = []
+    for i in range(n):
+        node = b"\xc2\x80" + bytes([i])
+        key = keccak_256(node)
+        server.db["0x" + key.hex()] = "0x" + node.hex()
+        keys.append(key)
+    return keys
+
+
+def test_http_source(server):
+    keys = fill_db(server, 10)
+    code = b"\x60\x01\x60\x02\x01"
+    code_hash = keccak_256(code)
+    server.db["0x" + (CODE_DB_PREFIX + code_hash).hex()] = "0x" + code.hex()
+    block_hash = b"\x11" * 32
+    server.headers["0x" + block_hash.hex()] = "0xc0"
+
+    src = HttpSource(server.url())
+    try:
+        assert keccak_256(src.get_world_node(keys[0])) == keys[0]
+        assert keccak_256(src.get_acc_storage_node(b"\x22" * 20, keys[1])) == keys[1]
+        assert src.get_code(code_hash) == code
+        assert src.block_header(block_hash) == b"\xc0"
+        with pytest.raises(Exception):
+            src.get_world_node(b"\x33" * 32)
+
+        server.requests.clear()
+        nodes = src.get_world_nodes(keys)
+        assert [keccak_256(node) for node in nodes] == keys
+        # all keys in one batch request
+        assert server.requests == [["debug_dbGet"] * len(keys)]
+        # the connection is kept alive and reused for all requests
+        assert server.connections == 1
+        assert src.client.pool.opened == 1
+    finally:
+        src.close()
+
+
+def test_rpc_coalescing(server):
+    keys = fill_db(server, 4)
+    server.delay = 0.05
+
+    async def run():
+        client = RpcClient(server.url())
+        try:
+            call = ("debug_dbGet", ["0x" + keys[0].hex()])
+            results = await asyncio.gather(*[client.call(*call) for _ in range(10)],
+                                           client.batch([call] + [("debug_dbGet", ["0x" + key.hex()]) for key in keys]))
+            return client, results
+        finally:
+            await client.close()
+
+    client, results = asyncio.run(run())
+    expected = [server.db["0x" + key.hex()] for key in keys]
+    assert results[:10] == [expected[0]] * 10
+    assert results[10] == [expected[0]] + expected
+    # the identical calls are sent once, the batch only sends the calls that were not in flight yet
+    assert sorted(len(req) for req in server.requests) == [1, 3]
+    assert client.requests == 2
+
+
+def test_rpc_pool_limit(server):
+    keys = fill_db(server, 12)
+    server.delay = 0.02
+
+    async def run():
+        client = RpcClient(server.url(), pool_size=3)
+        try:
+            results = await asyncio.gather(*[client.call("debug_dbGet", ["0x" + key.hex()]) for key in keys])
+            # the connections are reused, no new ones are needed
+            again = await asyncio.gather(*[client.call("debug_dbGet", ["0x" + key.hex()]) for key in keys])
+            assert again == results
+            return client, results
+        finally:
+            await client.close()
+
+    client, results = asyncio.run(run())
+    assert results == [server.db["0x" + key.hex()] for key in keys]
+    assert client.requests == 24
+    assert client.pool.opened == 3
+    assert server.connections == 3
+
+
+def test_rpc_errors(server):
+    fill_db(server, 1)
+
+    async def run():
+        client = RpcClient(server.url())
+        try:
+            with pytest.raises(Exception, match="method not found"):
+                await client.call("eth_unknown", [])
+            with pytest.raises(Exception, match="not found"):
+                await client.batch([("debug_dbGet", ["0x00"]), ("debug_dbGet", ["0x01"])])
+            # failed calls are not cached
+            assert client.inflight == {}
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+
+def test_rpc_timeout(server):
+    keys = fill_db(server, 2)
+    server.delay = 1.0
+    with HttpSource(server.url(), timeout=0.1) as src:
+        start = time.monotonic()
+        with pytest.raises((TimeoutError, asyncio.TimeoutError)):
+            src.get_world_node(keys[0])
+        assert time.monotonic() - start < 0.9
+        # the stalled connection is dropped, the next call uses a new one
+        server.delay = 0.0
+        assert keccak_256(src.get_world_node(keys[1])) == keys[1]
+        assert src.client.pool.opened == 2
+    assert src.loop.is_closed()
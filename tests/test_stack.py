@@ -0,0 +1,128 @@
+from itertools import product
+from macula.step import Step, uint256
+from macula.opcodes import OpCode
+from macula.jump_table import LONDON_TABLE
+
+# Differential test of the arithmetic opcodes, which use the int API of the stack,
+# against the uint256 view semantics they had before (see reference below).
+
+MAX = (1 << 256) - 1
+VALUES = [0, 1, 2, 31, 32, 256, (1 << 128) + 7, (1 << 255) - 1, 1 << 255, MAX]
+
+
+class LastOnly(object):
+    def __init__(self, step: Step):
+        self.step = step
+
+    def last(self) -> Step:
+        return self.step
+
+
+def to_signed_old(x):
+    x = int(x)
+    if x >= (1 << 255):
+        x = x - (1 << 255)
+    return x
+
+
+def ref_sdiv(x, y):
+    if y == 0:
+        return uint256(0)
+    z = to_signed_old(x) // to_signed_old(y)
+    if z < 0:
+        z += 1 << 255
+    return uint256(z)
+
+
+def ref_smod(x, y):
+    if y == 0:
+        return uint256(0)
+    x_old = x
+    if x >= (1 << 255): x = x - (1 << 255)
+    if y >= (1 << 255): y = y - (1 << 255)
+    z = x % y
+    if x_old >= (1 << 255):
+        if z >= (1 << 255): z = z - (1 << 255)
+        else: z = z + (1 << 255)
+    return uint256(z)
+
+
+def ref_sar(shift, value):
+    if shift > 256:
+        if value == 0 or value >= (1 << 255):
+            return uint256(0)
+        return uint256(MAX)
+    if value >= (1 << 255):
+        return value >> shift
+    if shift != 0:
+        raise NotImplementedError
+    return value
+
+
+# Top of the stack first, as uint256 views, the way the opcodes computed the results before.
+REFERENCE = {
+    OpCode.ADD: lambda x, y: x + y,
+    OpCode.SUB: lambda x, y: x - y,
+    OpCode.MUL: lambda x, y: x * y,
+    OpCode.DIV: lambda x, y: x // y,
+    OpCode.SDIV: ref_sdiv,
+    OpCode.MOD: lambda x, y: x % y,
+    OpCode.SMOD: ref_smod,
+    OpCode.EXP: lambda x, y: uint256(pow(int(x), int(y), 1 << 256)),
+    OpCode.NOT: lambda x: x ^ MAX,
+    OpCode.LT: lambda x, y: uint256(1 if x < y else 0),
+    OpCode.GT: lambda x, y: uint256(1 if x > y else 0),
+    OpCode.SLT: lambda x, y: uint256(1 if to_signed_old(x) < to_signed_old(y) else 0),
+    OpCode.SGT: lambda x, y: uint256(1 if to_signed_old(x) > to_signed_old(y) else 0),
+    OpCode.EQ: lambda x, y: uint256(1 if x == y else 0),
+    OpCode.ISZERO: lambda x: uint256(1 if x == 0 else 0),
+    OpCode.AND: lambda x, y: x & y,
+    OpCode.OR: lambda x, y: x | y,
+    OpCode.XOR: lambda x, y: x ^ y,
+    OpCode.BYTE: lambda th, val: uint256(val.encode_bytes()[th] if th < 32 else 0),
+    OpCode.ADDMOD: lambda x, y, z: uint256((int(x) + int(y)) % int(z)) if z != 0 else z,
+    OpCode.MULMOD: lambda x, y, z: uint256((int(x) * int(y)) % int(z)) if z != 0 else z,
+    OpCode.SHL: lambda shift, value: value << shift if shift < 256 else uint256(0),
+    OpCode.SHR: lambda shift, value: value >> shift if shift < 256 else uint256(0),
+    OpCode.SAR: ref_sar,
+}
+
+# the results that used to overflow, or divide by zero, now follow the EVM
+EVM = {
+    OpCode.ADD: lambda x, y: (x + y) & MAX,
+    OpCode.SUB: lambda x, y: (x - y) & MAX,
+    OpCode.MUL: lambda x, y: (x * y) & MAX,
+    OpCode.DIV: lambda x, y: x // y if y != 0 else 0,
+    OpCode.MOD: lambda x, y: x % y if y != 0 else 0,
+    OpCode.SHL: lambda shift, value: (value << shift) & MAX if shift < 256 else 0,
+}
+
+
+BASE_STEP = Step()
+
+
+def run_op(op: OpCode, args: list) -> Step:
+    step = BASE_STEP.copy()
+    # the first arg is the top of the stack
+    for v in reversed(args):
+        step.contract.stack.push_u256(uint256(v))
+    step.contract.op = op
+    return LONDON_TABLE[op].proc(LastOnly(step))
+
+
+def test_arithmetic_int_stack():
+    for op, ref in REFERENCE.items():
+        arg_count = ref.__code__.co_argcount
+        values = VALUES if arg_count < 3 else VALUES[::2]
+        for args in product(values, repeat=arg_count):
+            try:
+                expected = int(ref(*(uint256(v) for v in args)))
+            except (ValueError, ZeroDivisionError, OverflowError, NotImplementedError):
+                if op not in EVM:
+                    continue
+                expected = EVM[op](*args)
+            out = run_op(op, list(args))
+            assert len(out.contract.stack) == 1, op
+            assert out.contract.stack.peek_u256() == expected, (op, args)
+            assert out.contract.pc == 1
+
@@ -0,0 +1,196 @@
+from macula.exec_mode import ExecMode
+from macula.step import Memory, Input, Code, Step, Stack, CallWorkScope, ContractScope, PC_GINDEX, EXEC_MODE_GINDEX, STACK_LENGTH_GINDEX, STACK_GINDEX, stack_item_gindex
+from remerkleable.basic import uint8, uint64, uint256
+from remerkleable.tree import zero_node
+
+
+def test_memory_expand_zero():
+    for start, target in ((0, 32), (0, 4096), (32, 4096), (96, 1000), (64, 64 + 32 * 5)):
+        mem = Memory()
+        for i in range(start):
+            mem.append(1)
+        expected = Memory(*([1] * start + [0] * (target - start)))
+        grafts = 0
+        while len(mem) < target:
+            mem.expand_zero(target)
+            grafts += 1
+        assert len(mem) == target
+        assert mem.hash_tree_root() == expected.hash_tree_root()
+        assert grafts <= 2 * (target // 32).bit_length()
+    mem = Memory()
+    mem.append_zero_32_bytes()
+    mem.set_32_bytes(0, b"\x01" * 32)
+    assert len(mem) == 32
+    mem.append_zero_32_bytes()
+    assert bytes(mem[:64]) == b"\x01" * 32 + b"\x00" * 32
+
+
+def copy_all(mem: Memory, src, mem_offset: int, src_offset: int, length: int) -> int:
+    parts = 0
+    while length > 0:
+        delta = mem.copy_from(src, mem_offset, src_offset, length)
+        assert 0 < delta <= length
+        mem_offset += delta
+        src_offset += delta
+        length -= delta
+        parts += 1
+    return parts
+
+
+def test_memory_copy_from():
+    data = bytes((i * 7 + 3) % 256 for i in range(1200))
+    for src_cls in (Input, Code):
+        src = src_cls(*data)
+        for mem_offset, src_offset, length in ((0, 0, 1024), (64, 0, 1000), (32, 96, 1100), (5, 64, 300),
+                                               (0, 1088, 256), (0, 1600, 64), (7, 1190, 40)):
+            mem = Memory.decode_bytes(b"\xff" * 1536)
+            parts = copy_all(mem, src, mem_offset, src_offset, length)
+            expected = bytearray(b"\xff" * 1536)
+            expected[mem_offset:mem_offset + length] = data[src_offset:src_offset + length].ljust(length, b"\x00")
+            assert mem.encode_bytes() == bytes(expected)
+            assert mem.hash_tree_root() == Memory.decode_bytes(bytes(expected)).hash_tree_root()
+            if mem_offset == src_offset:
+                # aligned copies splice whole subtrees
+                assert parts <= 2 * (length // 32).bit_length() + 1
+
+
+def test_memory_words():
+    data = bytes((i * 13 + 1) % 256 for i in range(256))
+    for offset in (0, 1, 31, 32, 33, 100, 224):
+        mem = Memory.decode_bytes(data)
+        assert mem.get_ptr_32_bytes(offset) == data[offset:offset + 32]
+        word = bytes(range(100, 132))
+        mem.set_32_bytes(offset, word)
+        expected = data[:offset] + word + data[offset + 32:]
+        assert mem.encode_bytes() == expected
+        assert mem.hash_tree_root() == Memory.decode_bytes(expected).hash_tree_root()
+    mem = Memory.decode_bytes(data)
+    assert mem.get_ptr_32_bytes(256) == b"\x00" * 32
+    try:
+        mem.set_32_bytes(225, b"\x01" * 32)
+        assert False, "expected out of bounds write to fail"
+    except Exception as e:
+        assert "invalid memory access" in str(e)
+
+
+def test_step_with_nodes():
+    step = Step()
+    for v in (3, 4, 5):
+        step.contract.stack.push_u256(uint256(v))
+    step.contract.pc = 10
+    next = step.with_nodes({
+        PC_GINDEX: uint64(11).get_backing(),
+        EXEC_MODE_GINDEX: uint8(ExecMode.OpcodeLoad).get_backing(),
+        stack_item_gindex(2): zero_node(0),
+        stack_item_gindex(1): uint256(9).get_backing(),
+        STACK_LENGTH_GINDEX: uint256(2).get_backing(),
+    })
+
+    expected = step.copy()
+    expected.contract.stack.pop_u256()
+    expected.contract.stack.tweak_u256(uint256(9))
+    expected.contract.pc = 11
+    expected.exec_mode = ExecMode.OpcodeLoad
+    assert next.hash_tree_root() == expected.hash_tree_root()
+    assert next.contract.pc == 11
+    assert next.contract.stack.peek_u256() == 9
+    assert next.contract.stack.back_u256(1) == 3
+    # the original step is unchanged
+    assert step.contract.pc == 10
+    assert len(step.contract.stack) == 3
+    assert uint64.view_from_backing(step.get_node(PC_GINDEX)) == 10
+
+
+
+def test_step_with_nodes_zero_summary():
+    # the contents of an empty stack are a zero summary, patches within it expand it
+    step = Step()
+    next = step.with_nodes({
+        stack_item_gindex(0): uint256(9).get_backing(),
+        STACK_LENGTH_GINDEX: uint256(1).get_backing(),
+    })
+    expected = step.copy()
+    expected.contract.stack.push_u256(uint256(9))
+    assert next.hash_tree_root() == expected.hash_tree_root()
+    assert next.contract.stack.peek_u256() == 9
+    # and so do patches next to an expanded part
+    next = next.with_nodes({
+        stack_item_gindex(700): uint256(7).get_backing(),
+    })
+    assert uint256.view_from_backing(next.get_node(stack_item_gindex(700))) == 7
+    assert next.contract.stack.peek_u256() == 9
+    try:
+        step.with_nodes({PC_GINDEX * 2: zero_node(0)})
+        assert False, "expected patch within a leaf to fail"
+    except Exception as e:
+        assert "within a leaf" in str(e)
+
+
+def test_step_patch_set():
+    step = Step()
+    for v in range(1, 6):
+        step.contract.stack.push_u256(uint256(v))
+    step.contract.pc = 10
+    patch = step.patch()
+    patch.set(3, 'contract', 'call_depth')
+    patch.set(0, 'contract', 'pc')
+    patch.set(CallWorkScope(gas=100, input_size=4), 'call_work')
+    patch.set(ExecMode.CallSetup, 'exec_mode')
+    patch.stack_remove(2)
+    # reads through the patch set see the staged writes
+    assert patch.stack_length() == 3
+    patch.stack_remove(1)
+    next = patch.apply()
+
+    expected = step.copy()
+    expected.contract.call_depth = 3
+    expected.contract.pc = 0
+    expected.call_work = CallWorkScope(gas=100, input_size=4)
+    expected.exec_mode = ExecMode.CallSetup
+    expected.contract.stack.remove(3)
+    assert next.hash_tree_root() == expected.hash_tree_root()
+    assert next.contract.stack.peek_u256() == 2
+    assert next.call_work.gas == 100
+    # the original step is unchanged
+    assert step.contract.pc == 10
+    assert len(step.contract.stack) == 5
+
+    # replacing a whole subtree
+    next = step.patch().set(Stack(), 'contract', 'stack').apply()
+    assert len(next.contract.stack) == 0
+    try:
+        step.patch().stack_remove(6)
+        assert False, "expected stack underflow to fail"
+    except Exception as e:
+        assert "bad stack access" in str(e)
+
+
+def test_step_patch_set_overlap():
+    step = Step()
+    step.contract.pc = 10
+    for v in range(1, 4):
+        step.contract.stack.push_u256(uint256(v))
+
+    # a write within a staged field patches the staged value
+    next = step.patch().set(ContractScope(), 'contract').set(7, 'contract', 'pc').apply()
+    assert next.contract.pc == 7
+    assert len(next.contract.stack) == 0
+    # a write to a field replaces the staged writes within it
+    next = step.patch().set(7, 'contract', 'pc').set(ContractScope(), 'contract').apply()
+    assert next.contract.pc == 0
+    assert next.hash_tree_root() == step.patch().set(ContractScope(), 'contract').apply().hash_tree_root()
+
+    # reads see a staged ancestor
+    stack = Stack()
+    stack.push_u256(uint256(8))
+    stack.push_u256(uint256(9))
+    patch = step.patch().set(stack, 'contract', 'stack')
+    assert patch.stack_length() == 2
+    next = patch.stack_remove(1).apply()
+    assert len(next.contract.stack) == 1
+    assert next.contract.stack.peek_u256() == 8
+    assert next.contract.pc == 10
+    # and staged writes within the node that is read
+    patch = step.patch().stack_remove(1)
+    assert Stack.view_from_backing(patch.get_node(STACK_GINDEX)).hash_tree_root() \
+        == patch.apply().contract.stack.hash_tree_root()
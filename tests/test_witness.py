@@ -0,0 +1,235 @@
+import io
+from macula.step import Step
+from macula.witness import BinaryNodeStore, get_step_witness, get_helper_indices, encode_hex
+from macula.node_shim import ShimNode, ShimTracker, ZERO_ROOTS
+import macula
+from macula import keccak_256
+from macula.witness_stream import WitnessWriter, WitnessReader, RecordKind, FOOTER_SIZE, RECORD_HEADER_SIZE
+from macula.witness_gen import read_step_witness
+from remerkleable.tree import Node
+
+
+def all_pair_nodes(node: Node, out: dict):
+    if node.is_leaf():
+        return
+    left, right = node.get_left(), node.get_right()
+    out[node.merkle_root()] = (left.merkle_root(), right.merkle_root())
+    all_pair_nodes(left, out)
+    all_pair_nodes(right, out)
+
+
+def test_binary_node_store_incremental():
+    store = BinaryNodeStore()
+
+    step = Step()
+    step.contract.code = b"\x60\x01\x60\x02\x01"
+    first = {root: (left, right) for root, left, right in store.new_nodes(step.get_backing())}
+    expected = dict()
+    all_pair_nodes(step.get_backing(), expected)
+    assert first == expected
+
+    # unchanged tree: nothing new to emit
+    assert list(store.new_nodes(step.get_backing())) == []
+
+    next = step.copy()
+    next.contract.pc = 1
+    second = list(store.new_nodes(next.get_backing()))
+    # only the path from the root to the changed leaf is new
+    assert 0 < len(second) < 16
+    for root, left, right in second:
+        assert root not in first
+    expected = dict()
+    all_pair_nodes(next.get_backing(), expected)
+    # everything in the new tree is covered by what was emitted for both steps combined
+    assert set(expected.keys()) <= set(first.keys()) | set(root for root, _, _ in second)
+
+
+code_hash = b"\xaa" * 32
+mpt_hash = b"\xbb" * 32
+gindices = [2, 3, 5, 12]
+
+
+def two_steps():
+    step = Step()
+    step.contract.code = b"\x60\x01\x60\x02\x01"
+    next = step.copy()
+    next.contract.pc = 1
+    return step, next
+
+
+def write_test_trace(writer: WitnessWriter) -> WitnessWriter:
+    step, next = two_steps()
+    writer.write_code(code_hash, b"\x60\x01")
+    writer.write_code(code_hash, b"\x60\x01")
+    writer.write_mpt_node(mpt_hash, b"\xc0")
+    writer.write_tree(step.get_backing())
+    writer.write_step(step.hash_tree_root(), gindices, [mpt_hash], [code_hash])
+    writer.write_tree(next.get_backing())
+    writer.write_step(next.hash_tree_root(), [], [], [])
+    return writer
+
+
+def check_test_trace(reader: WitnessReader):
+    step, next = two_steps()
+    assert len(reader['steps']) == 2
+    assert len(reader['code_by_hash']) == 1
+
+    witness = get_step_witness(reader, 0)
+    assert witness['root'] == encode_hex(step.hash_tree_root())
+    assert witness['expected_next_root'] == encode_hex(next.hash_tree_root())
+    assert witness['code_by_hash'] == {encode_hex(code_hash): "0x6001"}
+    assert witness['mpt_node_by_hash'] == {encode_hex(mpt_hash): "0xc0"}
+    backing = step.get_backing()
+    assert witness['contents'] == {
+        encode_hex(gi.to_bytes(length=32, byteorder='big')): encode_hex(backing.getter(gi).merkle_root())
+        for gi in gindices
+    }
+    assert witness['helpers'] == {
+        encode_hex(gi.to_bytes(length=32, byteorder='big')): encode_hex(backing.getter(gi).merkle_root())
+        for gi in (13, 7, 4)
+    }
+
+
+def test_witness_stream_roundtrip():
+    buf = io.BytesIO()
+    write_test_trace(WitnessWriter(buf))
+    # not closed: no index, the reader scans the records
+    reader = WitnessReader(buf.getvalue())
+    assert not reader.indexed
+    check_test_trace(reader)
+
+
+def test_witness_stream_index(tmp_path):
+    buf = io.BytesIO()
+    write_test_trace(WitnessWriter(buf)).close()
+    reader = WitnessReader(buf.getvalue())
+    assert reader.indexed
+    check_test_trace(reader)
+    assert reader.lookup(RecordKind.CODE, b"\xcc" * 32) is None
+    # the index lists the same nodes as a scan of the records
+    scanned = WitnessReader(buf.getvalue()[:-FOOTER_SIZE])
+    assert not scanned.indexed
+    assert set(reader['binary_nodes'].keys()) == set(scanned['binary_nodes'].keys())
+
+    path = tmp_path / "trace.witness"
+    path.write_bytes(buf.getvalue())
+    assert read_step_witness(str(path), 0) == get_step_witness(reader, 0)
+
+
+def test_witness_stream_fake_footer():
+    buf = io.BytesIO()
+    writer = write_test_trace(WitnessWriter(buf))
+    # not closed, but the last record ends in bytes that look like a footer
+    fake_footer = bytes([RecordKind.FOOTER]) + (8).to_bytes(length=4, byteorder='big')
+    fake_node = b"\xc0" + fake_footer + (len(buf.getvalue()) + RECORD_HEADER_SIZE + 32).to_bytes(length=8, byteorder='big')
+    writer.write_mpt_node(b"\xdd" * 32, fake_node)
+    data = buf.getvalue()
+    assert data[-FOOTER_SIZE:-8] == fake_footer
+    reader = WitnessReader(data)
+    assert not reader.indexed
+    check_test_trace(reader)
+    assert reader['mpt_node_by_hash'][encode_hex(b"\xdd" * 32)] == encode_hex(fake_node)
+
+
+def test_helper_indices():
+    assert get_helper_indices([9]) == [8, 5, 3]
+    assert get_helper_indices([8, 9, 14]) == [15, 6, 5]
+    assert get_helper_indices([1]) == []
+
+
+def merkleize_multiproof(nodes: dict) -> bytes:
+    # bottom-up: combine siblings until only the root is left
+    nodes = dict(nodes)
+    keys = sorted(nodes.keys(), reverse=True)
+    pos = 0
+    while pos < len(keys):
+        k = keys[pos]
+        if k > 1 and (k ^ 1) in nodes and (k // 2) not in nodes:
+            nodes[k // 2] = keccak_256(nodes[k & ~1] + nodes[k | 1])
+            keys.append(k // 2)
+        pos += 1
+    return nodes[1]
+
+
+def test_touched_gindices_multiproof():
+    step, _ = two_steps()
+    step.set_backing(ShimNode.shim(step.get_backing()))
+    _ = step.contract.pc
+    _ = step.contract.code.hash_tree_root()
+    backing = step.get_backing()
+    touched = list(backing.get_touched_gindices(g=1))
+    helpers = get_helper_indices(touched)
+    # the untouched siblings are helpers, not part of the touched set
+    assert set(touched).isdisjoint(helpers)
+    nodes = {gi: backing.getter(gi).merkle_root() for gi in touched + helpers}
+    assert merkleize_multiproof(nodes) == step.hash_tree_root()
+
+
+def test_shim_hash_cache():
+    step, _ = two_steps()
+    # not zero, a touched zero subtree would be captured as a whole
+    step.contract.pc = 7
+    step.set_backing(ShimNode.shim(step.get_backing()))
+    backing = step.get_backing()
+    _ = step.contract.pc
+    [pc_gindex] = backing.get_touched_gindices()
+    all_nodes = dict()
+    all_pair_nodes(backing, all_nodes)
+    # the pair count includes duplicate subtrees, the dict only has unique ones
+    assert backing.pair_count >= len(all_nodes)
+    # counting does not shim the children, they are still wrapped lazily
+    raw, _ = two_steps()
+    raw.contract.pc = 7
+    fresh = ShimNode.shim(raw.get_backing())
+    assert fresh.pair_count == backing.pair_count
+    assert not isinstance(fresh.left, ShimNode) and not isinstance(fresh.right, ShimNode)
+
+    step.hash_tree_root()
+    next = step.copy()
+    next.contract.pc = 1
+    calls = macula.merkle_hash_calls
+    # shimming does not hash anything
+    next.set_backing(ShimNode.shim(next.get_backing()))
+    assert macula.merkle_hash_calls == calls
+    # only the path to the changed leaf is hashed
+    next.hash_tree_root()
+    assert macula.merkle_hash_calls - calls == pc_gindex.bit_length() - 1
+
+
+def test_shim_tracker_reset():
+    tracker = ShimTracker()
+    step, next = two_steps()
+    step.contract.pc = 7
+    step.set_backing(ShimNode.shim(step.get_backing(), tracker))
+    _ = step.contract.pc
+    [pc_gindex] = step.get_backing().get_touched_gindices()
+    assert pc_gindex > 1
+
+    next = step.copy()
+    next.contract.pc = 2
+    next.set_backing(ShimNode.shim(next.get_backing(), tracker))
+    tracker.reset()
+    # resetting the tracker resets all steps, including the subtrees they share
+    assert list(step.get_backing().get_touched_gindices()) == [1]
+    assert list(next.get_backing().get_touched_gindices()) == [1]
+    assert next.contract.pc == 2
+    assert list(next.get_backing().get_touched_gindices()) == [pc_gindex]
+    assert list(step.get_backing().get_touched_gindices()) == [1]
+
+
+def test_touched_zero_subtree():
+    step, _ = two_steps()
+    step.set_backing(ShimNode.shim(step.get_backing()))
+    # the call work scope is all zero, reading a field of it touches just the zero subtree
+    _ = step.call_work.gas
+    [zero_gindex] = step.get_backing().get_touched_gindices()
+    assert step.get_backing().getter(zero_gindex).merkle_root() in ZERO_ROOTS
+
+    next = step.copy()
+    next.call_work.gas = 1
+    next.set_backing(ShimNode.shim(next.get_backing()))
+    _ = next.call_work.gas
+    [gas_gindex] = next.get_backing().get_touched_gindices()
+    # the gas field is somewhere within the zero subtree
+    assert gas_gindex > zero_gindex
+    assert gas_gindex >> (gas_gindex.bit_length() - zero_gindex.bit_length()) == zero_gindex
@@ -0,0 +1,105 @@
+import io
+from macula.step import Step
+from macula.capture import CaptureTrace, AccessLog, StepAccessedKeys
+from macula.external import NoSource
+from macula.exec_mode import ExecMode
+from macula.opcodes import OpCode
+from macula.witness import get_step_witness, encode_hex
+from macula.witness_stream import WitnessWriter, WitnessReader
+from macula.witness_gen import write_step_witness, replay_step_witness
+
+
+def compile_test_ops(ops: list) -> bytes:
+    return bytes(map(lambda x: int(x.value) if isinstance(x, OpCode) else int(x), ops))
+
+
+def test_sparse_replay():
+    ops = [
+        OpCode.PUSH1, 1,
+        OpCode.PUSH1, 2,
+        OpCode.ADD,
+        OpCode.PUSH1, 3,
+        OpCode.MSTORE,
+        OpCode.PUSH1, 0,
+        OpCode.MLOAD,
+        OpCode.POP,
+        OpCode.STOP,
+    ]
+    trac = CaptureTrace(NoSource())
+    step = Step()
+    step.contract.code = compile_test_ops(ops)
+    step.contract.gas = 100000
+    step.exec_mode = ExecMode.CallPre.value
+    trac.add_step(step)
+
+    full_out = io.BytesIO()
+    full_writer = WitnessWriter(full_out)
+    sparse_out = io.BytesIO()
+    sparse_writer = WitnessWriter(sparse_out)
+    k = 8
+    # runs until the STOP error, call-post processing is not supported without a parent step
+    while ExecMode(trac.last().exec_mode) != ExecMode.ErrSTOP:
+        new_step = trac.trace_next()
+        write_step_witness(full_writer, trac, len(trac.steps)-1)
+        write_step_witness(sparse_writer, trac, len(trac.steps)-1, sparse_writer.step_count % k == 0)
+        trac.add_step(new_step)
+        trac.prune()
+    write_step_witness(full_writer, trac, len(trac.steps)-1)
+    write_step_witness(sparse_writer, trac, len(trac.steps)-1, sparse_writer.step_count % k == 0)
+    full_writer.close()
+    sparse_writer.close()
+
+    full = WitnessReader(full_out.getvalue())
+    sparse = WitnessReader(sparse_out.getvalue())
+    assert len(sparse_out.getvalue()) < len(full_out.getvalue())
+    assert sparse.step_count == full.step_count > 3 * k
+    assert [sparse.is_full_step(i) for i in range(k + 1)] == [True] + [False] * (k - 1) + [True]
+    for i in range(full.step_count - 1):
+        assert replay_step_witness(sparse, i) == get_step_witness(full, i)
+    # a full step followed by a step that is not full: just the root of the next step is needed
+    assert get_step_witness(sparse, 0, encode_hex(sparse.step_root(1))) == get_step_witness(full, 0)
+    try:
+        get_step_witness(sparse, 1)
+        assert False, "expected the access list of a step that is not full to be unavailable"
+    except Exception as e:
+        assert "replay_step_witness" in str(e)
+
+
+def test_access_log():
+    log = AccessLog()
+    accesses = []
+    for i in range(5):
+        acc = StepAccessedKeys()
+        acc.step_gindices.update([1 + i, 300 + i, 1 << (70 + i)])
+        acc.accessed_world_mpt_nodes.update([bytes([i]) * 32, b"\xaa" * 32])
+        if i % 2 == 0:
+            acc.accessed_acc_storage_mpt_nodes[b"\x01" * 20] = {b"\xbb" * 32, bytes([i]) * 32}
+            acc.accessed_acc_storage_mpt_nodes[b"\x02" * 20] = {b"\xcc" * 32}
+        acc.accessed_codes.add(b"\xdd" * 32)
+        if i == 3:
+            acc.block_headers.add(b"\xee" * 32)
+        log.append(acc)
+        accesses.append(acc)
+        assert len(log) == i + 1
+        # the current and the previous step are not sealed yet
+        assert log[-1] is acc
+        assert log.sealed == max(i - 1, 0)
+
+    for i, acc in enumerate(accesses):
+        got = log[i]
+        for name in StepAccessedKeys.__slots__:
+            assert getattr(got, name) == getattr(acc, name)
+    # interned once for the whole log
+    assert log.table.count(b"\xaa" * 32) == 1
+
+    log.prune()
+    assert len(log) == 1
+    assert log[0] is accesses[-1]
+    assert len(log.table) == 0
+
+    # pruned after every step, like gen does: nothing is sealed
+    for acc in accesses:
+        log.append(acc)
+        log.prune()
+        assert log.sealed == 0 and len(log.gindices) == 0
+        assert len(log) == 1 and log[0] is acc